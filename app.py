@@ -1,17 +1,64 @@
 """Streamlit app code.
 
 This Streamlit app will showcase the use of the 'inference_pipeline.joblib'
-model under the 'model' folder.
+model under the 'model' folder, served from its compiled, memory-mapped copy
+in 'model/compiled_pipeline' when there is one.
 """
+import os
+import tempfile
+
 import polars as pl
 import streamlit as st
-from joblib import load  # noqa: E402
 
-from util.is_fraud import predict_file, predict_transaction
+from util.batch_scoring import (
+    count_rows,
+    score_batches,
+    spooled_csv,
+    write_batches,
+)
+from util.geography import (
+    build_geography_index,
+    country_states,
+    state_cities,
+)
+from util.is_fraud import load_model, predict_transaction
 
 # "st.session_state object:", st.session_state
 
-model = load('model/inference_pipeline.joblib')
+# Rows of a scored file shown on the page, the rest is only downloadable.
+PREVIEW_ROWS = 1_000
+MODEL_PATH = "model/inference_pipeline.joblib"
+# Written by ``python -m util.compiled_pipeline``, its arrays are mapped by
+# every app process instead of each unpickling the forest.
+COMPILED_MODEL_PATH = "model/compiled_pipeline"
+
+
+@st.cache_resource
+def get_model():
+    """ Load the model once per process, shared by every session. """
+    if os.path.isdir(COMPILED_MODEL_PATH):
+        return load_model(COMPILED_MODEL_PATH)
+    return load_model(MODEL_PATH)
+
+
+@st.cache_resource
+def get_geography():
+    """ Read the reference data once per process and index it. """
+    return build_geography_index(pl.read_csv("app_data/countries.csv"),
+                                 pl.read_csv("app_data/states.csv"),
+                                 pl.read_csv("app_data/cities.csv"))
+
+
+@st.cache_data(max_entries=10_000)
+def verify_transaction(transaction):
+    """ Score a transaction given as a tuple of (column, value) pairs,
+    memoized so repeated checks of the same inputs skip the model.
+    """
+    return predict_transaction(get_model(), pl.DataFrame(dict(transaction)))
+
+
+model = get_model()
+geography = get_geography()
 
 st.markdown(
     """
@@ -30,10 +77,6 @@ would flag it as fraudulent or not, and the probability of each case.
 """
 )
 
-countries_df = pl.read_csv("app_data/countries.csv")
-states_df = pl.read_csv("app_data/states.csv")
-cities_df = pl.read_csv("app_data/cities.csv")
-
 col1, col2 = st.columns(2)
 
 with col1:
@@ -62,58 +105,24 @@ if chip_info == "Online":
     state = "ONLINE"
     zip = "ONLINE"
 else:
-    countries = countries_df.select(
-        pl.col("name")
-    ).to_series().to_list()
-    country = st.selectbox("Country", countries, index=0,
+    country = st.selectbox("Country", geography["countries"], index=0,
                         placeholder="Country where the transaction was made.")
-    country_id = countries_df.filter(
-        pl.col("name") == country
-    ).select(
-        pl.col("id")
-    ).to_numpy()[0][0]
+    country_id = geography["country_ids"][country]
+    states = country_states(geography, country_id)
     if country_id == 233:  #  233 = United States
-        states = states_df.filter(
-            pl.col("country_id") == country_id
-        ).select(
-            pl.col("state_code")
-        ).to_series().to_list()
-        state_code = st.selectbox("State", states, index=0,
+        state_code = st.selectbox("State", states["codes"], index=0,
                         placeholder="State where the transaction was made.")
-        state_id = states_df.filter(
-            pl.col("country_id") == 233
-        ).filter(pl.col("state_code") == state_code).select(
-            pl.col("id")
-        ).to_numpy()[0][0]
-        cities = cities_df.filter(
-            pl.col("state_id") == state_id
-        ).select(
-            pl.col("name")
-        ).to_series().to_list()
+        cities = state_cities(geography, states["id_by_code"][state_code])
         city = st.selectbox("Cities", cities, index=0,
                             placeholder="City where the transaction was made.")
         zip = st.number_input("Zip Code", value=91750, format="%d",
                               min_value=1, max_value=99_999)
         state = state_code
     else:
-        states = states_df.filter(
-            pl.col("country_id") == country_id
-        ).select(
-            pl.col("name")
-        ).to_series().to_list()
-        if len(states) > 0:
-            state = st.selectbox("State", states,
+        if len(states["names"]) > 0:
+            state = st.selectbox("State", states["names"],
                         placeholder="State where the transaction was made.")
-            state_id = states_df.filter(
-                pl.col("name") == state
-            ).select(
-                pl.col("id")
-            ).to_numpy()[0][0]
-            cities = cities_df.filter(
-                pl.col("state_id") == state_id
-            ).select(
-                pl.col("name")
-            ).to_series().to_list()
+            cities = state_cities(geography, states["id_by_name"][state])
             if len(cities) > 0:
                 city = st.selectbox("Cities", cities, index=0,
                             placeholder="City where the transaction was made.")
@@ -134,17 +143,17 @@ if errors is not None:
     errors = "".join(errors)
 card = 1
 
-data_df = pl.DataFrame({"Card": 1,
-                        "Amount": amount,
-                        "Merchant Name": 4645744106416199425,
-                        "Merchant State": state,
-                        "Merchant City": city,
-                        "Zip": zip,
-                        "MCC": mcc,
-                        "Errors?": errors,
-                        "Hour": hour,
-                        "Minute": minute,
-                        "Use Chip": chip_info + " Transaction"})
+transaction = (("Card", 1),
+               ("Amount", amount),
+               ("Merchant Name", 4645744106416199425),
+               ("Merchant State", state),
+               ("Merchant City", city),
+               ("Zip", zip),
+               ("MCC", mcc),
+               ("Errors?", errors),
+               ("Hour", hour),
+               ("Minute", minute),
+               ("Use Chip", chip_info + " Transaction"))
 
 st.markdown(
     """
@@ -153,15 +162,19 @@ Press the "Verify Transaction" button to check if the transaction is\
 """
 )
 
-st.button("Verify Transaction", on_click=predict_transaction(model, data_df))
-if st.single_transact is not None:
-    print(st.single_transact)
-    if st.single_transact[0] == 0:
+if st.button("Verify Transaction"):
+    st.session_state.single_transact = (transaction,
+                                        verify_transaction(transaction))
+# Only show a result that belongs to the inputs currently on screen.
+checked = st.session_state.get("single_transact")
+if checked is not None and checked[0] == transaction:
+    prediction, probabilities = checked[1]
+    if prediction == 0:
         st.markdown(f":white_check_mark: The transaction is legitimate,\
-            with a {st.single_transact[1][0]} probability!")
+            with a {probabilities[0]} probability!")
     else:
         st.markdown(f":x: The transaction is fraulent,\
-                    with a {st.single_transact[1][1]} probability!")
+                    with a {probabilities[1]} probability!")
 
 st.markdown(
     """
@@ -176,10 +189,16 @@ template file.
 
 uploaded_file = st.file_uploader("Upload a CSV file")
 if uploaded_file is not None:
-    data_df = pl.read_csv(uploaded_file)
-    predict_file(model, data_df)
-    final_data_df = pl.concat([data_df, st.multiple_transacts],
-                              how="horizontal")
-    st.markdown("Here's the original CSV file with a new\
+    with spooled_csv(uploaded_file) as source_path, \
+            tempfile.NamedTemporaryFile(suffix=".csv") as scored_file:
+        total = count_rows(source_path)
+        progress = st.progress(0.0, text="Scoring transactions...")
+        for written in write_batches(score_batches(source_path, model),
+                                     scored_file.name):
+            progress.progress(written / total,
+                              text=f"Scored {written}/{total} transactions")
+        st.markdown("Here's the original CSV file with a new\
  'Predicted_Is_Fraud?' column with the prediction for each transaction:")
-    st.dataframe(final_data_df)
+        st.dataframe(pl.read_csv(scored_file.name, n_rows=PREVIEW_ROWS))
+        st.download_button("Download all predictions", data=scored_file,
+                           file_name="predictions.csv", mime="text/csv")
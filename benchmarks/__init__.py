@@ -0,0 +1 @@
+""" Benchmarks of the pipeline, run as modules from the repository root. """
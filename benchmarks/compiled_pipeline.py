@@ -0,0 +1,84 @@
+""" Check parity and compare latency of the compiled scoring engine.
+
+Trains the pipeline from ``feature_pipeline.build_pipeline`` on synthetic
+transactions, compiles it and scores single rows and small batches with
+both. Run from the repository root with:
+
+    python -m benchmarks.compiled_pipeline --rows 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_transactions
+from util.categories import (
+    encode_categories,
+    extend_dictionaries,
+    inference_pipeline,
+)
+from util.compiled_pipeline import compile_pipeline
+from util.preprocessing import preprocess_dataset
+
+
+def train_pipeline(rows, **model_params):
+    """ Fit the training pipeline on synthetic data like the flow does and
+    return the inference pipeline.
+
+    Keyword arguments override parameters of the forest, for example
+    ``n_estimators`` or ``max_depth``.
+    """
+    from feature_pipeline import build_pipeline
+
+    data_df = preprocess_dataset(generate_transactions(rows, fraud_rate=0.1),
+                                 include_target=True)
+    dictionaries = extend_dictionaries(data_df)
+    data_df = encode_categories(data_df, dictionaries).to_pandas()
+    pipeline = build_pipeline()
+    pipeline.set_params(model__verbose=0, **{
+        f"model__{key}": value for key, value in model_params.items()
+    })
+    pipeline.fit(data_df.drop(columns="Is Fraud?"),
+                 data_df["Is Fraud?"].to_numpy())
+    return inference_pipeline(pipeline, dictionaries)
+
+
+def latency(function, data, repeat):
+    """ Return the median latency of a function call in milliseconds. """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start)
+    return np.median(timings) * 1_000
+
+
+def main():
+    """ Assert parity with sklearn and print latencies per batch size. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    pipeline = train_pipeline(args.rows)
+    engine = compile_pipeline(pipeline)
+
+    score_df = preprocess_dataset(
+        generate_transactions(10_000, seed=1)).to_pandas()
+    np.testing.assert_allclose(engine.predict_proba(score_df),
+                               pipeline.predict_proba(score_df))
+    print("parity: ok")
+
+    print(f"{'batch':>6} {'sklearn ms':>11} {'compiled ms':>12} "
+          f"{'speedup':>8}")
+    for batch_size in (1, 10, 100, 1_000):
+        batch_df = score_df.head(batch_size)
+        records = batch_df.to_dict("records")
+        sklearn_ms = latency(pipeline.predict_proba, batch_df, args.repeat)
+        compiled_ms = latency(engine.predict_proba, records, args.repeat)
+        print(f"{batch_size:>6} {sklearn_ms:>11.3f} {compiled_ms:>12.3f} "
+              f"{sklearn_ms / compiled_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+""" Check accuracy and cost of the traffic profile sketches.
+
+Generates synthetic transactions with a skewed merchant distribution,
+profiles them and asserts that quantiles are within the sketch's relative
+accuracy, that the most frequent merchants are found, that profiles of two
+halves merge into the profile of the whole and that a split of category
+codes, decoded with its dictionaries, lands in the same counters as the raw
+values. Then reports the drift found in held-out and shifted traffic and the
+cost of updating a profile per batch size. Run from the repository root
+with:
+
+    python -m benchmarks.drift --rows 200000
+"""
+import argparse
+import time
+
+import numpy as np
+import polars as pl
+
+from benchmarks.synthetic import generate_transactions
+from util.categories import encode_categories, extend_dictionaries
+from util.drift import TrafficProfile
+from util.preprocessing import preprocess_dataset
+
+
+def skewed_transactions(rows, seed=0):
+    """ Return preprocessed synthetic transactions whose merchants follow a
+    Zipf distribution.
+    """
+    rng = np.random.default_rng(seed)
+    return preprocess_dataset(generate_transactions(
+        rows, seed=seed
+    ).with_columns(
+        pl.Series("Merchant Name",
+                  np.minimum(rng.zipf(1.5, rows), 100_000) * 7919),
+    ))
+
+
+def assert_same_counts(expected, actual):
+    """ Assert two profiles hold identical sketches. """
+    for column, sketch in expected.numeric.items():
+        np.testing.assert_array_equal(sketch.counts,
+                                      actual.numeric[column].counts)
+    for column, sketch in expected.categorical.items():
+        np.testing.assert_array_equal(sketch.counts,
+                                      actual.categorical[column].counts)
+    np.testing.assert_array_equal(expected.probabilities,
+                                  actual.probabilities)
+
+
+def main():
+    """ Assert accuracy and print drift and update cost. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    data_df = skewed_transactions(args.rows)
+    data = data_df.to_pandas()
+    fraud_proba = np.random.default_rng(0).beta(0.5, 5, args.rows)
+    profile = TrafficProfile()
+    profile.update(data, fraud_proba)
+
+    sketch = profile.numeric["Amount"]
+    quantiles = np.linspace(0.01, 0.99, 99)
+    exact = np.quantile(data["Amount"], quantiles, method="lower")
+    estimated = sketch.quantile(quantiles)
+    large = np.abs(exact) >= sketch.min_value
+    error = np.max(np.abs(estimated - exact)[large] / np.abs(exact)[large])
+    np.testing.assert_array_less(error, sketch.relative_accuracy * 1.01)
+    print(f"quantiles: ok, max relative error {error:.4f}")
+
+    merchants = profile.categorical["Merchant Name"]
+    shares = data["Merchant Name"].value_counts(normalize=True)
+    found = {value for value, _ in merchants.heavy_hitters()}
+    np.testing.assert_equal(
+        {str(value) for value in shares.index[:10]} - found, set())
+    error = max(abs(share - shares[int(value)])
+                for value, share in merchants.heavy_hitters()[:10])
+    print(f"heavy hitters: ok, max share error {error:.4f}")
+
+    half = args.rows // 2
+    merged = TrafficProfile()
+    merged.update(data.iloc[:half], fraud_proba[:half])
+    other = TrafficProfile()
+    other.update(data.iloc[half:], fraud_proba[half:])
+    assert_same_counts(profile, merged.merge(other))
+    dictionaries = extend_dictionaries(data_df)
+    coded = TrafficProfile()
+    coded.update(encode_categories(data_df, dictionaries), fraud_proba,
+                 dictionaries=dictionaries)
+    assert_same_counts(profile, coded)
+    assert_same_counts(profile,
+                       TrafficProfile.from_dict(profile.to_dict()))
+    print("merge, decoding and serialization: ok")
+
+    held_out = skewed_transactions(args.rows // 10, seed=1).to_pandas()
+    shifted = held_out.assign(Amount=held_out["Amount"] * 2)
+    for name, traffic in (("held-out", held_out), ("shifted", shifted)):
+        current = TrafficProfile()
+        current.update(traffic)
+        report = current.compare(profile)["features"]
+        print(f"{name} PSI: " + ", ".join(
+            f"{column} {drift['psi']:.3f}"
+            for column, drift in report.items()))
+
+    for batch_size in (1, 64, 512, 10_000):
+        batch = {column: np.asarray(data[column][:batch_size])
+                 for column in profile.columns}
+        batch_proba = fraud_proba[:batch_size]
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            profile.update(batch, batch_proba)
+        seconds = (time.perf_counter() - start) / args.repeat
+        print(f"update of {batch_size:>6} rows: {seconds * 1e6:9.1f} us, "
+              f"{seconds / batch_size * 1e6:.2f} us/row")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+""" Check encoder parity and time incremental updates against full refits.
+
+Splits synthetic transactions into daily partitions. Asserts that target
+encoder statistics accumulated partition by partition give the encodings of
+an encoder fitted on all of them at once, then compares the time to refit
+the pipeline on the whole history with the time to update it with the
+latest partition only. Run from the repository root with:
+
+    python -m benchmarks.incremental --partitions 8 --partition-rows 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_transactions
+from util.categories import encode_categories, extend_dictionaries
+from util.incremental import (
+    encoder_statistics,
+    target_encoder,
+    update_pipeline,
+)
+from util.preprocessing import TARGET_COLUMN, preprocess_dataset
+
+
+def partitions(count, rows, fraud_rate):
+    """ Return ``count`` encoded partitions as (features, target) pairs. """
+    dictionaries = None
+    encoded = []
+    for seed in range(count):
+        data_df = preprocess_dataset(
+            generate_transactions(rows, fraud_rate=fraud_rate, seed=seed),
+            include_target=True)
+        dictionaries = extend_dictionaries(data_df, dictionaries)
+        data_df = encode_categories(data_df, dictionaries)
+        encoded.append((data_df.drop(TARGET_COLUMN).to_pandas(),
+                        data_df.get_column(TARGET_COLUMN).to_numpy()))
+    return encoded
+
+
+def fit(train_x, train_y, trees):
+    """ Fit the training pipeline from scratch. """
+    from feature_pipeline import build_pipeline
+
+    pipeline = build_pipeline(n_estimators=trees)
+    pipeline.set_params(model__verbose=0)
+    pipeline.fit(train_x, train_y)
+    return pipeline
+
+
+def main():
+    """ Assert encoder parity and print full refit and update timings. """
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--partitions", type=int, default=8)
+    parser.add_argument("--partition-rows", type=int, default=100_000)
+    parser.add_argument("--fraud-rate", type=float, default=0.01)
+    parser.add_argument("--trees", type=int, default=10)
+    parser.add_argument("--new-trees", type=int, default=2)
+    args = parser.parse_args()
+
+    data = partitions(args.partitions, args.partition_rows, args.fraud_rate)
+    pipeline = fit(*data[0], args.trees)
+    statistics = encoder_statistics(pipeline, *data[0])
+
+    print(f"{'history rows':>12} {'full refit s':>13} {'update s':>9}")
+    for day in range(1, len(data)):
+        history_x = pd.concat([train_x for train_x, _ in data[:day + 1]])
+        history_y = np.concatenate([train_y for _, train_y in data[:day + 1]])
+        start = time.perf_counter()
+        refit = fit(history_x, history_y, args.trees)
+        refit_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        statistics = update_pipeline(pipeline, statistics, *data[day],
+                                     args.new_trees, replace_trees=True)
+        update_seconds = time.perf_counter() - start
+
+        # The updated encoder must match one fitted on the whole history.
+        encoder, _ = target_encoder(pipeline)
+        expected, _ = target_encoder(refit)
+        np.testing.assert_allclose(encoder.target_mean_,
+                                   expected.target_mean_)
+        for actual, wanted in zip(encoder.encodings_, expected.encodings_):
+            np.testing.assert_allclose(actual, wanted)
+        print(f"{len(history_y):>12} {refit_seconds:>13.2f} "
+              f"{update_seconds:>9.2f}", flush=True)
+    print("Incremental encoder statistics match a full refit.")
+
+
+if __name__ == "__main__":
+    main()
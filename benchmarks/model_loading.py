@@ -0,0 +1,96 @@
+""" Measure cold start and memory of workers loading the model.
+
+Compares every worker unpickling the joblib pipeline against memory-mapping
+the compiled engine. Workers start together, load the model, score a batch
+so the trees are paged in, then report their load time, resident memory
+(RSS) and proportional set size (PSS, shared pages split between the
+processes sharing them). Linux only. Run from the repository root with:
+
+    python -m benchmarks.model_loading --rows 200000 --trees 50
+"""
+import argparse
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+
+from joblib import dump, load
+
+from benchmarks.compiled_pipeline import train_pipeline
+from benchmarks.synthetic import generate_transactions
+from util.compiled_pipeline import CompiledPipeline, compile_pipeline
+from util.preprocessing import preprocess_dataset
+
+
+def memory_mb():
+    """ Return the RSS and PSS of the current process in megabytes. """
+    usage = {}
+    for line in Path("/proc/self/smaps_rollup").read_text().splitlines():
+        key, _, value = line.partition(":")
+        if key in ("Rss", "Pss"):
+            usage[key] = int(value.split()[0]) / 1024
+    return usage["Rss"], usage["Pss"]
+
+
+def worker(path, compiled, score_df, barrier, results):
+    """ Load the model, score once and report timings and memory. """
+    barrier.wait()
+    start = time.perf_counter()
+    model = CompiledPipeline.load(path) if compiled else load(path)
+    load_seconds = time.perf_counter() - start
+    model.predict_proba(score_df)
+    # Measure once every worker holds its model, so sharing is visible.
+    barrier.wait()
+    results.put((load_seconds, *memory_mb()))
+    barrier.wait()
+
+
+def measure(path, compiled, score_df, workers):
+    """ Start ``workers`` processes and return their mean measurements. """
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker,
+                        args=(path, compiled, score_df, barrier, results))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return [sum(values) / workers for values in zip(*measurements)]
+
+
+def main():
+    """ Print load time, RSS and PSS per worker for 1 to 8 workers. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--trees", type=int, default=50)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    pipeline = train_pipeline(args.rows, n_estimators=args.trees)
+    model_dir = Path(tempfile.mkdtemp())
+    joblib_path = model_dir / "inference_pipeline.joblib"
+    compiled_path = model_dir / "compiled_pipeline"
+    dump(pipeline, joblib_path)
+    compile_pipeline(pipeline).save(compiled_path)
+    score_df = preprocess_dataset(
+        generate_transactions(1_000, seed=1)).to_pandas()
+
+    print(f"{'format':>8} {'workers':>7} {'load ms':>8} {'RSS MB':>7} "
+          f"{'PSS MB':>7}")
+    for name, path, compiled in (("joblib", joblib_path, False),
+                                 ("compiled", compiled_path, True)):
+        for workers in args.workers:
+            load_seconds, rss, pss = measure(str(path), compiled, score_df,
+                                             workers)
+            print(f"{name:>8} {workers:>7} {load_seconds * 1_000:>8.1f} "
+                  f"{rss:>7.1f} {pss:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
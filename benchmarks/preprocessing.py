@@ -0,0 +1,78 @@
+""" Compare the shared preprocessing against the original per-row lambdas.
+
+Run from the repository root with:
+
+    python -m benchmarks.preprocessing --rows 1000000
+"""
+import argparse
+import time
+
+import polars as pl
+
+from util.preprocessing import preprocess_dataset
+
+
+def legacy_preprocess_dataset(data_df):
+    """ Original map_elements based implementation, kept as a baseline. """
+    return data_df.with_columns(
+        Hour = pl.col("Time").map_elements(
+            lambda x: x[:2]).cast(pl.Int64, strict=True),
+        Minute = pl.col("Time").map_elements(
+            lambda x: x[3:]).cast(pl.Int64, strict=True),
+    ).drop("Time").with_columns(
+        pl.col("Amount").map_elements(
+            lambda x: x.replace("$", "")).cast(pl.Float64, strict=True)
+    ).with_columns(
+        pl.col("Merchant State").fill_null("ONLINE")
+    ).with_columns(
+        pl.col("Zip").cast(pl.String, strict=True).fill_null("ONLINE")
+    ).with_columns(
+        pl.col("Errors?").fill_null(value="No")
+    ).with_columns(
+        pl.col("Is Fraud?").map_elements(
+            lambda x: 0 if x == "No" else 1
+        )
+    )
+
+
+def sample_dataset(rows):
+    """ Tile the bundled test transactions up to the requested row count. """
+    sample_df = pl.read_csv("app_data/test_data.csv").with_columns(
+        pl.lit("No").alias("Is Fraud?"))
+    repeats = rows // len(sample_df) + 1
+    return pl.concat([sample_df] * repeats).head(rows)
+
+
+def best_time(function, data_df, repeat):
+    """ Return the best time of several runs and the last result. """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(data_df)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    """ Time both implementations and check that their outputs match. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    data_df = sample_dataset(args.rows)
+    legacy_time, legacy_df = best_time(legacy_preprocess_dataset, data_df,
+                                       args.repeat)
+    shared_time, shared_df = best_time(
+        lambda df: preprocess_dataset(df, include_target=True), data_df,
+        args.repeat)
+
+    assert legacy_df.equals(shared_df), "Outputs differ"  # noqa: S101
+    print(f"rows:    {args.rows}")
+    print(f"legacy:  {legacy_time:.3f}s")
+    print(f"shared:  {shared_time:.3f}s")
+    print(f"speedup: {legacy_time / shared_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
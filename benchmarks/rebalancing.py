@@ -0,0 +1,100 @@
+""" Compare wall-clock, peak memory and recall of the rebalancing strategies.
+
+Each strategy rebalances and fits the training pipeline in its own fresh
+process on the same synthetic training split, so peak memory of one strategy
+does not leak into the next, and is scored on an untouched test split. Run
+from the repository root with:
+
+    python -m benchmarks.rebalancing --rows 1000000 --fraud-rate 0.001
+"""
+import argparse
+import multiprocessing
+
+from benchmarks.synthetic import generate_transactions
+from util.categories import encode_categories, extend_dictionaries
+from util.preprocessing import TARGET_COLUMN, preprocess_dataset
+from util.rebalancing import STRATEGIES
+
+
+def split(rows, fraud_rate, train_proportion=0.6):
+    """ Return synthetic (train_x, train_y, test_x, test_y) polars frames,
+    encoded like the flow's ``split_dataset`` step.
+    """
+    data_df = preprocess_dataset(
+        generate_transactions(rows, fraud_rate=fraud_rate),
+        include_target=True)
+    data_df = encode_categories(
+        data_df, extend_dictionaries(data_df)
+    ).sample(fraction=1.0, shuffle=True, seed=0)
+    train_size = int(len(data_df) * train_proportion)
+    train_df, test_df = data_df.head(train_size), data_df.tail(-train_size)
+    return (train_df.drop(TARGET_COLUMN), train_df.select(TARGET_COLUMN),
+            test_df.drop(TARGET_COLUMN), test_df.select(TARGET_COLUMN))
+
+
+def run_strategy(args, strategy, results):
+    """ Rebalance, fit and score with one strategy, adding its results. """
+    from sklearn.metrics import precision_score, recall_score
+
+    from feature_pipeline import build_pipeline
+    from util.instrumentation import track_resources
+    from util.rebalancing import rebalance
+
+    train_x, train_y, test_x, test_y = split(args.rows, args.fraud_rate)
+    with track_resources() as rebalance_usage:
+        train_x_res, train_y_res, fit_params = rebalance(
+            train_x, train_y, strategy,
+            memory_budget_mb=args.memory_budget_mb,
+            majority_ratio=args.majority_ratio)
+    with track_resources() as fit_usage:
+        pipeline = build_pipeline()
+        pipeline.set_params(model__verbose=0)
+        pipeline.fit(train_x_res, train_y_res, **fit_params)
+    test_pred_y = pipeline.predict(test_x.to_pandas())
+    test_y = test_y.to_series().to_numpy()
+    results.put({
+        "strategy": strategy,
+        "rows": len(train_y_res),
+        "rebalance_seconds": rebalance_usage["seconds"],
+        "rebalance_peak_memory_mb": rebalance_usage["peak_memory_mb"],
+        "fit_seconds": fit_usage["seconds"],
+        "fit_peak_memory_mb": fit_usage["peak_memory_mb"],
+        "test_recall": recall_score(test_y, test_pred_y),
+        "test_precision": precision_score(test_y, test_pred_y,
+                                          zero_division=0),
+    })
+
+
+def main():
+    """ Run every strategy in a fresh process and print a comparison. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=500_000)
+    parser.add_argument("--fraud-rate", type=float, default=0.001)
+    parser.add_argument("--memory-budget-mb", type=int, default=256)
+    parser.add_argument("--majority-ratio", type=float, default=1.0)
+    parser.add_argument("--strategies", nargs="+", default=list(STRATEGIES),
+                        choices=STRATEGIES)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    print(f"{'strategy':>14} {'rows':>9} {'rebalance s':>12} "
+          f"{'peak MB':>8} {'fit s':>8} {'peak MB':>8} {'recall':>7} "
+          f"{'precision':>9}")
+    for strategy in args.strategies:
+        process = context.Process(target=run_strategy,
+                                  args=(args, strategy, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(f"{result['strategy']:>14} {result['rows']:>9} "
+              f"{result['rebalance_seconds']:>12.2f} "
+              f"{result['rebalance_peak_memory_mb']:>8.0f} "
+              f"{result['fit_seconds']:>8.2f} "
+              f"{result['fit_peak_memory_mb']:>8.0f} "
+              f"{result['test_recall']:>7.3f} "
+              f"{result['test_precision']:>9.3f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
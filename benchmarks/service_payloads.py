@@ -0,0 +1,83 @@
+""" Compare payload sizes and serving latency of the JSON and Arrow paths.
+
+For each batch size the request is encoded as JSON records, an Arrow IPC
+stream and a Parquet file. The server-side work of each endpoint (decode the
+request, score it and encode the response) is timed in-process with the same
+compiled engine, so only the serialization paths differ. Run from the
+repository root with:
+
+    python -m benchmarks.service_payloads --rows 100000
+"""
+import argparse
+import io
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.compiled_pipeline import latency, train_pipeline
+from benchmarks.synthetic import generate_transactions
+from service.arrow_io import (
+    is_parquet,
+    probability_table,
+    read_table,
+    write_table,
+)
+from util.compiled_pipeline import compile_pipeline
+from util.preprocessing import preprocess_dataset
+
+
+def json_endpoint(engine, payload):
+    """ Mirror ``predict``: JSON records in, every column echoed back. """
+    input_df = pd.read_json(io.StringIO(payload), orient="records")
+    probabilities = engine.predict_proba(input_df)
+    input_df["is_fraud_proba"] = probabilities[:, 1]
+    input_df["is_legit_proba"] = probabilities[:, 0]
+    return input_df.to_json(orient="records")
+
+
+def arrow_endpoint(engine, payload):
+    """ Mirror ``predict_arrow``: Arrow or Parquet in, probabilities out. """
+    table = read_table(payload)
+    fraud_proba = engine.score_features(engine.transform(table))[:, 1]
+    return write_table(probability_table(table, fraud_proba),
+                       parquet=is_parquet(payload))
+
+
+def main():
+    """ Print request/response sizes and latency per format and batch. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = compile_pipeline(train_pipeline(args.rows))
+    requests_df = preprocess_dataset(
+        generate_transactions(10_000, seed=1)).with_row_index("request_id")
+
+    print(f"{'batch':>6} {'format':>8} {'request B':>10} {'response B':>11}"
+          f" {'latency ms':>11}")
+    for batch_size in (1, 100, 10_000):
+        batch_df = requests_df.head(batch_size)
+        payloads = {
+            "json": (json_endpoint,
+                     batch_df.drop("request_id").to_pandas().to_json(
+                         orient="records")),
+            "arrow": (arrow_endpoint, write_table(batch_df.to_arrow())),
+            "parquet": (arrow_endpoint,
+                        write_table(batch_df.to_arrow(), parquet=True)),
+        }
+        for name, (endpoint, payload) in payloads.items():
+            response = endpoint(engine, payload)
+            milliseconds = latency(lambda request, endpoint=endpoint:
+                                   endpoint(engine, request),
+                                   payload, args.repeat)
+            print(f"{batch_size:>6} {name:>8} {len(payload):>10} "
+                  f"{len(response):>11} {milliseconds:>11.3f}")
+    np.testing.assert_allclose(
+        read_table(arrow_endpoint(engine, write_table(
+            requests_df.to_arrow())))["is_fraud_proba"].to_numpy(),
+        engine.predict_proba(requests_df.to_pandas())[:, 1])
+
+
+if __name__ == "__main__":
+    main()
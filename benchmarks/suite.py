@@ -0,0 +1,244 @@
+""" End-to-end performance benchmark suite.
+
+Trains the pipeline on synthetic transactions for every combination of
+forest size and depth, then times preprocessing, each stage of the fitted
+pipeline (category codes, target encoding, scaling, forest), the full
+pipeline, the compiled engine and the Bento runner's ``is_fraud`` for batch
+sizes from 1 row up to 100k rows. Optionally replays a load test against a
+locally served Bento.
+Results are written as JSON, so runs on different commits can be compared.
+Run from the repository root with:
+
+    python -m benchmarks.suite --output bench_results.json
+
+and, with the service running (``bentoml serve
+service.service:fraud_detection_service``), add the load test with:
+
+    python -m benchmarks.suite --url http://127.0.0.1:3000 \
+--output bench_results.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.compiled_pipeline import train_pipeline
+from benchmarks.synthetic import generate_transactions
+from util.categories import CODES_STEP
+from util.compiled_pipeline import compile_pipeline
+from util.preprocessing import preprocess_dataset
+
+BATCH_SIZES = [1, 10, 100, 1_000, 10_000, 100_000]
+# Total rows scored per measurement, so small batches get more repeats.
+ROWS_PER_MEASUREMENT = 200_000
+
+
+def measure(function, data, repeat):
+    """ Call ``function(data)`` ``repeat`` times and summarize latencies. """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(data)
+        timings.append(time.perf_counter() - start)
+    timings = np.asarray(timings) * 1_000
+    return {
+        "repeat": repeat,
+        "mean_ms": float(timings.mean()),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p99_ms": float(np.percentile(timings, 99)),
+    }
+
+
+def stages(pipeline, engine, runners, raw_batch):
+    """ Return the timed stages of a raw batch as (function, input) pairs. """
+    batch_df = preprocess_dataset(raw_batch).to_pandas()
+    codes = pipeline.named_steps[CODES_STEP]
+    coded_df = codes.transform(batch_df)
+    union = pipeline.named_steps["feature_engineering"].named_steps["features"]
+    forest = pipeline.named_steps["model"]
+    timed = {
+        "preprocess_dataset": (preprocess_dataset, raw_batch),
+        "category_codes": (codes.transform, batch_df),
+        "target_encoding": (union.transformer_list[0][1].transform, coded_df),
+        "scaling": (union.transformer_list[1][1].transform, coded_df),
+        "forest": (forest.predict_proba, union.transform(coded_df)),
+        "pipeline": (pipeline.predict_proba, batch_df),
+        "compiled_pipeline": (engine.predict_proba, batch_df),
+    }
+    timed.update({name: (function, batch_df)
+                  for name, function in runners.items()})
+    return timed
+
+
+def runner_functions(pipeline):
+    """ Return ``is_fraud`` of the Bento runner, with and without the
+    compiled engine, or nothing when bentoml is not installed.
+    """
+    try:
+        import bentoml
+    except ImportError:
+        return {}, lambda: None
+
+    from service.fraud_detection_runner import FraudDetectionModelRunner
+    from service.model_versions import COMPILED_MODEL_DIR
+
+    bento_model = bentoml.sklearn.save_model("fraud-detection-benchmark",
+                                             pipeline)
+    compile_pipeline(pipeline).save(bento_model.path_of(COMPILED_MODEL_DIR))
+    functions = {}
+    for name, compiled in (("runner_is_fraud", False),
+                           ("runner_is_fraud_compiled", True)):
+        runner = FraudDetectionModelRunner(bento_model, compiled=compiled)
+        functions[name] = lambda batch_df, runner=runner: \
+            FraudDetectionModelRunner.is_fraud.func(runner, batch_df)
+    return functions, lambda: bentoml.models.delete(bento_model.tag)
+
+
+def benchmark_model(args, trees, depth, raw_df):
+    """ Train one model configuration and time every stage on it. """
+    fit_start = time.perf_counter()
+    pipeline = train_pipeline(args.train_rows, n_estimators=trees,
+                              max_depth=depth)
+    fit_seconds = time.perf_counter() - fit_start
+    engine = compile_pipeline(pipeline)
+    model = {
+        "n_estimators": trees,
+        "max_depth": depth,
+        "node_count": int(len(engine.left)),
+        "fit_seconds": fit_seconds,
+    }
+    runners, cleanup = runner_functions(pipeline)
+
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            repeat = max(3, min(args.repeat,
+                                ROWS_PER_MEASUREMENT // batch_size))
+            timed = stages(pipeline, engine, runners,
+                           raw_df.head(batch_size))
+            for stage, (function, data) in timed.items():
+                result = measure(function, data, repeat)
+                result.update({
+                    "model": model,
+                    "stage": stage,
+                    "batch_size": batch_size,
+                    "rows_per_second": batch_size * 1_000 / result["p50_ms"],
+                })
+                results.append(result)
+                print(f"trees={trees} depth={depth} {stage:>24} "
+                      f"batch={batch_size:>6} p50={result['p50_ms']:.3f}ms "
+                      f"p99={result['p99_ms']:.3f}ms", flush=True)
+    finally:
+        cleanup()
+    return results
+
+
+def load_test(url, raw_df, batch_size, concurrency, duration):
+    """ Replay JSON batches against a served Bento from ``concurrency``
+    threads for ``duration`` seconds and summarize the latencies.
+    """
+    batch_df = preprocess_dataset(raw_df)
+    payloads = [
+        batch_df.slice(offset, batch_size).to_pandas().to_json(
+            orient="records").encode()
+        for offset in range(0, min(len(batch_df), 100 * batch_size),
+                            batch_size)
+    ]
+    deadline = time.perf_counter() + duration
+
+    def client(worker):
+        latencies, errors = [], 0
+        sent = worker
+        while time.perf_counter() < deadline:
+            request = urllib.request.Request(  # noqa: S310
+                f"{url}/predict", data=payloads[sent % len(payloads)],
+                headers={"Content-Type": "application/json"})
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(request) as response:  # noqa: S310
+                    response.read()
+                latencies.append(time.perf_counter() - start)
+            except OSError:
+                errors += 1
+            sent += 1
+        return latencies, errors
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        outcomes = list(executor.map(client, range(concurrency)))
+    latencies = np.concatenate([latency for latency, _ in outcomes]) * 1_000
+    return {
+        "url": url,
+        "batch_size": batch_size,
+        "concurrency": concurrency,
+        "duration_seconds": duration,
+        "requests": int(len(latencies)),
+        "errors": int(sum(errors for _, errors in outcomes)),
+        "requests_per_second": len(latencies) / duration,
+        "rows_per_second": len(latencies) * batch_size / duration,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def run_metadata():
+    """ Describe the commit and environment the results come from. """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],  # noqa: S603, S607
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+
+def main():
+    """ Run the suite and write the results as JSON. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default=None,
+                        help="JSON results file, defaults to a temp file")
+    parser.add_argument("--train-rows", type=int, default=100_000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=BATCH_SIZES)
+    parser.add_argument("--trees", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 20],
+                        help="Forest max_depth values, 0 means unlimited")
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--url", help="Base URL of a served Bento to load \
+test, skipped when not given")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--load-batch-size", type=int, default=1)
+    args = parser.parse_args()
+
+    raw_df = generate_transactions(max(args.batch_sizes), seed=1)
+    report = {"metadata": run_metadata(), "config": vars(args),
+              "results": [], "load_test": None}
+    for trees in args.trees:
+        for depth in args.depths:
+            report["results"].extend(
+                benchmark_model(args, trees, depth or None, raw_df))
+    if args.url:
+        report["load_test"] = load_test(args.url, raw_df,
+                                        args.load_batch_size,
+                                        args.concurrency, args.duration)
+
+    output = args.output or tempfile.mkstemp(suffix=".json")[1]
+    with open(output, "w") as results_file:
+        json.dump(report, results_file, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+""" Synthetic transactions following the IBM credit card dataset schema. """
+import argparse
+
+import numpy as np
+import polars as pl
+
+USE_CHIP = ["Swipe Transaction", "Chip Transaction", "Online Transaction"]
+STATES = ["CA", "TX", "NY", "FL", "IL", "WA", "OH", "GA", "NC", "MI"]
+CITIES = ["La Verne", "Monterey Park", "Austin", "Houston", "New York",
+          "Miami", "Chicago", "Seattle", "Columbus", "Atlanta", "Raleigh",
+          "Detroit"]
+MCCS = [5411, 5499, 5541, 5812, 5912, 5942, 4829, 7230, 3000, 4121]
+ERRORS = ["Bad PIN", "Insufficient Balance", "Technical Glitch",
+          "Bad Card Number", "Bad CVV", "Bad Expiration", "Bad Zipcode"]
+
+
+def generate_transactions(rows, fraud_rate=0.01, users=2_000,
+                          merchants=50_000, seed=0):
+    """ Generate a raw transactions DataFrame with ``rows`` rows. """
+    rng = np.random.default_rng(seed)
+    use_chip = rng.choice(USE_CHIP, rows, p=[0.5, 0.35, 0.15])
+    online = use_chip == "Online Transaction"
+    merchant_names = rng.integers(-2**62, 2**62, merchants)
+    errors = np.where(rng.random(rows) < 0.02,
+                      rng.choice(ERRORS, rows), None)
+    amounts = np.round(rng.lognormal(3.5, 1.2, rows), 2)
+    amounts[rng.random(rows) < 0.01] *= -1
+    return pl.DataFrame({
+        "User": rng.integers(0, users, rows),
+        "Card": rng.integers(0, 9, rows),
+        "Year": rng.integers(1991, 2020, rows),
+        "Month": rng.integers(1, 13, rows),
+        "Day": rng.integers(1, 29, rows),
+        "Time": [f"{hour:02d}:{minute:02d}" for hour, minute in zip(
+            rng.integers(0, 24, rows), rng.integers(0, 60, rows))],
+        "Amount": [f"${amount:.2f}" for amount in amounts],
+        "Use Chip": use_chip,
+        "Merchant Name": rng.choice(merchant_names, rows),
+        "Merchant City": np.where(online, "ONLINE",
+                                  rng.choice(CITIES, rows)),
+        "Merchant State": pl.Series(
+            np.where(online, None, rng.choice(STATES, rows)).tolist(),
+            dtype=pl.String),
+        "Zip": pl.Series(
+            np.where(online, np.nan,
+                     rng.integers(10_000, 99_999, rows).astype(float)),
+            nan_to_null=True),
+        "MCC": rng.choice(MCCS, rows),
+        "Errors?": pl.Series(errors.tolist(), dtype=pl.String),
+        "Is Fraud?": np.where(rng.random(rows) < fraud_rate, "Yes", "No"),
+    })
+
+
+def main():
+    """ Write synthetic transactions to a CSV file. """
+    parser = argparse.ArgumentParser(description="Generate synthetic \
+transactions following the IBM credit card dataset schema.")
+    parser.add_argument("output", help="Output CSV file")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--fraud-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate_transactions(args.rows, fraud_rate=args.fraud_rate,
+                          seed=args.seed).write_csv(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+""" Check replay and compare latency of the journaled tracking calls.
+
+Logs the params and metrics of a few nested trial runs, an artifact and a
+registered model offline, replays the journal into a tracking server and
+asserts that everything arrived, then compares the time the training code
+waits for journaled and for direct mlflow calls, after a first pass paying
+for imports. A file store in a temp dir is used unless a server is given.
+Run from the repository root with:
+
+    python -m benchmarks.tracking --tracking-uri http://127.0.0.1:5000
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from util import tracking
+
+EXPERIMENT = "/benchmarks/tracking"
+
+
+def log_trials(api, trials, params, metrics):
+    """ Log nested trial runs and a summary artifact with ``api``, either
+    ``util.tracking`` or ``mlflow``, one call per param and metric as flow
+    steps spread over their code would. Return the seconds it took and the
+    parent run.
+    """
+    start = time.perf_counter()
+    with api.start_run(experiment=EXPERIMENT) if api is tracking \
+            else api.start_run() as parent:
+        for index in range(trials):
+            with api.start_run(run_name=f"trial-{index}", nested=True):
+                for key, value in params.items():
+                    api.log_params({f"{key}_{index}": value})
+                for key, value in metrics.items():
+                    api.log_metrics({f"{key}_{index}": value})
+        api.log_dict({"trials": trials}, "summary.json")
+    return time.perf_counter() - start, parent
+
+
+def main():
+    """ Assert replay and print the time spent in tracking calls. """
+    import mlflow
+    from mlflow import MlflowClient
+    from sklearn.dummy import DummyClassifier
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tracking-uri", default=None)
+    parser.add_argument("--trials", type=int, default=4)
+    parser.add_argument("--values", type=int, default=25)
+    args = parser.parse_args()
+
+    tracking_uri = (args.tracking_uri
+                    or f"file:{tempfile.mkdtemp()}/mlruns")
+    params = {f"param{index}": index for index in range(args.values)}
+    metrics = {f"metric{index}": index / 3 for index in range(args.values)}
+    model_name = f"tracking-benchmark-{time.time_ns()}"
+
+    directory = tempfile.mkdtemp()
+    tracking.configure(directory, tracking_uri, offline=True)
+    _, parent_id = log_trials(tracking, args.trials, params, metrics)
+    journaled_s, _ = log_trials(tracking, args.trials, params, metrics)
+    with tracking.start_run(run_id=parent_id):
+        tracking.log_model(DummyClassifier().fit([[0]], [0]), "model")
+        tracking.register_model("model", model_name)
+
+    start = time.perf_counter()
+    sent = tracking.replay(directory, tracking_uri)
+    replay_s = time.perf_counter() - start
+    np.testing.assert_equal(tracking.replay(directory, tracking_uri), 0)
+
+    client = MlflowClient(tracking_uri)
+    parent = client.search_runs(
+        [client.get_experiment_by_name(EXPERIMENT).experiment_id],
+        f"tags.`{tracking.LOCAL_RUN_ID_TAG}` = '{parent_id}'")[0]
+    children = client.search_runs(
+        [parent.info.experiment_id],
+        f"tags.`mlflow.parentRunId` = '{parent.info.run_id}'")
+    np.testing.assert_equal(len(children), args.trials)
+    for child in children:
+        index = int(child.info.run_name.split("-")[1])
+        np.testing.assert_equal(child.data.params, {
+            f"{key}_{index}": str(value) for key, value in params.items()})
+        np.testing.assert_equal(child.data.metrics, {
+            f"{key}_{index}": value for key, value in metrics.items()})
+        np.testing.assert_equal(child.info.status, "FINISHED")
+    np.testing.assert_equal({artifact.path for artifact in
+                             client.list_artifacts(parent.info.run_id)},
+                            {"model", "summary.json"})
+    version, = client.search_model_versions(f"name='{model_name}'")
+    np.testing.assert_equal(version.run_id, parent.info.run_id)
+    print(f"replay: ok, {sent} calls in {replay_s:.2f} s")
+
+    mlflow.set_tracking_uri(tracking_uri)
+    mlflow.set_experiment(EXPERIMENT)
+    log_trials(mlflow, args.trials, params, metrics)
+    direct_s, _ = log_trials(mlflow, args.trials, params, metrics)
+
+    calls = args.trials * (2 * args.values + 2) + 3
+    print(f"journaled: {journaled_s / calls * 1e6:9.1f} us/call")
+    print(f"direct:    {direct_s / calls * 1e6:9.1f} us/call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+""" Check parity and compare cost of the batch and online velocity features.
+
+Generates synthetic transactions packed into a few weeks so cards have a
+busy history, computes their velocity features with ``backfill`` and by
+streaming them through a ``VelocityStore``, asserts both agree exactly, in
+row order and in time order, and checks a snapshot restores the same
+history. Run from the repository root with:
+
+    python -m benchmarks.velocity --rows 200000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import polars as pl
+
+from benchmarks.synthetic import generate_transactions
+from util.preprocessing import preprocess_dataset
+from util.velocity import (
+    VELOCITY_COLUMNS,
+    VelocityStore,
+    backfill,
+    event_minutes,
+)
+
+
+def busy_transactions(rows, users, seed=0):
+    """ Return preprocessed synthetic transactions within four weeks. """
+    return preprocess_dataset(generate_transactions(
+        rows, users=users, merchants=rows // 100 + 1, seed=seed
+    ).with_columns(
+        pl.lit(2019).alias("Year"),
+        pl.lit(1).alias("Month"),
+    ))
+
+
+def assert_equal_features(expected, actual):
+    """ Assert two sets of velocity feature columns are identical. """
+    for column in VELOCITY_COLUMNS:
+        np.testing.assert_array_equal(np.asarray(expected[column]),
+                                      np.asarray(actual[column]),
+                                      err_msg=column)
+
+
+def main():
+    """ Assert parity and print the cost of both implementations. """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=1_000)
+    args = parser.parse_args()
+
+    data_df = busy_transactions(args.rows, args.users)
+
+    start = time.perf_counter()
+    expected = backfill(data_df)
+    backfill_s = time.perf_counter() - start
+    store = VelocityStore()
+    start = time.perf_counter()
+    actual = store.features(data_df)
+    online_s = time.perf_counter() - start
+    assert_equal_features(expected, actual)
+
+    order = np.argsort(event_minutes(data_df), kind="stable")
+    assert_equal_features(backfill(data_df, by_time=True)[order],
+                          VelocityStore().features(data_df[order]))
+    print("parity: ok")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "velocity.npz")
+        store.snapshot(path)
+        restored = VelocityStore.restore(path)
+        size_mb = os.path.getsize(path) / 1024 ** 2
+    more_df = busy_transactions(10_000, args.users, seed=1)
+    assert_equal_features(store.features(more_df),
+                          restored.features(more_df))
+    print(f"snapshot: ok, {len(store)} cards, {size_mb:.1f} MB")
+
+    single_df = more_df.head(1).to_pandas()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        store.features(single_df)
+    single_us = (time.perf_counter() - start) / args.repeat * 1e6
+
+    print(f"backfill: {backfill_s / args.rows * 1e6:.2f} us/transaction")
+    print(f"online:   {online_s / args.rows * 1e6:.2f} us/transaction, "
+          f"{single_us:.1f} us for a single-row DataFrame")
+
+
+if __name__ == "__main__":
+    main()
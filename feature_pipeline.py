@@ -1,14 +1,23 @@
 """ Feature engineering and training pipeline. """
 
-def build_pipeline():
-    """ Build pipeline with feature encoders and model. """
-    import mlflow
+def build_pipeline(n_estimators=10, max_depth=None, min_samples_leaf=1,
+                   smooth="auto", n_jobs=10, velocity=False):
+    """ Build pipeline with feature encoders and model.
+
+    The keyword arguments are the hyperparameters explored by the flow's
+    search, the defaults reproduce the original model. With ``velocity``
+    the per-card velocity features of ``util.velocity`` are scaled and fed
+    to the model too. The settings of every part are logged to the active
+    tracking run in one batch.
+    """
     from sklearn.compose import ColumnTransformer  # noqa: E402
     from sklearn.ensemble import RandomForestClassifier  # noqa: E402
     from sklearn.pipeline import FeatureUnion, Pipeline  # noqa: E402
     from sklearn.preprocessing import RobustScaler, TargetEncoder  # noqa: E402
+
+    from util import tracking
     # Target encoder
-    internal_target_encoding = TargetEncoder(smooth="auto")
+    internal_target_encoding = TargetEncoder(smooth=smooth)
     columns_to_encode = [
         "Card",
         "Merchant Name",
@@ -22,9 +31,9 @@ def build_pipeline():
         "Use Chip"
     ]
 
-    mlflow.log_param("target_encoded_columns", columns_to_encode)
+    params = {"target_encoded_columns": columns_to_encode}
     encoder_params = internal_target_encoding.get_params()
-    mlflow.log_params(
+    params.update(
         {f"target_encoder__{key}": value for key, value in encoder_params.items()})
 
     target_encoding = ColumnTransformer([
@@ -38,10 +47,13 @@ def build_pipeline():
     # Scaler
     internal_scaler = RobustScaler()
     columns_to_scale = ["Amount"]
+    if velocity:
+        from util.velocity import VELOCITY_COLUMNS
+        columns_to_scale += list(VELOCITY_COLUMNS)
 
-    mlflow.log_param("scaled_columns", columns_to_scale)
+    params["scaled_columns"] = columns_to_scale
     scaler_params = internal_scaler.get_params()
-    mlflow.log_params(
+    params.update(
         {f"scaler__{key}": value for key, value in scaler_params.items()})
 
     scaler = ColumnTransformer([
@@ -60,12 +72,16 @@ def build_pipeline():
     ])
 
     # Machine learning model
-    model = RandomForestClassifier(n_estimators=10, verbose=1, n_jobs=10)
+    model = RandomForestClassifier(n_estimators=n_estimators,
+                                   max_depth=max_depth,
+                                   min_samples_leaf=min_samples_leaf,
+                                   verbose=1, n_jobs=n_jobs)
 
     model_params = model.get_params()
-    mlflow.log_params({
+    params.update({
         f"model__{key}": value for key, value in model_params.items()
     })
+    tracking.log_params(params)
 
     # Full pipeline
     final_pipeline = Pipeline([
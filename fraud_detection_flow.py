@@ -2,222 +2,575 @@
 mlflow.
 """
 
-from metaflow import FlowSpec, Parameter, step
+from metaflow import FlowSpec, JSONType, Parameter, step
 
 
 class FraudDetectionFlow(FlowSpec):
     """ Class that will contain all our pipeline's steps."""
-    source_file = Parameter("source-file", help="Source CSV file")
+    source_file = Parameter("source-file", help="Source CSV file, or a \
+directory of CSV partitions")
     train_proportion = Parameter("train-proportion", help="Proportion of the \
 dataset to use for training", default=0.6)
     test_proportion = Parameter("test-proportion", help="Proportion of\
  the dataset to use for validation and testing", default=0.5)
+    streaming = Parameter("streaming", help="Ingest the source file with the \
+streaming engine into a cached Parquet dataset", default=False, type=bool)
+    cache_dir = Parameter("cache-dir", help="Directory for the cached Parquet\
+ datasets", default="data/cache")
+    rebalance = Parameter("rebalance", help="Class rebalancing strategy: \
+smote, chunked_smote, undersample or class_weight", default="smote")
+    memory_budget_mb = Parameter("memory-budget-mb", help="Memory budget in \
+MB for the rebalanced training set of chunked_smote", default=4096)
+    majority_ratio = Parameter("majority-ratio", help="Legitimate \
+transactions kept per fraudulent one when undersampling", default=1.0)
+    search_space = Parameter("search-space", help="JSON object mapping \
+n_estimators, max_depth, min_samples_leaf, smooth and rebalance to lists of \
+values to try, one trial per combination", type=JSONType, default="{}")
+    max_trials = Parameter("max-trials", help="Randomly sample at most this \
+many trials from the search space, 0 keeps them all", default=0)
+    trial_jobs = Parameter("trial-jobs", help="Forest jobs per trial, lower \
+it when many trials train in parallel", default=10)
+    recall_tolerance = Parameter("recall-tolerance", help="Pick the fastest \
+and smallest model among trials within this validation recall of the best",
+                                 default=0.0)
+    incremental = Parameter("incremental", help="Update the model of the \
+base run with the partitions it has not seen instead of training from \
+scratch", default=False, type=bool)
+    base_run = Parameter("base-run", help="Run id of the model to update in \
+incremental mode, defaults to the latest successful run", default="")
+    new_trees = Parameter("new-trees", help="Trees grown on the new \
+partitions in incremental mode", default=10)
+    replace_trees = Parameter("replace-trees", help="Drop as many of the \
+oldest trees as are grown in incremental mode, keeping the forest size",
+                              default=False, type=bool)
+    alert_budgets = Parameter("alert-budgets", help="JSON list of shares of \
+transactions analysts can review, recall is reported when alerting on that \
+many of the most suspicious ones", type=JSONType,
+                              default="[0.001, 0.005, 0.01, 0.05]")
+    threshold_beta = Parameter("threshold-beta", help="Beta of the F-beta \
+score maximized by the decision threshold, above 1 favours recall",
+                               default=1.0)
+    compaction = Parameter("compaction", help="JSON list of compaction \
+variants of the selected forest to evaluate, objects with any of max_depth, \
+min_samples_leaf, ccp_alpha and precision", type=JSONType, default="[]")
+    compaction_tolerance = Parameter("compaction-tolerance", help="Register \
+the smallest compaction variant within this validation recall of the full \
+model", default=0.0)
+    tracking_uri = Parameter("tracking-uri", help="URI of the mlflow \
+tracking server the journaled tracking calls are sent to",
+                             default="http://127.0.0.1:5000")
+    tracking_offline = Parameter("tracking-offline", help="Only journal the \
+tracking calls under the cache directory, to send them later with python -m \
+util.tracking", default=False, type=bool)
+    velocity_features = Parameter("velocity-features", help="Add per-card \
+transaction counts, spend and distinct merchants over the last hour and 24 \
+hours to the model's features", default=False, type=bool)
 
     @step
     def start(self):
         """ First step. """
-        import mlflow
+        from util import tracking
 
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        mlflow.set_experiment("/final-project/FraudDetection")
-        run = mlflow.start_run()
-        self.mlflow_run_id = run.info.run_id
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(
+                experiment="/final-project/FraudDetection") as run_id:
+            # The journal's own id, tagged on the mlflow run at replay.
+            self.tracking_run_id = run_id
 
         print("Initializing...")
         self.next(self.load_data)
 
     @step
     def load_data(self):
-        """ Load data into polars DataFrame and save it. """
-        import mlflow
+        """ Load data into polars DataFrame and store it.
+
+        In streaming mode the partitions are ingested into preprocessed
+        Parquet caches instead. Either way only references to the files are
+        saved, the data itself is memory-mapped by the steps that need it.
+        In incremental mode only the partitions the base run has not seen
+        are loaded.
+        """
         import polars as pl
-
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        with mlflow.start_run(run_id=self.mlflow_run_id):
-
-            print("Loading dataset...")
-            self.new_data_df = pl.read_csv(self.source_file)
+        from metaflow import current
+
+        from util import tracking
+        from util.artifacts import step_key, stored_step
+        from util.incremental import base_run
+        from util.ingest import file_digest, ingest_csv, list_partitions
+
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id):
+
+            partitions = list_partitions(self.source_file)
+            self.ingested_partitions = [path.name for path in partitions]
+            if self.incremental:
+                run = base_run(current.flow_name, self.base_run)
+                self.base_run_id = run.id
+                seen = set(run.data.ingested_partitions)
+                partitions = [path for path in partitions
+                              if path.name not in seen]
+                if not partitions:
+                    message = (f"No new partitions in {self.source_file} "
+                               f"since run {run.id}")
+                    raise ValueError(message)
+                self.ingested_partitions = run.data.ingested_partitions + [
+                    path.name for path in partitions]
+                tracking.log_param("base_run_id", self.base_run_id)
+            tracking.log_param("new_partitions", len(partitions))
+
+            print(f"Loading {len(partitions)} partition(s)...")
+            if self.streaming:
+                self.dataset_paths = [
+                    str(ingest_csv(path, self.cache_dir))
+                    for path in partitions
+                ]
+                tracking.log_param("cache_dir", self.cache_dir)
+            else:
+                key = step_key([self.load_data],
+                               [file_digest(path) for path in partitions])
+                self.raw_data = stored_step(
+                    f"{self.cache_dir}/steps", "load_data", key,
+                    lambda: ({"data": pl.concat(
+                        [pl.read_csv(path) for path in partitions],
+                        how="vertical_relaxed")}, None))
         self.next(self.preprocess_dataset)
 
     @step
     def preprocess_dataset(self):
         """ Pre-process dataset. """
-        import mlflow
-        import polars as pl
-
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        with mlflow.start_run(run_id=self.mlflow_run_id):
-
-            print("Pre-processing dataset...")
-            new_data_df = self.new_data_df.with_columns(
-                Hour = pl.col("Time").map_elements(
-                    lambda x: x[:2]).cast(pl.Int64, strict=True),
-                Minute = pl.col("Time").map_elements(
-                    lambda x: x[3:]).cast(pl.Int64, strict=True),
-            ).drop("Time").with_columns(
-                pl.col("Amount").map_elements(
-                    lambda x: x.replace("$", "")).cast(pl.Float64, strict=True)
-            ).with_columns(
-                pl.col("Merchant State").fill_null("ONLINE")
-            ).with_columns(
-                pl.col("Zip").cast(pl.String, strict=True).fill_null("ONLINE")
-            ).with_columns(
-                pl.col("Errors?").fill_null(value="No")
-            ).with_columns(
-                pl.col("Is Fraud?").map_elements(
-                    lambda x: 0 if x == "No" else 1
-                )
-            )
-            self.new_data_df = new_data_df
+        from util import preprocessing, tracking
+        from util.artifacts import step_key, stored_step
+
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id):
+
+            if self.streaming:
+                print("Dataset already pre-processed during ingest.")
+            else:
+                print("Pre-processing dataset...")
+                key = step_key([self.preprocess_dataset, preprocessing],
+                               [self.raw_data.key])
+                dataset = stored_step(
+                    f"{self.cache_dir}/steps", "preprocess_dataset", key,
+                    lambda: ({"data": preprocessing.preprocess_dataset(
+                        self.raw_data.load("data"), include_target=True)},
+                        None))
+                self.dataset_paths = [str(dataset.frame_path("data"))]
         self.next(self.split_dataset)
 
     @step
     def split_dataset(self):
-        """ Convert categorical columns and split dataset. """
-        import mlflow
+        """ Convert categorical columns and split dataset.
+
+        Categorical values are replaced by codes from category dictionaries
+        that are saved with the run, and extended rather than rebuilt in
+        incremental mode so codes stay stable across runs. Velocity features
+        are backfilled on the whole dataset in time order before splitting.
+        The splits are stored as Parquet files and only a reference to them
+        is saved.
+        """
         import polars as pl
+        from metaflow import current
         from sklearn.model_selection import train_test_split
 
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        with mlflow.start_run(run_id=self.mlflow_run_id):
-
-            print("Splitting dataset...")
-            data_df = self.new_data_df.with_columns(
-                pl.col("Use Chip").cast(pl.Categorical).to_physical()
-            ).with_columns(
-                pl.col("Merchant Name").cast(pl.String).cast(
-                    pl.Categorical).to_physical()
-            ).with_columns(
-                pl.col("Merchant City").cast(pl.Categorical).to_physical()
-            ).with_columns(
-                pl.col("Merchant State").cast(pl.Categorical).to_physical()
-            ).with_columns(
-                pl.col("Zip").cast(pl.Categorical).to_physical()
-            ).with_columns(
-                pl.col("Errors?").cast(pl.Categorical).to_physical()
-            )
+        from util import categories, tracking, velocity
+        from util.artifacts import step_key, stored_step
+        from util.incremental import load_run
+        from util.ingest import load_cached
+
+        base_run_id = self.base_run_id if self.incremental else None
+        # Incremental runs keep the features of the model they update.
+        self.use_velocity = self.velocity_features
+        if self.incremental:
+            base = load_run(current.flow_name, base_run_id).data
+            self.use_velocity = getattr(base, "use_velocity", False)
+
+        def split():
+            new_data_df = pl.concat(
+                [load_cached(path) for path in self.dataset_paths],
+                how="vertical_relaxed", rechunk=False)
+            dictionaries = None
+            if self.incremental:
+                dictionaries = base.category_dictionaries
+            dictionaries = categories.extend_dictionaries(new_data_df,
+                                                          dictionaries)
+            if self.use_velocity:
+                new_data_df = velocity.backfill(new_data_df, by_time=True)
+            data_df = categories.encode_categories(new_data_df, dictionaries)
             is_fraud = data_df.select(pl.col('Is Fraud?'))
             features = data_df.drop('Is Fraud?')
 
             original_count = len(data_df)
             training_size = int(original_count * self.train_proportion)
-            test_size = int(
-                (1 - self.train_proportion)*self.test_proportion*training_size)
-
-            train_x, rest_x, train_y, rest_y = train_test_split(features,
-                                                                is_fraud,
-                                                                train_size=training_size,
-                                                                random_state=0)
-            validate_x, test_x, validate_y, test_y  = train_test_split(rest_x,
-                                                                    rest_y,
-                                                                    train_size=test_size,
-                                                                    random_state=0)
-
-            mlflow.log_params({
-                'dataset_size': original_count,
-                'training_set_size': len(train_x),
-                'validate_set_size': len(validate_x),
-                'test_set_size': len(test_x)
-            })
+            test_size = int((1 - self.train_proportion)
+                            * self.test_proportion * training_size)
+
+            train_x, rest_x, train_y, rest_y = train_test_split(
+                features, is_fraud, train_size=training_size,
+                random_state=0)
+            validate_x, test_x, validate_y, test_y = train_test_split(
+                rest_x, rest_y, train_size=test_size, random_state=0)
+
+            frames = {
+                "train_x": train_x,
+                "train_y": train_y,
+                "validate_x": validate_x,
+                "validate_y": validate_y,
+                "test_x": test_x,
+                "test_y": test_y,
+            }
+            metadata = {
+                "category_dictionaries": dictionaries,
+                "sizes": {
+                    'dataset_size': original_count,
+                    'training_set_size': len(train_x),
+                    'validate_set_size': len(validate_x),
+                    'test_set_size': len(test_x)
+                },
+            }
+            return frames, metadata
 
-            self.train_x = train_x
-            self.train_y = train_y
-            self.validate_x = validate_x
-            self.validate_y = validate_y
-            self.test_x = test_x
-            self.test_y = test_y
-        self.next(self.model_training)
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id):
+
+            print("Splitting dataset...")
+            key = step_key(
+                [self.split_dataset, categories, velocity],
+                self.dataset_paths,
+                {"train_proportion": self.train_proportion,
+                 "test_proportion": self.test_proportion,
+                 "base_run_id": base_run_id,
+                 "velocity": self.use_velocity})
+            self.splits = stored_step(f"{self.cache_dir}/steps",
+                                      "split_dataset", key, split)
+            self.category_dictionaries = self.splits.metadata[
+                "category_dictionaries"]
+            tracking.log_params(self.splits.metadata["sizes"])
+            tracking.log_param("velocity_features", self.use_velocity)
+        self.next(self.plan_trials)
+
+    @step
+    def plan_trials(self):
+        """ Expand the search space into the trials to train in parallel.
+
+        Every trial memory-maps the same split datasets stored by the
+        previous steps, nothing is loaded or preprocessed again.
+        """
+        from metaflow import current
+
+        from util.incremental import load_run
+        from util.trials import expand_search_space
+
+        if self.incremental:
+            # The base model's hyperparameters and rebalancing are kept.
+            base = load_run(current.flow_name, self.base_run_id).data
+            self.trials = [
+                {"rebalance": base.best_trial["trial"]["rebalance"]}]
+        else:
+            self.trials = expand_search_space(self.search_space,
+                                              self.max_trials)
+        for trial in self.trials:
+            trial.setdefault("rebalance", self.rebalance)
+        print(f"Training {len(self.trials)} trial(s)...")
+        self.next(self.model_training, foreach="trials")
 
     @step
     def model_training(self):
-        """ Call our feature pipeline build function and train model. """
-        import mlflow
-        from imblearn.over_sampling import SMOTE  # noqa: E402
+        """ Call our feature pipeline build function and train model.
+
+        Each trial trains in its own nested mlflow run. The training set is
+        rebalanced with the trial's strategy, the rebalanced copy only lives
+        for the duration of the fit and is not stored as an artifact. The
+        legitimate rows ``chunked_smote`` leaves out to stay within the
+        memory budget are counted in ``majority_rows_dropped``. In
+        incremental mode the base run's model is updated with the new
+        training set instead.
+        """
+        from metaflow import current
 
         from feature_pipeline import build_pipeline
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        with mlflow.start_run(run_id=self.mlflow_run_id):
-
-            print("Training model...")
-            self.training_pipeline = build_pipeline()
-            sm = SMOTE(random_state=0)
-
-            train_x_res, train_y_res = sm.fit_resample(
-                self.train_x.to_pandas(), self.train_y.to_pandas())
-
-            self.sm = sm
-            self.train_x_res = train_x_res
-            self.train_y_res = train_y_res
-            self.training_pipeline.fit(train_x_res,
-                                       train_y_res.to_numpy().ravel())
+        from util import tracking
+        from util.incremental import (
+            encoder_statistics,
+            load_run,
+            update_pipeline,
+        )
+        from util.instrumentation import track_resources
+        from util.rebalancing import dropped_majority_rows, rebalance
+        self.trial = self.input
+        strategy = self.trial["rebalance"]
+        model_params = {key: value for key, value in self.trial.items()
+                        if key != "rebalance"}
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id), \
+                tracking.start_run(run_name=f"trial-{self.index}",
+                                   nested=True) as trial_run_id:
+            self.trial_run_id = trial_run_id
+
+            print(f"Rebalancing training set with {strategy}...")
+            train_x, train_y = (self.splits.load("train_x"),
+                                self.splits.load("train_y"))
+            # Legitimate rows chunked_smote leaves out to fit the budget.
+            self.majority_rows_dropped = (
+                dropped_majority_rows(train_x, train_y,
+                                      self.memory_budget_mb)
+                if strategy == "chunked_smote" else 0)
+            with track_resources() as rebalance_usage:
+                train_x_res, train_y_res, fit_params = rebalance(
+                    train_x, train_y, strategy,
+                    memory_budget_mb=self.memory_budget_mb,
+                    majority_ratio=self.majority_ratio)
+            del train_x, train_y
+
+            if self.incremental:
+                print(f"Updating model of run {self.base_run_id}...")
+                base = load_run(current.flow_name, self.base_run_id).data
+                self.training_pipeline = base.training_pipeline
+                with track_resources() as fit_usage:
+                    self.encoder_statistics = update_pipeline(
+                        self.training_pipeline, base.encoder_statistics,
+                        train_x_res, train_y_res, self.new_trees,
+                        self.replace_trees,
+                        fit_params.get("model__sample_weight"))
+                tracking.log_params({"new_trees": self.new_trees,
+                                     "replace_trees": self.replace_trees})
+            else:
+                print(f"Training model with {model_params}...")
+                self.training_pipeline = build_pipeline(
+                    n_jobs=self.trial_jobs, velocity=self.use_velocity,
+                    **model_params)
+                with track_resources() as fit_usage:
+                    self.training_pipeline.fit(train_x_res, train_y_res,
+                                               **fit_params)
+                self.encoder_statistics = encoder_statistics(
+                    self.training_pipeline, train_x_res, train_y_res)
+
+            tracking.log_params({
+                "rebalance": strategy,
+                "memory_budget_mb": self.memory_budget_mb,
+                "majority_ratio": self.majority_ratio,
+                "rebalanced_training_set_size": len(train_y_res),
+                "majority_rows_dropped": self.majority_rows_dropped,
+            })
+            tracking.log_metrics({
+                "rebalance_seconds": rebalance_usage["seconds"],
+                "rebalance_peak_memory_mb":
+                    rebalance_usage["peak_memory_mb"],
+                "fit_seconds": fit_usage["seconds"],
+                "fit_peak_memory_mb": fit_usage["peak_memory_mb"],
+            })
         self.next(self.model_validation)
 
     @step
     def model_validation(self):
-        """ Test our model against the train, validate and test datasets. """
-        import mlflow
-        from sklearn.metrics import (  # noqa: E402, F811
-            accuracy_score,
-            recall_score,
-        )
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        with mlflow.start_run(run_id=self.mlflow_run_id):
+        """ Evaluate our model on the untouched train, validate and test
+        datasets, and measure its serving latency and size.
+
+        Each split is scored once, in parallel chunks, with the compiled
+        pipeline. The decision threshold maximizing the F-beta score on the
+        validation split is kept with the model, and every split is
+        evaluated at that threshold and at the alert budgets.
+        """
+        from util import tracking
+        from util.compiled_pipeline import compile_pipeline
+        from util.evaluation import curve_points, evaluate, fraud_probabilities
+        from util.trials import serving_profile
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.trial_run_id):
 
             print("Validating model..")
-            validate_x_res, validate_y_res = self.sm.fit_resample(
-                self.validate_x.to_pandas(), self.validate_y.to_pandas())
-            test_x_res, test_y_res = self.sm.fit_resample(
-                self.test_x.to_pandas(), self.test_y.to_pandas())
-
-            train_pred_y = self.training_pipeline.predict(self.train_x_res)
-            validate_pred_y = self.training_pipeline.predict(validate_x_res)
-            test_pred_y = self.training_pipeline.predict(test_x_res)
-
-            train_accuracy = accuracy_score(train_pred_y,
-                                            self.train_y_res.to_numpy().ravel())
-            train_recall = recall_score(train_pred_y,
-                                        self.train_y_res.to_numpy().ravel())
-            validate_accuracy = accuracy_score(validate_pred_y,
-                                            validate_y_res.to_numpy().ravel())
-            validate_recall = recall_score(validate_pred_y,
-                                        validate_y_res.to_numpy().ravel())
-            test_accuracy = accuracy_score(test_pred_y,
-                                        test_y_res.to_numpy().ravel())
-            test_recall = recall_score(test_pred_y,
-                                       test_y_res.to_numpy().ravel())
-
-            print("Training accuracy:", train_accuracy)
-            print("Training recall:", train_recall)
-            print("Validate accuracy:", validate_accuracy)
-            print("Validate recall:", validate_recall)
-            print("Test accuracy:", test_accuracy)
-            print("Test recall:", test_recall)
-
-            metrics = {
-                'train_accuracy': train_accuracy,
-                'train_recall': train_recall,
-                'validate_accuracy': validate_accuracy,
-                'validate_recall': validate_recall,
-                'test_accuracy': test_accuracy,
-                'test_recall': test_recall,
-            }
-            mlflow.log_metrics(metrics)
+            engine = compile_pipeline(self.training_pipeline)
+            metrics = {}
+            threshold = None
+            for split in ("validate", "train", "test"):
+                split_x = self.splits.load(f"{split}_x")
+                split_y = self.splits.load(f"{split}_y")
+                scores = fraud_probabilities(engine, split_x)
+                result = evaluate(split_y.to_series().to_numpy(), scores,
+                                  threshold=threshold,
+                                  budgets=self.alert_budgets,
+                                  beta=self.threshold_beta)
+                threshold = result["threshold"]
+                for name in ("accuracy", "recall", "precision",
+                             "average_precision"):
+                    metrics[f"{split}_{name}"] = result[name]
+                for budget, at_budget in result["budgets"].items():
+                    metrics[f"{split}_recall_at_{budget:g}"] = \
+                        at_budget["recall"]
+                tracking.log_dict(curve_points(result["curve"]),
+                                  f"pr_curve_{split}.json")
+                print(f"{split.capitalize()} accuracy:",
+                      metrics[f"{split}_accuracy"])
+                print(f"{split.capitalize()} recall:",
+                      metrics[f"{split}_recall"])
+                print(f"{split.capitalize()} average precision:",
+                      metrics[f"{split}_average_precision"])
+
+            self.decision_threshold = threshold
+            metrics["decision_threshold"] = threshold
+            print("Decision threshold:", threshold)
+            metrics.update(serving_profile(
+                self.training_pipeline,
+                self.splits.load("validate_x").to_pandas()))
+            print("Serving p50 latency (ms):", metrics["serving_p50_ms"])
+            print("Model size (MB):", metrics["model_size_mb"])
+            tracking.log_metrics(metrics)
+            self.metrics = metrics
+
+        self.next(self.select_model)
 
+    @step
+    def select_model(self, inputs):
+        """ Join the trials and keep the best model.
+
+        The best model has the highest validation recall, or the fastest and
+        smallest one within ``recall-tolerance`` of it.
+        """
+        from util import tracking
+        from util.trials import select_best
+
+        self.tracking_run_id = inputs[0].tracking_run_id
+        self.ingested_partitions = inputs[0].ingested_partitions
+        self.category_dictionaries = inputs[0].category_dictionaries
+        self.splits = inputs[0].splits
+        self.use_velocity = inputs[0].use_velocity
+        self.trial_results = [
+            {"trial": branch.trial, "trial_run_id": branch.trial_run_id,
+             **branch.metrics}
+            for branch in inputs
+        ]
+        best = select_best(self.trial_results, self.recall_tolerance)
+        self.best_trial = self.trial_results[best]
+        self.training_pipeline = inputs[best].training_pipeline
+        self.encoder_statistics = inputs[best].encoder_statistics
+        self.decision_threshold = inputs[best].decision_threshold
+        print(f"Best trial: {self.best_trial['trial']}")
+
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id):
+            tracking.log_params({
+                "trial_count": len(self.trial_results),
+                "best_trial_run_id": self.best_trial["trial_run_id"],
+                **{f"best__{key}": value
+                   for key, value in self.best_trial["trial"].items()},
+            })
+            tracking.log_metrics(inputs[best].metrics)
+        self.next(self.compact_model)
+
+    @step
+    def compact_model(self):
+        """ Evaluate compaction variants of the selected forest.
+
+        Every variant, the full model first, is measured on the validation
+        split in its own nested mlflow run: size on disk, load time, serving
+        latency and recall change at the decision threshold. The smallest
+        variant within ``compaction-tolerance`` of the full model's recall is
+        the one registered. The full forest is kept as the training pipeline
+        so incremental runs keep growing it.
+        """
+        from util import tracking
+        from util.compaction import (
+            check_variants,
+            compact_pipeline,
+            measure_variant,
+            select_variant,
+            variant_name,
+        )
+
+        check_variants(self.compaction)
+        variants = [{}] + list(self.compaction)
+        validate_x = self.splits.load("validate_x")
+        validate_y = self.splits.load("validate_y")
+        pipelines = []
+        self.compaction_results = []
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id):
+            for variant in variants:
+                name = variant_name(variant)
+                print(f"Measuring {name} model...")
+                pipeline = compact_pipeline(self.training_pipeline, **variant)
+                result = measure_variant(pipeline, validate_x, validate_y,
+                                         self.decision_threshold)
+                result["recall_change"] = (
+                    result["recall"]
+                    - (self.compaction_results or [result])[0]["recall"])
+                with tracking.start_run(run_name=f"compact-{name}",
+                                        nested=True):
+                    tracking.log_params({"variant": name, **variant})
+                    tracking.log_metrics(result)
+                print(f"Compiled size (MB): {result['compiled_size_mb']:.2f},"
+                      f" recall change: {result['recall_change']:+.4f}")
+                pipelines.append(pipeline)
+                self.compaction_results.append({"variant": variant,
+                                                **result})
+
+            selected = select_variant(self.compaction_results,
+                                      self.compaction_tolerance)
+            self.compaction_variant = variants[selected]
+            self.compacted_pipeline = (pipelines[selected] if selected
+                                       else None)
+            print(f"Selected {variant_name(self.compaction_variant)} model")
+            tracking.log_param("compaction",
+                               variant_name(self.compaction_variant))
+            tracking.log_metrics({
+                f"compacted_{key}": value for key, value
+                in self.compaction_results[selected].items()
+                if key != "variant"})
         self.next(self.register_model)
 
     @step
     def register_model(self):
-        """ Register model into mlflow. """
-        import mlflow
-        mlflow.set_tracking_uri("http://127.0.0.1:5000")
-        with mlflow.start_run(run_id=self.mlflow_run_id):
+        """ Register model into mlflow, once the tracking calls are sent.
+
+        The registered pipeline starts with the category dictionaries, so
+        it scores raw transactions with the codes it was trained on, and
+        carries the decision threshold picked during validation. The
+        compaction variant selected is registered in place of the full
+        forest. The pipeline also carries a profile of the validation
+        split's features and fraud probabilities, the baseline the service
+        compares its traffic with.
+        """
+        from util import tracking
+        from util.categories import CODES_STEP, inference_pipeline
+        from util.compiled_pipeline import (
+            PRECISION_ATTRIBUTE,
+            compile_pipeline,
+        )
+        from util.drift import PROFILE_ATTRIBUTE, PROFILE_FILE, TrafficProfile
+        from util.evaluation import THRESHOLD_ATTRIBUTE, fraud_probabilities
+        tracking.configure(f"{self.cache_dir}/tracking", self.tracking_uri,
+                           self.tracking_offline)
+        with tracking.start_run(run_id=self.tracking_run_id):
             print("Registering model...")
-            mlflow.sklearn.log_model(self.training_pipeline,
-                                     "fraud-detection-model")
-            mlflow.register_model(
-                f"runs:/{self.mlflow_run_id}/fraud-detection-model",
-                "fraud-detection-model"
-            )
+            selected = self.compacted_pipeline or self.training_pipeline
+            pipeline = inference_pipeline(selected,
+                                          self.category_dictionaries)
+            if hasattr(selected, PRECISION_ATTRIBUTE):
+                setattr(pipeline, PRECISION_ATTRIBUTE,
+                        getattr(selected, PRECISION_ATTRIBUTE))
+            tracking.log_dict(pipeline.named_steps[CODES_STEP].to_dict(),
+                              "category_dictionaries.json")
+            setattr(pipeline, THRESHOLD_ATTRIBUTE, self.decision_threshold)
+            tracking.log_param("decision_threshold", self.decision_threshold)
+            validate_x = self.splits.load("validate_x")
+            baseline = TrafficProfile()
+            baseline.update(
+                validate_x,
+                fraud_probabilities(compile_pipeline(selected), validate_x),
+                dictionaries=self.category_dictionaries)
+            setattr(pipeline, PROFILE_ATTRIBUTE, baseline.to_dict())
+            tracking.log_dict(baseline.to_dict(), PROFILE_FILE)
+            tracking.log_model(pipeline, "fraud-detection-model")
+            tracking.register_model("fraud-detection-model",
+                                    "fraud-detection-model")
         self.next(self.end)
 
     @step
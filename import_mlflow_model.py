@@ -1,15 +1,41 @@
 """ Download the model from mlflow registry to use it in bentoml. """
 
+import argparse
+import json
+
 import bentoml
 import mlflow
 
+from service.model_versions import COMPILED_MODEL_DIR
+from util.compiled_pipeline import compile_pipeline
+from util.drift import PROFILE_ATTRIBUTE, PROFILE_FILE
+
 mlflow.set_tracking_uri("http://127.0.0.1:5000/")
 
 model_name = "fraud-detection-model"
-model_version = 1
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument("--version", type=int, default=None,
+                    help="registered version to import, the latest one "
+                         "by default")
+model_version = parser.parse_args().version
+if model_version is None:
+    model_version = max(
+        int(version.version) for version in
+        mlflow.MlflowClient().search_model_versions(f"name='{model_name}'"))
 model_mlflow_uri = f"models:/{model_name}/{model_version}"
 
 sklearn_model = mlflow.sklearn.load_model(model_uri=model_mlflow_uri)
 
 bento_model = bentoml.sklearn.save_model(name=f"{model_name}:{model_version}",
                                          model=sklearn_model)
+
+# Ship the memory-mappable compiled engine alongside the sklearn pipeline.
+compile_pipeline(sklearn_model).save(bento_model.path_of(COMPILED_MODEL_DIR))
+
+# The training traffic profile the service compares its traffic with.
+profile = getattr(sklearn_model, PROFILE_ATTRIBUTE, None)
+if profile is not None:
+    with open(bento_model.path_of(PROFILE_FILE), "w",
+              encoding="utf-8") as file:
+        json.dump(profile, file)
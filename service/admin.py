@@ -0,0 +1,26 @@
+""" Access control of the service's admin endpoints.
+
+Swapping or shadowing model versions and reading their status are opt-in:
+the endpoints answer 404 unless an admin token is configured, and 401 to
+requests that do not send it as ``Authorization: Bearer <token>``.
+"""
+import hmac
+from http import HTTPStatus
+
+from bentoml.exceptions import BentoMLException, NotFound
+
+# Environment variable holding the admin token.
+ADMIN_SETTING = "FRAUD_DETECTION_ADMIN_TOKEN"
+
+
+def check_admin(headers, token):
+    """ Raise unless admin endpoints are enabled by ``token`` and a request
+    with ``headers`` carries it.
+    """
+    if not token:
+        message = f"Admin endpoints are disabled, set {ADMIN_SETTING}"
+        raise NotFound(message)
+    supplied = headers.get("authorization", "").encode()
+    if not hmac.compare_digest(supplied, f"Bearer {token}".encode()):
+        message = "Admin endpoints need the admin token as a bearer token"
+        raise BentoMLException(message, error_code=HTTPStatus.UNAUTHORIZED)
@@ -0,0 +1,50 @@
+""" Arrow IPC and Parquet payloads for the fraud detection service. """
+
+import io
+
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+ARROW_MIME_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MIME_TYPE = "application/vnd.apache.parquet"
+PARQUET_MAGIC = b"PAR1"
+REQUEST_ID_COLUMN = "request_id"
+
+
+def is_parquet(payload: bytes) -> bool:
+    """ Tell Parquet files from Arrow IPC streams by their magic bytes. """
+    return payload[:4] == PARQUET_MAGIC
+
+
+def read_table(payload: bytes) -> pa.Table:
+    """ Read an Arrow IPC stream or a Parquet file without copying the
+    column buffers out of the payload where the format allows it.
+    """
+    if is_parquet(payload):
+        return pq.read_table(pa.BufferReader(payload))
+    return ipc.open_stream(pa.py_buffer(payload)).read_all()
+
+
+def write_table(table: pa.Table, parquet: bool = False) -> bytes:
+    """ Serialize a table as an Arrow IPC stream or a Parquet file. """
+    if parquet:
+        sink = io.BytesIO()
+        pq.write_table(table, sink)
+        return sink.getvalue()
+    sink = pa.BufferOutputStream()
+    with ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def probability_table(request: pa.Table, fraud_proba) -> pa.Table:
+    """ Build the response table: the probability columns, preceded by the
+    request id column when the request has one.
+    """
+    columns = {}
+    if REQUEST_ID_COLUMN in request.column_names:
+        columns[REQUEST_ID_COLUMN] = request[REQUEST_ID_COLUMN]
+    columns["is_fraud_proba"] = pa.array(fraud_proba)
+    columns["is_legit_proba"] = pa.array(1 - fraud_proba)
+    return pa.table(columns)
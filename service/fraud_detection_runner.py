@@ -1,24 +1,492 @@
 """ Create our own bentoml runner for our fraud detection model. """
 
+import os
+import socket
+import threading
+import time
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+
 import bentoml
+import numpy as np
 import pandas as pd
 
+from service.model_versions import LoadedModel, ShadowStats
+from service.prediction_cache import PredictionCache, row_keys
+from util.drift import PROBABILITY_COLUMN, TrafficProfile
+from util.instrumentation import (
+    STAGE_BUCKETS,
+    PrometheusStages,
+    timed,
+    timed_predict_proba,
+)
+from util.velocity import VelocityStore
+
+# Shadow batches waiting for or being scored by the candidate. Batches
+# arriving while the candidate is this far behind are dropped.
+SHADOW_BACKLOG = 4
+# Batches waiting for or being added to the traffic profile. Batches
+# arriving while the profile is this far behind are left out of it.
+PROFILE_BACKLOG = 8
+# Model generations kept after a swap, for Arrow requests whose features
+# were transformed by the API server just before it.
+KEPT_GENERATIONS = 2
+# Per-stage latency histograms, exposed on the service's /metrics endpoint.
+# Only the FRAUD_DETECTION_METRICS_SAMPLE_RATE share of calls is timed.
+STAGE_METRICS = PrometheusStages(
+    bentoml.metrics.Histogram(
+        name="fraud_detection_stage_duration_seconds",
+        documentation="Duration of each scoring stage by batch size",
+        labelnames=["stage", "batch_size"],
+        buckets=STAGE_BUCKETS,
+    ),
+    sample_rate=float(
+        os.environ.get("FRAUD_DETECTION_METRICS_SAMPLE_RATE", "1.0")),
+)
+# Prediction cache hits and misses, counted per transaction.
+CACHE_LOOKUPS = bentoml.metrics.Counter(
+    name="fraud_detection_cache_lookups",
+    documentation="Transactions looked up in the prediction cache",
+    labelnames=["result"],
+)
+CACHE_ENTRIES = bentoml.metrics.Gauge(
+    name="fraud_detection_cache_entries",
+    documentation="Fraud probabilities held in the prediction cache",
+)
+# Active model swaps and how the shadow candidate compares with the active
+# model on the same batches.
+MODEL_SWAPS = bentoml.metrics.Counter(
+    name="fraud_detection_model_swaps",
+    documentation="Model versions swapped in as the active model",
+    labelnames=["model"],
+)
+SHADOW_BATCHES = bentoml.metrics.Counter(
+    name="fraud_detection_shadow_batches",
+    documentation="Batches sent to the shadow candidate by outcome",
+    labelnames=["candidate", "result"],
+)
+SHADOW_DECISIONS = bentoml.metrics.Counter(
+    name="fraud_detection_shadow_decisions",
+    documentation="Transactions the candidate and active models decide on "
+                  "alike or not",
+    labelnames=["candidate", "result"],
+)
+SHADOW_DIVERGENCE = bentoml.metrics.Histogram(
+    name="fraud_detection_shadow_divergence",
+    documentation="Absolute difference between the candidate and active "
+                  "fraud probabilities of a transaction",
+    labelnames=["candidate"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.2, 0.5, 1.0),
+)
+# Drift of the served traffic from the active model's training data.
+DRIFT_PSI = bentoml.metrics.Gauge(
+    name="fraud_detection_drift_psi",
+    documentation="Population stability index of served traffic against "
+                  "the active model's training data, by feature",
+    labelnames=["feature"],
+)
+PROFILE_BATCHES = bentoml.metrics.Counter(
+    name="fraud_detection_profile_batches",
+    documentation="Batches added to or left out of the traffic profile",
+    labelnames=["result"],
+)
+SHADOW_DURATION = bentoml.metrics.Histogram(
+    name="fraud_detection_shadow_duration_seconds",
+    documentation="Scoring time of the same batches by the active and "
+                  "candidate models",
+    labelnames=["candidate", "role"],
+    buckets=STAGE_BUCKETS,
+)
+
 
 class FraudDetectionModelRunner(bentoml.Runnable):
     """ Define our runner's class properties and is_fraud method. """
     SUPPORTED_RESOURCES = ("cpu")
     SUPPORTS_CPU_MULTI_THREADING = True
 
-    def __init__(self, model: bentoml.Model) -> None:
-        self.classifier = bentoml.sklearn.load_model(model)
+    def __init__(self, model: bentoml.Model, compiled: bool = True,
+                 cache_size: int = 0, cache_ttl: float = 300.0,
+                 velocity_snapshot: str = "",
+                 snapshot_interval: float = 60.0,
+                 shadow_tag: str = "", profile_dir: str = "",
+                 profile_interval: float = 60.0) -> None:
+        self.compiled = compiled
+        # Each batch reads the active model once, so a swap is a single
+        # assignment and never splits a batch between two versions.
+        self.active = LoadedModel(model, compiled)
+        self.models = {self.active.generation: self.active}
+        self.swap_lock = threading.Lock()
+        self.last_batch = None
+        self.cache = None
+        if cache_size > 0:
+            # Entries are keyed on the model version, so a swap needs no
+            # invalidation.
+            self.cache = PredictionCache(cache_size, cache_ttl)
+        # Per-card history of the velocity features, created when a model
+        # reads them, warm started from and periodically saved to a snapshot
+        # on its own thread, off the request path.
+        self.velocity = None
+        self.velocity_snapshot = velocity_snapshot
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="velocity")
+        self.snapshot_slots = threading.BoundedSemaphore(1)
+        self.ensure_velocity(self.active)
+        # The shadow candidate scores copies of the active model's batches
+        # on its own thread, off the request path.
+        self.shadow = None
+        self.shadow_stats = None
+        self.shadow_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="shadow")
+        self.shadow_slots = threading.BoundedSemaphore(SHADOW_BACKLOG)
+        if shadow_tag:
+            self.set_shadow(shadow_tag)
+        # Sketches of the traffic scored by the active model, updated on
+        # their own thread and saved every profile_interval seconds to
+        # profile_dir, one file per process, to merge and compare with the
+        # model's training data.
+        self.profile = TrafficProfile()
+        self.profile_dir = profile_dir
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+        self.profile_interval = profile_interval
+        self.profile_saved_at = time.monotonic()
+        self.profile_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="profile")
+        self.profile_slots = threading.BoundedSemaphore(PROFILE_BACKLOG)
+
+    def ensure_velocity(self, model):
+        """ Create the card histories the first time a model reads the
+        velocity features.
+        """
+        if self.velocity is not None or not model.uses_velocity:
+            return
+        self.snapshot_at = time.monotonic()
+        if self.velocity_snapshot and os.path.exists(self.velocity_snapshot):
+            self.velocity = VelocityStore.restore(self.velocity_snapshot)
+        else:
+            self.velocity = VelocityStore()
+
+    def load(self, tag, generation):
+        """ Load and warm up a model version away from the active one. """
+        model = LoadedModel(bentoml.models.get(tag), self.compiled,
+                            generation)
+        model.warm_up(self.last_batch)
+        self.ensure_velocity(model)
+        return model
+
+    @bentoml.Runnable.method(batchable=False)
+    def swap_model(self, tag: str) -> dict:
+        """ Load a model version, warm it up and make it the active model.
+
+        Batches being scored finish with the previous version and the next
+        ones start with the new one, so no request is dropped. Swapping to
+        the active version does nothing.
+        """
+        with self.swap_lock:
+            tag = str(bentoml.models.get(tag).tag)
+            if tag != self.active.tag:
+                model = self.load(tag, self.active.generation + 1)
+                self.models[model.generation] = model
+                for generation in list(self.models):
+                    if generation <= model.generation - KEPT_GENERATIONS:
+                        del self.models[generation]
+                self.active = model
+                self.profile = TrafficProfile()
+                MODEL_SWAPS.labels(model=tag).inc()
+                if self.shadow is not None:
+                    self.shadow_stats = ShadowStats(self.shadow.tag, tag)
+        return self.status()
+
+    @bentoml.Runnable.method(batchable=False)
+    def set_shadow(self, tag: str) -> dict:
+        """ Score every batch with a candidate model version in shadow, or
+        stop when the tag is empty.
+        """
+        with self.swap_lock:
+            if not tag:
+                self.shadow = self.shadow_stats = None
+            else:
+                tag = str(bentoml.models.get(tag).tag)
+                if self.shadow is None or tag != self.shadow.tag:
+                    shadow = self.load(tag, generation=-1)
+                    self.shadow_stats = ShadowStats(tag, self.active.tag)
+                    self.shadow = shadow
+        return self.status()
+
+    @bentoml.Runnable.method(batchable=False)
+    def model_status(self) -> dict:
+        """ Return the active model and the shadow comparison so far. """
+        return self.status()
+
+    @bentoml.Runnable.method(batchable=False)
+    def traffic_report(self) -> dict:
+        """ Return how far the traffic scored by the active model drifted
+        from its training data.
+        """
+        return self.drift_report()
+
+    def drift_report(self):
+        """ Compare the traffic profile with the active model's baseline and
+        export the PSI of every feature.
+        """
+        model, profile = self.active, self.profile
+        report = {"model": model.tag, "drift": None}
+        if model.baseline is not None:
+            report["drift"] = profile.compare(model.baseline)
+            drifts = {**report["drift"]["features"],
+                      PROBABILITY_COLUMN: report["drift"][PROBABILITY_COLUMN]}
+            for feature, drift in drifts.items():
+                if drift["psi"] is not None:
+                    DRIFT_PSI.labels(feature=feature).set(drift["psi"])
+        return report
+
+    def status(self):
+        """ Describe the active model and the shadow candidate. """
+        shadow_stats = self.shadow_stats
+        return {
+            "active": self.active.tag,
+            "generation": self.active.generation,
+            "shadow": (shadow_stats.summary() if shadow_stats is not None
+                       else None),
+        }
 
-    @bentoml.Runnable.method()
+    @bentoml.Runnable.method(batchable=True, batch_dim=0)
     def is_fraud(self, input_data: pd.DataFrame) -> pd.DataFrame:
-        """ Get predicted values for input dataset. """
-        result = input_data
-        predict_probas = self.classifier.predict_proba(input_data)
-        negative_proba = predict_probas[:, 1]
-        positive_proba = predict_probas[:, 0]
-        result["is_fraud_proba"] = negative_proba
-        result["is_legit_proba"] = positive_proba
+        """ Get predicted values for input dataset.
+
+        The method is batchable, so the runner's dispatcher merges the
+        DataFrames of concurrent requests along the rows, scores them in a
+        single predict_proba call and splits the result back per caller.
+        """
+        recorder = STAGE_METRICS.sample()
+        batch_size = len(input_data)
+        model, shadow = self.active, self.shadow
+        with timed(recorder, "is_fraud", batch_size):
+            self.last_batch = input_data
+            if self.cache is None:
+                data = input_data
+                if self.velocity is not None:
+                    with timed(recorder, "velocity", batch_size):
+                        data = self.with_velocity(model, input_data)
+                start = time.perf_counter()
+                negative_proba = timed_predict_proba(
+                    model.classifier, data, batch_size, recorder)[:, 1]
+                data_proba = negative_proba
+            else:
+                start = time.perf_counter()
+                negative_proba, data, data_proba = self.cached_fraud_proba(
+                    model, input_data, recorder)
+            if len(data_proba):
+                if shadow is not None:
+                    self.shadow_score(shadow, model, data, data_proba,
+                                      time.perf_counter() - start)
+                with timed(recorder, "profile", batch_size):
+                    self.profile_traffic(data, data_proba)
+            with timed(recorder, "response", batch_size):
+                # A copy, the caller's DataFrame is left untouched.
+                result = input_data.assign(
+                    is_fraud_proba=negative_proba,
+                    is_legit_proba=1 - negative_proba,
+                    is_fraud=model.flag_fraud(negative_proba))
         return result
+
+    def with_velocity(self, model, input_data):
+        """ Add a batch to the card histories and return its columns with
+        the velocity features. The compiled engine reads them through a
+        mapping, sparing a copy of the DataFrame.
+        """
+        velocity = self.velocity.features(input_data)
+        if (self.velocity_snapshot and time.monotonic() - self.snapshot_at
+                >= self.snapshot_interval):
+            self.snapshot_at = time.monotonic()
+            self.queue_snapshot()
+        if model.compiled:
+            return ChainMap(velocity, input_data)
+        return input_data.assign(**velocity)
+
+    def queue_snapshot(self):
+        """ Queue a snapshot of the card histories, or skip it while the
+        previous one is still being written, never blocking the request.
+        """
+        if not self.snapshot_slots.acquire(blocking=False):
+            return
+        try:
+            self.snapshot_executor.submit(self.save_snapshot)
+        except RuntimeError:
+            self.snapshot_slots.release()
+
+    def save_snapshot(self):
+        """ Save the card histories to the snapshot file. """
+        try:
+            self.velocity.snapshot(self.velocity_snapshot)
+        except Exception as error:  # noqa: BLE001
+            # The next interval tries again.
+            print(f"Velocity snapshot failed: {error}")
+        finally:
+            self.snapshot_slots.release()
+
+    def cached_fraud_proba(self, model, input_data, recorder=None):
+        """ Return fraud probabilities from the prediction cache, scoring
+        only the transactions it misses, each distinct one once, with the
+        rows to profile and their probabilities.
+
+        Only the transactions scored are added to the card histories, so a
+        retry is neither counted twice nor missed by the cache. For models
+        reading velocity features, the rows to profile are those scored, as
+        the features of the others are not computed again.
+        """
+        batch_size = len(input_data)
+        with timed(recorder, "cache_lookup", batch_size):
+            keys = row_keys(model.cache_columns, input_data, model.tag)
+            fraud_proba, missing = self.cache.lookup(keys)
+        missing_rows = np.flatnonzero(missing)
+        # Retries in the same batch are scored once.
+        distinct = {}
+        for row in missing_rows.tolist():
+            distinct.setdefault(keys[row], row)
+        rows = np.fromiter(distinct.values(), dtype=np.int64)
+        missed = input_data.iloc[rows]
+        fresh = fraud_proba[:0]
+        if len(rows):
+            if self.velocity is not None:
+                with timed(recorder, "velocity", len(rows)):
+                    missed = self.with_velocity(model, missed)
+            fresh = timed_predict_proba(model.classifier, missed,
+                                        len(rows), recorder)[:, 1]
+            positions = {key: idx for idx, key in enumerate(distinct)}
+            fraud_proba[missing_rows] = fresh[
+                [positions[keys[row]] for row in missing_rows.tolist()]]
+            self.cache.store(list(distinct), fresh)
+        CACHE_LOOKUPS.labels(result="hit").inc(batch_size - len(missing_rows))
+        CACHE_LOOKUPS.labels(result="miss").inc(len(missing_rows))
+        CACHE_ENTRIES.set(len(self.cache))
+        if self.velocity is not None:
+            return fraud_proba, missed, fresh
+        return fraud_proba, input_data, fraud_proba
+
+    def shadow_score(self, shadow, model, data, active_proba,
+                     active_seconds):
+        """ Queue a batch for the shadow candidate, or drop it when the
+        candidate is too far behind, never blocking the request.
+        """
+        stats = self.shadow_stats
+        if stats is None or stats.active != model.tag:
+            # Shadow scoring was stopped or the active model swapped since
+            # the batch started.
+            return
+        if not self.shadow_slots.acquire(blocking=False):
+            stats.skip("dropped")
+            SHADOW_BATCHES.labels(candidate=shadow.tag, result="dropped").inc()
+            return
+        # The columns are referenced, not copied, and the request only
+        # adds new ones, so the candidate sees the batch as scored.
+        columns = {column: np.asarray(data[column])
+                   for column in shadow.input_columns}
+        try:
+            self.shadow_executor.submit(
+                self.compare_shadow, shadow, model, stats, columns,
+                active_proba, active_seconds)
+        except RuntimeError:
+            self.shadow_slots.release()
+
+    def profile_traffic(self, data, fraud_proba):
+        """ Queue a scored batch for the traffic profile, or leave it out
+        when the profile is too far behind, never blocking the request.
+        """
+        if not self.profile_slots.acquire(blocking=False):
+            PROFILE_BATCHES.labels(result="dropped").inc()
+            return
+        profile = self.profile
+        columns = {column: np.asarray(data[column])
+                   for column in profile.columns if column in data}
+        try:
+            self.profile_executor.submit(self.update_profile, profile,
+                                         columns, fraud_proba)
+        except RuntimeError:
+            self.profile_slots.release()
+
+    def update_profile(self, profile, columns, fraud_proba):
+        """ Add a batch to the traffic profile and periodically save it. """
+        try:
+            try:
+                profile.update(columns, fraud_proba)
+            except Exception:  # noqa: BLE001
+                PROFILE_BATCHES.labels(result="failed").inc()
+                return
+            PROFILE_BATCHES.labels(result="profiled").inc()
+            if (self.profile_dir and time.monotonic() - self.profile_saved_at
+                    >= self.profile_interval):
+                self.profile_saved_at = time.monotonic()
+                profile.save(os.path.join(
+                    self.profile_dir,
+                    f"{socket.gethostname()}-{os.getpid()}.json"))
+                self.drift_report()
+        finally:
+            self.profile_slots.release()
+
+    def compare_shadow(self, shadow, model, stats, columns, active_proba,
+                       active_seconds):
+        """ Score a batch with the shadow candidate and record how its
+        probabilities, decisions and latency compare with the active model.
+        """
+        try:
+            start = time.perf_counter()
+            candidate_proba = shadow.fraud_proba(columns)
+            candidate_seconds = time.perf_counter() - start
+        except Exception:  # noqa: BLE001
+            stats.skip("failed")
+            SHADOW_BATCHES.labels(candidate=shadow.tag, result="failed").inc()
+            return
+        finally:
+            self.shadow_slots.release()
+        divergence = np.abs(candidate_proba - active_proba)
+        disagreements = int(np.count_nonzero(
+            shadow.flag_fraud(candidate_proba)
+            != model.flag_fraud(active_proba)))
+        stats.record(divergence, disagreements, active_seconds,
+                     candidate_seconds)
+        SHADOW_BATCHES.labels(candidate=shadow.tag, result="scored").inc()
+        SHADOW_DECISIONS.labels(candidate=shadow.tag,
+                                result="disagree").inc(disagreements)
+        SHADOW_DECISIONS.labels(candidate=shadow.tag, result="agree").inc(
+            len(divergence) - disagreements)
+        histogram = SHADOW_DIVERGENCE.labels(candidate=shadow.tag)
+        for value in divergence.tolist():
+            histogram.observe(value)
+        SHADOW_DURATION.labels(candidate=shadow.tag,
+                               role="active").observe(active_seconds)
+        SHADOW_DURATION.labels(candidate=shadow.tag,
+                               role="candidate").observe(candidate_seconds)
+
+    @bentoml.Runnable.method(batchable=True, batch_dim=0)
+    def fraud_proba(self, features: np.ndarray) -> np.ndarray:
+        """ Get the fraud probability for an already transformed feature
+        matrix, skipping any DataFrame handling.
+
+        The last column holds the generation of the model whose feature
+        engine transformed each row, so rows transformed just before a swap
+        are still scored by the matching model. Rows of a generation no
+        longer kept get a NaN probability. The second column returned holds
+        the generation of the active model, so API workers that did not see
+        a swap find out, switch engines and transform the rows again.
+        """
+        recorder = STAGE_METRICS.sample()
+        with timed(recorder, "forest", len(features)):
+            active_generation = self.active.generation
+            generations = features[:, -1]
+            features = features[:, :-1]
+            fraud_proba = np.full(len(features), np.nan)
+            if len(features) and generations.min() == generations.max():
+                model = self.models.get(int(generations[0]))
+                if model is not None:
+                    fraud_proba = model.score_features(features)
+            else:
+                for generation in np.unique(generations).tolist():
+                    rows = generations == generation
+                    model = self.models.get(int(generation))
+                    if model is not None:
+                        fraud_proba[rows] = model.score_features(
+                            features[rows])
+            return np.column_stack(
+                [fraud_proba, np.full(len(features), active_generation)])
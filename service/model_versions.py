@@ -0,0 +1,180 @@
+""" Model versions the service can switch between while it is running.
+
+A ``LoadedModel`` bundles a bento model version with everything scoring it
+takes: its classifier, compiled or not, its decision threshold and the input
+columns it reads. The runner holds the active one in a single attribute, so
+a new version is loaded and warmed up in the background and swapped in with
+one assignment: every batch reads the attribute once and is scored start to
+finish by the version it found there.
+
+Each swap starts a new generation. The Arrow endpoint transforms features in
+the API server and tags the matrix with the generation of the engine it
+used, so the runner scores it with the matching version even while a swap
+is in progress.
+
+A candidate version can also score the batches of the active one in shadow,
+on a background thread, to compare its probabilities, decisions and latency
+before it is promoted. ``ShadowStats`` keeps those comparisons.
+"""
+import os
+import threading
+
+import bentoml
+import numpy as np
+import pandas as pd
+
+from service.prediction_cache import key_columns
+from util.compiled_pipeline import (
+    FOREST_ARRAYS,
+    CompiledPipeline,
+    compile_pipeline,
+)
+from util.drift import PROFILE_FILE, TrafficProfile
+from util.evaluation import decision_threshold, flag_fraud
+from util.velocity import VELOCITY_COLUMNS
+
+# Directory inside the bento model holding the memory-mappable engine.
+COMPILED_MODEL_DIR = "compiled_pipeline"
+# Rows of a recent batch scored to warm up a new version.
+WARMUP_ROWS = 64
+
+
+def load_engine(model, pipeline=None):
+    """ Return the compiled engine of a bento model, memory-mapped when it
+    ships one, compiled from its pipeline otherwise, ``pipeline`` when it
+    was already loaded.
+    """
+    compiled_path = model.path_of(COMPILED_MODEL_DIR)
+    if os.path.isdir(compiled_path):
+        return CompiledPipeline.load(compiled_path)
+    if pipeline is None:
+        pipeline = bentoml.sklearn.load_model(model)
+    return compile_pipeline(pipeline)
+
+
+class LoadedModel:
+    """ A bento model version ready to score. """
+
+    def __init__(self, model, compiled=True, generation=0):
+        self.tag = str(model.tag)
+        self.generation = generation
+        pipeline = None if compiled else bentoml.sklearn.load_model(model)
+        engine = load_engine(model, pipeline)
+        # Memory-mapped, so all workers share one copy of the trees.
+        self.classifier = engine if compiled else pipeline
+        self.engine = engine
+        # Tuned on the validation split when the model was trained.
+        self.decision_threshold = decision_threshold(self.classifier)
+        self.input_columns = key_columns(engine)
+        # Retries are matched on the columns of the request: the velocity
+        # features derived from them change as the card's history grows.
+        self.cache_columns = {
+            column: coded for column, coded in self.input_columns.items()
+            if column not in VELOCITY_COLUMNS}
+        self.uses_velocity = bool(
+            set(VELOCITY_COLUMNS) & set(engine.feature_columns))
+        # Profile of the training data traffic is compared with, saved with
+        # models registered by recent flows.
+        profile_path = model.path_of(PROFILE_FILE)
+        self.baseline = (TrafficProfile.load(profile_path)
+                         if os.path.exists(profile_path) else None)
+
+    @property
+    def compiled(self):
+        """ Whether the classifier is the compiled engine. """
+        return isinstance(self.classifier, CompiledPipeline)
+
+    def fraud_proba(self, data):
+        """ Return the fraud probabilities of a DataFrame or a mapping of
+        the input columns.
+        """
+        if not self.compiled and not isinstance(data, pd.DataFrame):
+            data = pd.DataFrame(
+                {column: data[column] for column in self.input_columns})
+        return self.classifier.predict_proba(data)[:, 1]
+
+    def flag_fraud(self, fraud_proba):
+        """ Return which fraud probabilities the model flags as fraud. """
+        return flag_fraud(self.classifier, fraud_proba)
+
+    def score_features(self, features):
+        """ Return the fraud probabilities of a transformed feature matrix. """
+        if self.compiled:
+            return self.classifier.score_features(features)[:, 1]
+        return self.classifier.named_steps["model"].predict_proba(
+            features)[:, 1]
+
+    def warm_up(self, data=None):
+        """ Page in the memory-mapped trees and score a few rows of a recent
+        batch, so the first requests after a swap are not slowed down.
+        """
+        for name in FOREST_ARRAYS:
+            np.asarray(getattr(self.engine, name)).sum()
+        if data is None or not len(data):
+            return
+        sample = data.head(WARMUP_ROWS)
+        missing = [column for column in VELOCITY_COLUMNS
+                   if column not in sample]
+        if self.uses_velocity and missing:
+            sample = sample.assign(**dict.fromkeys(missing, 0))
+        self.fraud_proba(sample)
+
+
+class ShadowStats:
+    """ Running comparison of a shadow candidate with the active model. """
+
+    def __init__(self, candidate, active):
+        self.candidate = candidate
+        self.active = active
+        self.batches = 0
+        self.dropped = 0
+        self.failed = 0
+        self.transactions = 0
+        self.disagreements = 0
+        self.divergence_sum = 0.0
+        self.divergence_max = 0.0
+        self.active_seconds = 0.0
+        self.candidate_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, divergence, disagreements, active_seconds,
+               candidate_seconds):
+        """ Add a scored batch: the absolute probability differences of its
+        transactions, how many decisions differ and both scoring times.
+        """
+        with self._lock:
+            self.batches += 1
+            self.transactions += len(divergence)
+            self.disagreements += disagreements
+            self.divergence_sum += float(divergence.sum())
+            if len(divergence):
+                self.divergence_max = max(self.divergence_max,
+                                          float(divergence.max()))
+            self.active_seconds += active_seconds
+            self.candidate_seconds += candidate_seconds
+
+    def skip(self, outcome):
+        """ Count a batch the candidate did not score, by its outcome. """
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def summary(self):
+        """ Return the comparison so far as a JSON-serializable dict. """
+        with self._lock:
+            batches = max(self.batches, 1)
+            transactions = max(self.transactions, 1)
+            return {
+                "candidate": self.candidate,
+                "active": self.active,
+                "batches": self.batches,
+                "dropped_batches": self.dropped,
+                "failed_batches": self.failed,
+                "transactions": self.transactions,
+                "decision_disagreement_rate":
+                    self.disagreements / transactions,
+                "mean_divergence": self.divergence_sum / transactions,
+                "max_divergence": self.divergence_max,
+                "active_mean_ms": self.active_seconds / batches * 1_000,
+                "candidate_mean_ms":
+                    self.candidate_seconds / batches * 1_000,
+            }
@@ -0,0 +1,121 @@
+""" In-process cache of fraud probabilities for retried transactions.
+
+Payment gateways retry and upstream systems resend the same transaction, so
+the runner keeps recent fraud probabilities keyed on the model version and
+the values of the columns the model actually reads, written canonically so
+that representations the model scores alike (a Zip of 94107, 94107.0 or
+"94107.0") share a key. Keys are tuples hashed by the cache's dict and
+compared exactly, so a hash collision never returns the probability of
+another transaction. Entries are evicted least recently used first once the
+cache is full, and expire after a TTL.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from util.categories import canonical_strings
+from util.compiled_pipeline import CODES
+
+
+def key_columns(engine):
+    """ Return the input columns a compiled engine reads, each with whether
+    the model reads it as a dictionary coded category.
+    """
+    columns = {}
+    for kind, column, _ in engine.features:
+        columns.setdefault(column, kind == CODES)
+    return columns
+
+
+def _canonical_codes(values):
+    """ Return a dictionary coded column as the strings its codes are looked
+    up with, see ``util.categories.canonical_strings``.
+    """
+    if values.dtype.kind in "iu":
+        return list(map(str, values.tolist()))
+    if values.dtype == object and all(
+            value is None or isinstance(value, str) for value in values):
+        return [
+            value[:-2] if value is not None and value.endswith(".0")
+            and value[:-2].lstrip("-").isdigit() else value
+            for value in values.tolist()
+        ]
+    strings, missing = canonical_strings(values)
+    return np.where(missing, None, strings.astype(object)).tolist()
+
+
+def _canonical_numbers(values):
+    """ Return a numeric column as python numbers, missing values as None.
+    Equal ints and floats are equal keys.
+    """
+    if values.dtype.kind == "f":
+        return np.where(np.isnan(values), None, values.astype(object)
+                        ).tolist()
+    return values.tolist()
+
+
+def row_keys(columns, data, model_version):
+    """ Return the cache key of every row of a DataFrame: the model version
+    and the canonical values of the key columns from ``key_columns``.
+    """
+    canonical = [
+        (_canonical_codes if coded else _canonical_numbers)(
+            np.asarray(data[column]))
+        for column, coded in columns.items()
+    ]
+    return [(model_version, *values) for values in zip(*canonical)]
+
+
+class PredictionCache:
+    """ Size-bounded LRU cache of fraud probabilities with a TTL. """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """ Number of entries held, expired ones included. """
+        return len(self._entries)
+
+    def lookup(self, keys):
+        """ Return the cached probabilities of ``keys``, NaN where missing,
+        and the mask of the missing ones.
+        """
+        probabilities = np.full(len(keys), np.nan)
+        now = time.monotonic()
+        with self._lock:
+            for idx, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires_at, probability = entry
+                if expires_at <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                probabilities[idx] = probability
+            missing = np.isnan(probabilities)
+            misses = int(np.count_nonzero(missing))
+            self.misses += misses
+            self.hits += len(keys) - misses
+        return probabilities, missing
+
+    def store(self, keys, probabilities):
+        """ Cache freshly scored probabilities, evicting the least recently
+        used entries beyond ``max_entries``.
+        """
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            for key, probability in zip(keys, probabilities.tolist()):
+                self._entries[key] = (expires_at, probability)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
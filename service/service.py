@@ -1,20 +1,95 @@
 """ Use model to generate predictions through an API. """
 
+import asyncio
+import os
+import threading
+import time
+
 import bentoml
-from bentoml.io import PandasDataFrame
-from fraud_detection_runner import FraudDetectionModelRunner
+import numpy as np
+from bentoml.exceptions import InvalidArgument
+from bentoml.io import JSON, File, PandasDataFrame
+
+from service.admin import ADMIN_SETTING, check_admin
+from service.arrow_io import (
+    ARROW_MIME_TYPE,
+    is_parquet,
+    probability_table,
+    read_table,
+    write_table,
+)
+from service.fraud_detection_runner import (
+    STAGE_METRICS,
+    FraudDetectionModelRunner,
+)
+from service.model_versions import load_engine
+from util.instrumentation import timed
+from util.velocity import require_velocity_columns
 
 MODEL_TAG = "fraud-detection-model"
+# Adaptive batching limits: concurrent requests are merged into batches of at
+# most MAX_BATCH_SIZE rows, waiting only as long as the MAX_LATENCY_MS budget
+# allows. Requests that would exceed the budget are rejected with a 503, so
+# bentoml's default budget of a minute is kept unless one is set.
+MAX_BATCH_SIZE = int(os.environ.get("FRAUD_DETECTION_MAX_BATCH_SIZE", 512))
+MAX_LATENCY_MS = os.environ.get("FRAUD_DETECTION_MAX_LATENCY_MS")
+if MAX_LATENCY_MS is not None:
+    MAX_LATENCY_MS = int(MAX_LATENCY_MS)
+# Score with the compiled NumPy engine instead of the sklearn pipeline.
+COMPILED = os.environ.get("FRAUD_DETECTION_COMPILED", "1") == "1"
+# Cache fraud probabilities of up to CACHE_SIZE recently scored transactions
+# for CACHE_TTL_S seconds, so retried transactions are not scored again.
+# A size of 0 disables the cache.
+CACHE_SIZE = int(os.environ.get("FRAUD_DETECTION_CACHE_SIZE", 0))
+CACHE_TTL_S = float(os.environ.get("FRAUD_DETECTION_CACHE_TTL_S", 300))
+# Models reading the per-card velocity features keep each card's recent
+# history in the runner, restored from and saved every VELOCITY_SNAPSHOT_S
+# seconds to the VELOCITY_SNAPSHOT file when one is given.
+VELOCITY_SNAPSHOT = os.environ.get("FRAUD_DETECTION_VELOCITY_SNAPSHOT", "")
+VELOCITY_SNAPSHOT_S = float(
+    os.environ.get("FRAUD_DETECTION_VELOCITY_SNAPSHOT_S", 60))
+# Every MODEL_POLL_S seconds, swap in the latest imported model version if
+# it is not the active one. 0 disables polling.
+MODEL_POLL_S = float(os.environ.get("FRAUD_DETECTION_MODEL_POLL_S", 0))
+# Model version scoring every batch in shadow, to compare with the active
+# model before promoting it.
+SHADOW_TAG = os.environ.get("FRAUD_DETECTION_SHADOW_TAG", "")
+# Sketches of the served traffic are saved every PROFILE_S seconds to the
+# PROFILE_DIR directory when one is given, to merge across workers and
+# compare with the model's training data.
+PROFILE_DIR = os.environ.get("FRAUD_DETECTION_PROFILE_DIR", "")
+PROFILE_S = float(os.environ.get("FRAUD_DETECTION_PROFILE_S", 60))
+# The endpoints swapping and shadowing model versions and reporting on them
+# are disabled unless an admin token is set, which requests must then send.
+ADMIN_TOKEN = os.environ.get(ADMIN_SETTING, "")
 
 fraud_detection_model = bentoml.sklearn.get(MODEL_TAG)
 fraud_detection_model_runner = bentoml.Runner(
     FraudDetectionModelRunner,
     models=[fraud_detection_model],
+    max_batch_size=MAX_BATCH_SIZE,
+    max_latency_ms=MAX_LATENCY_MS,
     runnable_init_params={
-        "model":fraud_detection_model
+        "model":fraud_detection_model,
+        "compiled": COMPILED,
+        "cache_size": CACHE_SIZE,
+        "cache_ttl": CACHE_TTL_S,
+        "velocity_snapshot": VELOCITY_SNAPSHOT,
+        "snapshot_interval": VELOCITY_SNAPSHOT_S,
+        "shadow_tag": SHADOW_TAG,
+        "profile_dir": PROFILE_DIR,
+        "profile_interval": PROFILE_S,
     }
 )
 
+# Feature transform for the Arrow endpoint, run in the API server so only
+# the float32 feature matrix travels to the runner, with the generation of
+# the runner's model it belongs to. Both are replaced together on a swap,
+# by the API worker handling it, and by the others when the runner answers
+# with a newer generation.
+feature_engine = (0, load_engine(fraud_detection_model))
+feature_engine_lock = threading.Lock()
+
 fraud_detection_service = bentoml.Service("fraud-detection-service",
                                           runners=[fraud_detection_model_runner])
 
@@ -24,4 +99,152 @@ fraud_detection_service = bentoml.Service("fraud-detection-service",
 def predict(input_df):
     """ Function to predict on new values that the API receives. """
 
-    return fraud_detection_model_runner.is_fraud.run(input_df)
+    with timed(STAGE_METRICS.sample(), "runner", len(input_df)):
+        return fraud_detection_model_runner.is_fraud.run(input_df)
+
+
+@fraud_detection_service.api(input=File(mime_type=ARROW_MIME_TYPE),
+                             output=File(mime_type=ARROW_MIME_TYPE))
+def predict_arrow(input_file):
+    """ Predict on an Arrow IPC stream or Parquet file of transactions and
+    answer in the same format with only the probability columns, plus the
+    request_id column if the request has one.
+    """
+    recorder = STAGE_METRICS.sample()
+    payload = input_file.read()
+    start = time.perf_counter()
+    table = read_table(payload)
+    batch_size = table.num_rows
+    if recorder is not None:
+        # The batch size is only known once the payload is decoded.
+        recorder.record("deserialize", batch_size,
+                        time.perf_counter() - start)
+    generation, engine = feature_engine
+    fraud_proba, active_generation = score_table(table, generation, engine,
+                                                 recorder)
+    if active_generation != generation:
+        # Swapped from another API worker: transform with the active model.
+        generation, engine = refresh_feature_engine(active_generation)
+        fraud_proba, _ = score_table(table, generation, engine, recorder)
+    with timed(recorder, "serialize", batch_size):
+        return write_table(probability_table(table, fraud_proba),
+                           parquet=is_parquet(payload))
+
+
+def score_table(table, generation, engine, recorder=None):
+    """ Transform a table with a feature engine and score it with the
+    runner's model of the same generation. Return the fraud probabilities
+    and the generation of the runner's active model.
+    """
+    try:
+        # The card histories live in the runner, not in the API server.
+        require_velocity_columns(engine, table.column_names,
+                                 "The Arrow endpoint")
+    except ValueError as error:
+        raise InvalidArgument(str(error)) from None
+    batch_size = table.num_rows
+    with timed(recorder, "transform", batch_size):
+        features = engine.transform(table)
+        features = np.column_stack(
+            [features, np.full(batch_size, generation, features.dtype)])
+    with timed(recorder, "runner", batch_size):
+        result = fraud_detection_model_runner.fraud_proba.run(features)
+    active_generation = int(result[0, 1]) if batch_size else generation
+    return result[:, 0], active_generation
+
+
+def install_feature_engine(status):
+    """ Switch the Arrow endpoint to the feature engine of the runner's
+    active model described by a status, unless it already has it.
+    """
+    global feature_engine
+    with feature_engine_lock:
+        if feature_engine[0] != status["generation"]:
+            feature_engine = (status["generation"], load_engine(
+                bentoml.models.get(status["active"])))
+        return feature_engine
+
+
+def refresh_feature_engine(generation):
+    """ Switch to the feature engine of the runner's active model, of the
+    given generation, after a swap handled by another API worker.
+    """
+    current = feature_engine
+    if current[0] == generation:
+        return current
+    return install_feature_engine(
+        fraud_detection_model_runner.model_status.run())
+
+
+async def activate(tag):
+    """ Make a model version the runner's active model and switch the Arrow
+    endpoint's feature engine to it.
+    """
+    status = await fraud_detection_model_runner.swap_model.async_run(tag)
+    await asyncio.to_thread(install_feature_engine, status)
+    return status
+
+
+@fraud_detection_service.api(input=JSON(), output=JSON())
+async def swap_model(request, ctx: bentoml.Context):
+    """ Swap in the model version given as {"tag": ...}, the latest imported
+    one by default, without interrupting scoring.
+    """
+    check_admin(ctx.request.headers, ADMIN_TOKEN)
+    return await activate(
+        (request or {}).get("tag") or f"{MODEL_TAG}:latest")
+
+
+@fraud_detection_service.api(input=JSON(), output=JSON())
+async def shadow_model(request, ctx: bentoml.Context):
+    """ Score every batch in shadow with the model version given as
+    {"tag": ...}, or stop shadow scoring when no tag is given.
+    """
+    check_admin(ctx.request.headers, ADMIN_TOKEN)
+    return await fraud_detection_model_runner.set_shadow.async_run(
+        (request or {}).get("tag") or "")
+
+
+@fraud_detection_service.api(input=JSON(), output=JSON())
+async def model_status(_request, ctx: bentoml.Context):
+    """ Return the active model version and how the shadow candidate
+    compares with it so far.
+    """
+    check_admin(ctx.request.headers, ADMIN_TOKEN)
+    return await fraud_detection_model_runner.model_status.async_run()
+
+
+@fraud_detection_service.api(input=JSON(), output=JSON())
+async def traffic_report(_request, ctx: bentoml.Context):
+    """ Return how far the traffic scored by the active model drifted from
+    its training data.
+    """
+    check_admin(ctx.request.headers, ADMIN_TOKEN)
+    return await fraud_detection_model_runner.traffic_report.async_run()
+
+
+async def poll_models():
+    """ Swap in the latest imported model version whenever it changes, so
+    a version swapped in by hand stays active until a new one is imported.
+    """
+    seen = str(fraud_detection_model.tag)
+    while True:
+        await asyncio.sleep(MODEL_POLL_S)
+        try:
+            latest = str(bentoml.models.get(f"{MODEL_TAG}:latest").tag)
+            if latest != seen:
+                await activate(latest)
+                seen = latest
+        except Exception as error:  # noqa: BLE001
+            print(f"Model poll failed: {error}")
+
+
+# Background tasks of the API server, referenced so they are not collected.
+background_tasks = set()
+
+
+@fraud_detection_service.on_startup
+async def start_model_polling(_context):
+    """ Poll for new model versions in the background, if enabled. """
+    if MODEL_POLL_S > 0:
+        background_tasks.add(asyncio.create_task(poll_models()))
@@ -0,0 +1,44 @@
+""" Shared fixtures: a small pipeline trained on synthetic transactions. """
+import os
+import tempfile
+
+import pytest
+
+from benchmarks.compiled_pipeline import train_pipeline
+from benchmarks.synthetic import generate_transactions
+from util.preprocessing import preprocess_dataset
+
+# Bento models saved by the tests go to a throwaway store, set before
+# bentoml is first imported.
+os.environ["BENTOML_HOME"] = tempfile.mkdtemp()
+
+
+@pytest.fixture(scope="session")
+def pipeline():
+    """ Inference pipeline fitted like the flow does, kept small. """
+    return train_pipeline(2_000, n_estimators=5, max_depth=6, n_jobs=1)
+
+
+@pytest.fixture(scope="session")
+def raw_df():
+    """ Raw transactions the pipeline was not trained on. """
+    return generate_transactions(200, seed=1).drop("Is Fraud?")
+
+
+@pytest.fixture(scope="session")
+def score_df(raw_df):
+    """ The raw transactions preprocessed, as a pandas DataFrame. """
+    return preprocess_dataset(raw_df).to_pandas()
+
+
+@pytest.fixture(scope="session")
+def bento_model(pipeline):
+    """ The pipeline imported into bentoml like ``import_mlflow_model``. """
+    import bentoml
+
+    from service.model_versions import COMPILED_MODEL_DIR
+    from util.compiled_pipeline import compile_pipeline
+
+    model = bentoml.sklearn.save_model("fraud-detection-model", pipeline)
+    compile_pipeline(pipeline).save(model.path_of(COMPILED_MODEL_DIR))
+    return model
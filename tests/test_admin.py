@@ -0,0 +1,24 @@
+""" The token guarding the service's admin endpoints. """
+from http import HTTPStatus
+
+import pytest
+from bentoml.exceptions import BentoMLException, NotFound
+
+from service.admin import check_admin
+
+
+def test_admin_endpoints_are_disabled_without_a_token():
+    with pytest.raises(NotFound):
+        check_admin({"authorization": "Bearer "}, "")
+
+
+@pytest.mark.parametrize("headers", [{}, {"authorization": "Bearer wrong"},
+                                     {"authorization": "secret"}])
+def test_admin_endpoints_need_the_token(headers):
+    with pytest.raises(BentoMLException) as error:
+        check_admin(headers, "secret")
+    assert error.value.error_code == HTTPStatus.UNAUTHORIZED
+
+
+def test_admin_endpoints_accept_the_token():
+    check_admin({"authorization": "Bearer secret"}, "secret")
@@ -0,0 +1,44 @@
+""" Arrow IPC and Parquet payloads of the Arrow endpoint. """
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from service.arrow_io import (
+    is_parquet,
+    probability_table,
+    read_table,
+    write_table,
+)
+from util.compiled_pipeline import compile_pipeline
+
+
+@pytest.fixture(scope="module")
+def table(score_df):
+    return pa.Table.from_pandas(score_df, preserve_index=False)
+
+
+@pytest.mark.parametrize("parquet", [False, True])
+def test_round_trip(table, parquet):
+    payload = write_table(table, parquet=parquet)
+    assert is_parquet(payload) == parquet
+    assert read_table(payload).equals(table)
+
+
+def test_probability_table():
+    fraud_proba = np.array([0.25, 0.5])
+    request = pa.table({"request_id": ["a", "b"], "Amount": [1.0, 2.0]})
+    response = probability_table(request, fraud_proba)
+    assert response.column_names == ["request_id", "is_fraud_proba",
+                                     "is_legit_proba"]
+    assert response["request_id"].to_pylist() == ["a", "b"]
+    assert response["is_legit_proba"].to_pylist() == [0.75, 0.5]
+    assert probability_table(request.drop(["request_id"]),
+                             fraud_proba).column_names == [
+        "is_fraud_proba", "is_legit_proba"]
+
+
+def test_engine_reads_arrow_tables(pipeline, score_df, table):
+    engine = compile_pipeline(pipeline)
+    features = engine.transform(read_table(write_table(table)))
+    np.testing.assert_allclose(engine.score_features(features),
+                               pipeline.predict_proba(score_df))
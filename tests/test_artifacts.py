@@ -0,0 +1,58 @@
+""" Content-addressed storage of flow step frames. """
+import pickle
+
+import polars as pl
+
+from util import preprocessing
+from util.artifacts import (
+    find_artifacts,
+    step_key,
+    store_artifacts,
+    stored_step,
+)
+
+
+def test_step_key_follows_its_inputs():
+    key = step_key([preprocessing], ["a" * 32], {"seed": 1})
+    assert key == step_key([preprocessing], ["a" * 32], {"seed": 1})
+    assert key != step_key([preprocessing], ["b" * 32], {"seed": 1})
+    assert key != step_key([preprocessing], ["a" * 32], {"seed": 2})
+    assert key != step_key([pl], ["a" * 32], {"seed": 1})
+
+
+def test_store_and_load(tmp_path):
+    frame = pl.DataFrame({"a": [1, 2, 3], "b": ["x", None, "z"]})
+    artifacts = store_artifacts(tmp_path, "split", "k1", {"train": frame},
+                                {"rows": 3})
+    assert artifacts.key == "k1"
+    assert artifacts.load("train").equals(frame)
+    assert artifacts.metadata == {"rows": 3}
+    # Steps hand over the small reference only.
+    reference = pickle.loads(pickle.dumps(artifacts))  # noqa: S301
+    assert reference.load("train").equals(frame)
+    assert not list((tmp_path / "split").glob("*.partial-*"))
+    assert find_artifacts(tmp_path, "split", "k2") is None
+
+
+def test_stored_step_computes_once(tmp_path):
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"data": pl.DataFrame({"a": [len(calls)]})}, {}
+
+    first = stored_step(tmp_path, "step", "key", compute)
+    second = stored_step(tmp_path, "step", "key", compute)
+    assert len(calls) == 1
+    assert second.load("data").equals(first.load("data"))
+    stored_step(tmp_path, "step", "other", compute)
+    assert len(calls) == 2
+
+
+def test_storing_an_existing_key_keeps_it(tmp_path):
+    frame = pl.DataFrame({"a": [1]})
+    store_artifacts(tmp_path, "step", "key", {"data": frame})
+    artifacts = store_artifacts(tmp_path, "step", "key",
+                                {"data": pl.DataFrame({"a": [2]})})
+    assert artifacts.load("data").equals(frame)
+    assert [path.name for path in (tmp_path / "step").iterdir()] == ["key"]
@@ -0,0 +1,77 @@
+""" Chunked, parallel scoring of transaction files. """
+import io
+
+import numpy as np
+import polars as pl
+import pyarrow.parquet as pq
+import pytest
+
+from util.batch_scoring import (
+    PREDICTION_COLUMN,
+    PROBABILITY_COLUMN,
+    count_rows,
+    score_batches,
+    write_batches,
+)
+from util.compiled_pipeline import compile_pipeline
+from util.preprocessing import preprocess_dataset
+
+
+@pytest.fixture(scope="module")
+def source(raw_df, tmp_path_factory):
+    path = tmp_path_factory.mktemp("batch") / "transactions.csv"
+    raw_df.write_csv(path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def expected(pipeline, raw_df):
+    return pipeline.predict_proba(preprocess_dataset(raw_df).to_pandas())
+
+
+def check_scored(scored_df, raw_df, expected):
+    assert scored_df.drop(PREDICTION_COLUMN, PROBABILITY_COLUMN).equals(
+        raw_df)
+    np.testing.assert_allclose(scored_df[PROBABILITY_COLUMN], expected[:, 1])
+
+
+def test_threads_keep_file_order(pipeline, source, raw_df, expected):
+    chunks = list(score_batches(source, compile_pipeline(pipeline),
+                                chunk_size=30, workers=3))
+    assert len(chunks) > 1
+    check_scored(pl.concat(chunks), raw_df, expected)
+
+
+def test_processes_load_the_model(pipeline, source, raw_df, expected,
+                                  tmp_path):
+    compile_pipeline(pipeline).save(tmp_path / "engine")
+    chunks = score_batches(source, str(tmp_path / "engine"), chunk_size=50,
+                           workers=2, processes=True)
+    check_scored(pl.concat(list(chunks)), raw_df, expected)
+
+
+def test_file_object_source(pipeline, source, raw_df, expected):
+    with open(source, "rb") as source_file:
+        stream = io.BytesIO(source_file.read())
+    assert count_rows(io.BytesIO(stream.getvalue())) == len(raw_df)
+    chunks = score_batches(stream, compile_pipeline(pipeline), chunk_size=64)
+    check_scored(pl.concat(list(chunks)), raw_df, expected)
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".csv"])
+def test_write_batches(pipeline, source, raw_df, expected, tmp_path,
+                       suffix):
+    output = tmp_path / f"scored{suffix}"
+    progress = list(write_batches(
+        score_batches(source, compile_pipeline(pipeline), chunk_size=80),
+        output))
+    # The batched CSV reader makes chunks of about chunk_size rows.
+    assert len(progress) > 1
+    assert progress == sorted(progress)
+    assert progress[-1] == len(raw_df)
+    if suffix == ".parquet":
+        # Polars 0.20 reads an all-null string page back as empty strings.
+        check_scored(pl.from_arrow(pq.read_table(output)), raw_df, expected)
+    else:
+        np.testing.assert_allclose(
+            pl.read_csv(output)[PROBABILITY_COLUMN], expected[:, 1])
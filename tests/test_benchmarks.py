@@ -0,0 +1,42 @@
+""" The synthetic generator and the benchmark suite on a tiny config. """
+import argparse
+
+import polars as pl
+
+from benchmarks.suite import benchmark_model, measure
+from benchmarks.synthetic import generate_transactions
+from util.ingest import SOURCE_SCHEMA
+
+
+def test_generator_follows_the_source_schema(tmp_path):
+    transactions = generate_transactions(500, fraud_rate=0.2, seed=3)
+    assert transactions.columns == list(SOURCE_SCHEMA)
+    transactions.write_csv(tmp_path / "transactions.csv")
+    read_df = pl.read_csv(tmp_path / "transactions.csv", dtypes=SOURCE_SCHEMA)
+    assert read_df.shape == (500, len(SOURCE_SCHEMA))
+    assert set(read_df["Is Fraud?"].unique()) == {"Yes", "No"}
+
+
+def test_generator_is_seeded():
+    assert generate_transactions(50, seed=4).equals(
+        generate_transactions(50, seed=4))
+    assert not generate_transactions(50, seed=4).equals(
+        generate_transactions(50, seed=5))
+
+
+def test_measure():
+    result = measure(lambda data: sum(data), range(10), repeat=5)
+    assert result["repeat"] == 5
+    assert 0 <= result["p50_ms"] <= result["p99_ms"]
+
+
+def test_benchmark_model_times_every_stage():
+    args = argparse.Namespace(train_rows=500, batch_sizes=[1, 5], repeat=3)
+    raw_df = generate_transactions(5, seed=1)
+    results = benchmark_model(args, trees=3, depth=4, raw_df=raw_df)
+    stages = {result["stage"] for result in results}
+    assert {"preprocess_dataset", "category_codes", "target_encoding",
+            "scaling", "forest", "pipeline", "compiled_pipeline",
+            "runner_is_fraud", "runner_is_fraud_compiled"} == stages
+    assert len(results) == 2 * len(stages)
+    assert all(result["model"]["n_estimators"] == 3 for result in results)
@@ -0,0 +1,73 @@
+""" Category dictionaries shared by training and serving. """
+import numpy as np
+import pandas as pd
+import polars as pl
+
+from benchmarks.synthetic import generate_transactions
+from util.categories import (
+    CATEGORICAL_COLUMNS,
+    UNKNOWN_CODE,
+    CategoryCodes,
+    encode_categories,
+    extend_dictionaries,
+)
+from util.preprocessing import preprocess_dataset
+
+
+def test_serving_codes_match_training_codes():
+    data_df = preprocess_dataset(generate_transactions(500))
+    dictionaries = extend_dictionaries(data_df)
+    encoded = encode_categories(data_df, dictionaries)
+    served = CategoryCodes(dictionaries).fit().transform(data_df)
+    for column in CATEGORICAL_COLUMNS:
+        assert encoded[column].dtype == pl.Int32
+        np.testing.assert_array_equal(served[column], encoded[column])
+        assert (encoded[column] != UNKNOWN_CODE).all()
+
+
+def test_extending_keeps_existing_codes():
+    first = preprocess_dataset(generate_transactions(200, seed=0))
+    second = preprocess_dataset(generate_transactions(200, seed=1))
+    dictionaries = extend_dictionaries(first)
+    extended = extend_dictionaries(second, dictionaries)
+    for column in CATEGORICAL_COLUMNS:
+        assert extended[column][:len(dictionaries[column])] == (
+            dictionaries[column])
+    np.testing.assert_array_equal(
+        encode_categories(first, dictionaries)["Zip"],
+        encode_categories(first, extended)["Zip"])
+
+
+def test_zip_representations_share_a_code():
+    dictionaries = extend_dictionaries(pl.DataFrame(
+        {**{column: ["x"] for column in CATEGORICAL_COLUMNS},
+         "Zip": [94107.0]}))
+    assert dictionaries["Zip"] == ["94107"]
+    codes = CategoryCodes(dictionaries).fit()
+    served = codes.transform(pd.DataFrame({
+        **{column: ["x"] * 4 for column in CATEGORICAL_COLUMNS},
+        "Zip": [94107, 94107.0, "94107.0", "94107"],
+    }))
+    assert served["Zip"].tolist() == [0, 0, 0, 0]
+
+
+def test_unknown_and_missing_values():
+    data_df = pl.DataFrame({
+        **{column: ["a", None] for column in CATEGORICAL_COLUMNS},
+        "Zip": ["1", None],
+    })
+    dictionaries = extend_dictionaries(data_df)
+    assert dictionaries["Use Chip"] == ["a", None]
+    codes = CategoryCodes(dictionaries).fit()
+    served = codes.transform(pd.DataFrame(
+        {column: ["never seen", None, "a"]
+         for column in CATEGORICAL_COLUMNS}))
+    assert served["Use Chip"].tolist() == [UNKNOWN_CODE, 1, 0]
+    assert codes.to_dict()["dictionaries"] == dictionaries
+
+
+def test_transform_leaves_its_input_untouched():
+    data_df = pd.DataFrame({column: ["a"] for column in CATEGORICAL_COLUMNS})
+    codes = CategoryCodes(extend_dictionaries(pl.from_pandas(data_df))).fit()
+    codes.transform(data_df)
+    assert data_df["Zip"].tolist() == ["a"]
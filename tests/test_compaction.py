@@ -0,0 +1,105 @@
+""" Pruning fitted forests into compact variants. """
+import numpy as np
+import pytest
+from sklearn.datasets import make_classification
+from sklearn.tree import DecisionTreeClassifier
+
+from util.compaction import (
+    TREE_LEAF,
+    check_variants,
+    compact_pipeline,
+    compact_tree,
+    select_variant,
+    variant_name,
+)
+from util.compiled_pipeline import compile_pipeline
+
+
+@pytest.fixture(scope="module")
+def data():
+    return make_classification(2_000, n_features=8, weights=[0.9],
+                               random_state=0)
+
+
+def fitted_tree(data, **params):
+    return DecisionTreeClassifier(random_state=0, **params).fit(*data)
+
+
+def with_tree(estimator, tree):
+    estimator.tree_ = tree
+    return estimator
+
+
+def node_depths(tree):
+    depths = np.zeros(tree.node_count, dtype=np.int64)
+    for node in range(tree.node_count):
+        if tree.children_left[node] != TREE_LEAF:
+            depths[tree.children_left[node]] = depths[node] + 1
+            depths[tree.children_right[node]] = depths[node] + 1
+    return depths
+
+
+def test_max_depth_predicts_the_node_at_that_depth(data):
+    full = fitted_tree(data)
+    compacted = with_tree(fitted_tree(data), compact_tree(full.tree_,
+                                                          max_depth=3))
+    assert compacted.tree_.max_depth == 3
+    assert node_depths(compacted.tree_).max() == 3
+    # The deepest node of each sample's path within the first 4 levels.
+    paths = full.decision_path(data[0]).toarray().astype(bool)
+    depths = node_depths(full.tree_)
+    nodes = np.array([np.flatnonzero(path & (depths <= 3))[-1]
+                      for path in paths])
+    values = full.tree_.value[nodes, 0]
+    np.testing.assert_allclose(compacted.predict_proba(data[0]),
+                               values / values.sum(axis=1, keepdims=True))
+
+
+def test_ccp_alpha_matches_sklearn(data):
+    full = fitted_tree(data)
+    for ccp_alpha in (0.0005, 0.002, 0.01):
+        expected = fitted_tree(data, ccp_alpha=ccp_alpha)
+        compacted = with_tree(fitted_tree(data),
+                              compact_tree(full.tree_, ccp_alpha=ccp_alpha))
+        assert compacted.tree_.node_count == expected.tree_.node_count
+        np.testing.assert_allclose(compacted.predict_proba(data[0]),
+                                   expected.predict_proba(data[0]))
+
+
+def test_min_samples_leaf(data):
+    full = fitted_tree(data)
+    tree = compact_tree(full.tree_, min_samples_leaf=20)
+    assert tree.node_count < full.tree_.node_count
+    internal = tree.children_left != TREE_LEAF
+    samples = tree.n_node_samples
+    assert (samples[tree.children_left[internal]] >= 20).all()
+    assert (samples[tree.children_right[internal]] >= 20).all()
+
+
+def test_compact_pipeline(pipeline, score_df):
+    full_engine = compile_pipeline(pipeline)
+    compacted = compact_pipeline(pipeline, max_depth=2, precision="float32")
+    engine = compile_pipeline(compacted)
+    assert engine.depth <= 2 < full_engine.depth
+    assert engine.threshold.dtype == np.float32
+    assert len(engine.left) < len(full_engine.left)
+    np.testing.assert_allclose(engine.predict_proba(score_df),
+                               compacted.predict_proba(score_df), atol=1e-6)
+    # The original pipeline is left as it was.
+    assert compile_pipeline(pipeline).depth == full_engine.depth
+
+
+def test_variants():
+    check_variants([{}, {"max_depth": 8, "precision": "float32"}])
+    with pytest.raises(ValueError, match="max_leaf_nodes"):
+        check_variants([{"max_leaf_nodes": 10}])
+    assert variant_name({}) == "full"
+    assert variant_name({"precision": "float32", "max_depth": 8}) == (
+        "max_depth=8,precision=float32")
+    results = [
+        {"recall": 0.90, "compiled_size_mb": 10, "serving_p50_ms": 1},
+        {"recall": 0.89, "compiled_size_mb": 4, "serving_p50_ms": 1},
+        {"recall": 0.70, "compiled_size_mb": 1, "serving_p50_ms": 1},
+    ]
+    assert select_variant(results) == 0
+    assert select_variant(results, recall_tolerance=0.02) == 1
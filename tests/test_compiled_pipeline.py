@@ -0,0 +1,48 @@
+""" Parity of the compiled engine with the sklearn pipeline. """
+import numpy as np
+import pytest
+
+from util.compiled_pipeline import CompiledPipeline, compile_pipeline
+
+
+@pytest.fixture(scope="module")
+def engine(pipeline):
+    """ The pipeline compiled. """
+    return compile_pipeline(pipeline)
+
+
+def test_single_row(pipeline, engine, score_df):
+    row_df = score_df.head(1)
+    np.testing.assert_allclose(engine.predict_proba(row_df),
+                               pipeline.predict_proba(row_df))
+
+
+def test_batch(pipeline, engine, score_df):
+    np.testing.assert_allclose(engine.predict_proba(score_df),
+                               pipeline.predict_proba(score_df))
+
+
+def test_records(pipeline, engine, score_df):
+    batch_df = score_df.head(20)
+    np.testing.assert_allclose(
+        engine.predict_proba(batch_df.to_dict("records")),
+        pipeline.predict_proba(batch_df))
+
+
+def test_mapping(pipeline, engine, score_df):
+    columns = {column: score_df[column].to_numpy()
+               for column in score_df.columns}
+    np.testing.assert_allclose(engine.predict_proba(columns),
+                               pipeline.predict_proba(score_df))
+
+
+@pytest.mark.parametrize("mmap_mode", ["r", None])
+def test_save_load(pipeline, engine, score_df, tmp_path, mmap_mode):
+    engine.save(tmp_path / "engine")
+    loaded = CompiledPipeline.load(tmp_path / "engine", mmap_mode=mmap_mode)
+    np.testing.assert_allclose(loaded.predict_proba(score_df),
+                               pipeline.predict_proba(score_df))
+    assert loaded.feature_columns == engine.feature_columns
+    assert loaded.decision_threshold == engine.decision_threshold
+    np.testing.assert_array_equal(loaded.predict(score_df),
+                                  engine.predict(score_df))
@@ -0,0 +1,115 @@
+""" Traffic profile sketches and the drift they report. """
+import numpy as np
+import pytest
+
+from benchmarks.drift import assert_same_counts, skewed_transactions
+from service.fraud_detection_runner import FraudDetectionModelRunner
+from util.categories import encode_categories, extend_dictionaries
+from util.drift import (
+    PROBABILITY_COLUMN,
+    CategorySketch,
+    QuantileSketch,
+    TrafficProfile,
+    category_keys,
+)
+
+
+@pytest.fixture(scope="module")
+def skewed_df():
+    return skewed_transactions(20_000)
+
+
+@pytest.fixture(scope="module")
+def fraud_proba(skewed_df):
+    return np.random.default_rng(0).beta(0.5, 5, len(skewed_df))
+
+
+@pytest.fixture(scope="module")
+def profile(skewed_df, fraud_proba):
+    profile = TrafficProfile()
+    profile.update(skewed_df.to_pandas(), fraud_proba)
+    return profile
+
+
+def test_quantiles_within_the_relative_accuracy():
+    values = np.random.default_rng(0).lognormal(3, 2, 10_000)
+    sketch = QuantileSketch()
+    sketch.update(np.concatenate([values, -values[:100], [0, np.nan]]))
+    assert (sketch.count, sketch.missing) == (10_101, 1)
+    quantiles = np.linspace(0.05, 0.95, 19)
+    exact = np.quantile(np.concatenate([values, -values[:100], [0]]),
+                        quantiles, method="lower")
+    np.testing.assert_allclose(sketch.quantile(quantiles), exact,
+                               rtol=sketch.relative_accuracy * 1.01)
+
+
+def test_heavy_hitters(skewed_df, profile):
+    merchants = skewed_df["Merchant Name"].to_pandas().value_counts(
+        normalize=True)
+    heavy = profile.categorical["Merchant Name"].heavy_hitters()
+    assert [value for value, _ in heavy[:5]] == [
+        str(value) for value in merchants.index[:5]]
+    for value, share in heavy[:5]:
+        # Count-min estimates only ever overcount.
+        assert merchants[int(value)] <= share < merchants[int(value)] + 0.01
+
+
+def test_category_keys_are_canonical():
+    keys = category_keys(np.array([94107, 94107.0, "94107", "94107.0"],
+                                  dtype=object))
+    assert len(set(keys.tolist())) == 1
+    assert category_keys(np.array(["ONLINE"], dtype=object))[0] != keys[0]
+    with pytest.raises(ValueError, match="power of two"):
+        CategorySketch(width=1_000)
+
+
+def test_merge_decode_and_save(skewed_df, fraud_proba, profile, tmp_path):
+    data = skewed_df.to_pandas()
+    half = len(data) // 2
+    merged, other = TrafficProfile(), TrafficProfile()
+    merged.update(data.iloc[:half], fraud_proba[:half])
+    other.update(data.iloc[half:], fraud_proba[half:])
+    assert_same_counts(profile, merged.merge(other))
+    assert merged.transactions == len(data)
+
+    dictionaries = extend_dictionaries(skewed_df)
+    coded = TrafficProfile()
+    coded.update(encode_categories(skewed_df, dictionaries), fraud_proba,
+                 dictionaries=dictionaries)
+    assert_same_counts(profile, coded)
+
+    path = tmp_path / "profile.json"
+    profile.save(str(path))
+    loaded = TrafficProfile.load(str(path))
+    assert_same_counts(profile, loaded)
+    assert loaded.categorical["Merchant Name"].heavy_hitters() == (
+        profile.categorical["Merchant Name"].heavy_hitters())
+
+
+def test_compare_finds_shifted_traffic(profile):
+    held_out = skewed_transactions(5_000, seed=1).to_pandas()
+    same, shifted = TrafficProfile(), TrafficProfile()
+    same.update(held_out, np.random.default_rng(1).beta(0.5, 5, 5_000))
+    shifted.update(held_out.assign(Amount=held_out["Amount"] * 2),
+                   np.random.default_rng(1).beta(2, 2, 5_000))
+    report = same.compare(profile)
+    drifted = shifted.compare(profile)
+    assert report["baseline_transactions"] == profile.transactions
+    assert report["features"]["Amount"]["psi"] < 0.05
+    assert drifted["features"]["Amount"]["psi"] > 0.2
+    assert drifted["features"]["Amount"]["p50"] == pytest.approx(
+        2 * report["features"]["Amount"]["p50"], rel=0.05)
+    assert report[PROBABILITY_COLUMN]["psi"] < 0.05
+    assert drifted[PROBABILITY_COLUMN]["psi"] > 0.2
+    assert report["features"]["Merchant Name"]["psi"] < 0.05
+
+
+def test_runner_profiles_scored_traffic(bento_model, score_df):
+    runner = FraudDetectionModelRunner(bento_model)
+    result = FraudDetectionModelRunner.is_fraud.func(runner, score_df)
+    runner.profile_executor.shutdown(wait=True)
+    assert runner.profile.transactions == len(score_df)
+    assert runner.profile.probability_sum == pytest.approx(
+        result["is_fraud_proba"].sum())
+    report = FraudDetectionModelRunner.traffic_report.func(runner)
+    assert report == {"model": str(bento_model.tag), "drift": None}
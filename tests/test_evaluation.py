@@ -0,0 +1,109 @@
+""" Vectorized evaluation against sklearn's metrics. """
+import numpy as np
+import pytest
+from sklearn import metrics
+
+from benchmarks.compiled_pipeline import train_pipeline
+from util.compiled_pipeline import compile_pipeline
+from util.evaluation import (
+    DEFAULT_THRESHOLD,
+    THRESHOLD_ATTRIBUTE,
+    curve_points,
+    decision_threshold,
+    evaluate,
+    flag_fraud,
+    fraud_probabilities,
+    precision_recall_curve,
+    predict_classes,
+)
+
+
+@pytest.fixture(scope="module")
+def labelled():
+    rng = np.random.default_rng(0)
+    y_true = (rng.random(5_000) < 0.1).astype(np.int64)
+    # Rounded so that scores tie, like probabilities of a small forest.
+    scores = np.round(np.clip(0.3 * y_true + rng.random(5_000) * 0.7, 0, 1),
+                      2)
+    return y_true, scores
+
+
+def test_curve_matches_sklearn(labelled):
+    y_true, scores = labelled
+    curve = precision_recall_curve(y_true, scores)
+    precision, recall, thresholds = metrics.precision_recall_curve(
+        y_true, scores)
+    # sklearn orders thresholds upwards and appends the (1, 0) end point.
+    np.testing.assert_allclose(curve["thresholds"], thresholds[::-1])
+    np.testing.assert_allclose(curve["precision"], precision[:-1][::-1])
+    np.testing.assert_allclose(curve["recall"], recall[:-1][::-1])
+
+
+def test_evaluate(labelled):
+    y_true, scores = labelled
+    result = evaluate(y_true, scores, budgets=(0.05, 1.0))
+    assert result["average_precision"] == pytest.approx(
+        metrics.average_precision_score(y_true, scores))
+    flagged = scores >= result["threshold"]
+    assert result["recall"] == pytest.approx(
+        metrics.recall_score(y_true, flagged))
+    assert result["precision"] == pytest.approx(
+        metrics.precision_score(y_true, flagged))
+    # The picked threshold maximizes F1 over every distinct score.
+    best_f1 = max(metrics.f1_score(y_true, scores >= threshold)
+                  for threshold in np.unique(scores))
+    assert metrics.f1_score(y_true, flagged) == pytest.approx(best_f1)
+    assert result["budgets"][1.0]["recall"] == 1.0
+    assert result["budgets"][0.05]["threshold"] >= result["budgets"][1.0][
+        "threshold"]
+    fixed = evaluate(y_true, scores, threshold=0.9)
+    assert fixed["threshold"] == 0.9
+    assert fixed["recall"] == pytest.approx(
+        metrics.recall_score(y_true, scores >= 0.9))
+
+
+def test_curve_points(labelled):
+    curve = precision_recall_curve(*labelled)
+    points = curve_points(curve, max_points=10)
+    assert len(points["thresholds"]) == 10
+    assert points["thresholds"][0] == curve["thresholds"][0]
+    assert points["thresholds"][-1] == curve["thresholds"][-1]
+
+
+def test_fraud_probabilities_in_chunks(pipeline, score_df):
+    engine = compile_pipeline(pipeline)
+    np.testing.assert_allclose(
+        fraud_probabilities(engine, score_df, chunk_size=30, workers=3),
+        pipeline.predict_proba(score_df)[:, 1])
+
+
+def test_decision_threshold(pipeline, score_df):
+    engine = compile_pipeline(pipeline)
+    assert decision_threshold(pipeline) == DEFAULT_THRESHOLD
+    setattr(pipeline, THRESHOLD_ATTRIBUTE, 0.2)
+    try:
+        assert decision_threshold(pipeline) == 0.2
+        assert decision_threshold(compile_pipeline(pipeline)) == 0.2
+        probabilities = pipeline.predict_proba(score_df)
+        np.testing.assert_array_equal(
+            predict_classes(pipeline, probabilities),
+            (probabilities[:, 1] >= 0.2).astype(np.int64))
+    finally:
+        delattr(pipeline, THRESHOLD_ATTRIBUTE)
+    assert decision_threshold(engine) == DEFAULT_THRESHOLD
+
+
+def test_untuned_ties_predict_like_sklearn(score_df):
+    # Two fully grown trees often split their vote evenly.
+    pipeline = train_pipeline(2_000, n_estimators=2, n_jobs=1)
+    engine = compile_pipeline(pipeline)
+    probabilities = pipeline.predict_proba(score_df)
+    assert (probabilities[:, 1] == 0.5).any()
+    expected = pipeline.predict(score_df)
+    np.testing.assert_array_equal(predict_classes(pipeline, probabilities),
+                                  expected)
+    np.testing.assert_array_equal(engine.predict(score_df), expected)
+    setattr(pipeline, THRESHOLD_ATTRIBUTE, 0.5)
+    # A tuned threshold flags from the threshold on.
+    assert flag_fraud(pipeline, [0.5]).tolist() == [True]
+    assert flag_fraud(compile_pipeline(pipeline), [0.5]).tolist() == [True]
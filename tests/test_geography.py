@@ -0,0 +1,49 @@
+""" The app's precomputed geography index. """
+import polars as pl
+
+from util.geography import build_geography_index, country_states, state_cities
+
+
+def small_index():
+    countries_df = pl.DataFrame({"id": [233, 1], "name": ["United States",
+                                                         "Afghanistan"]})
+    states_df = pl.DataFrame({
+        "id": [10, 11, 20],
+        "name": ["California", "Texas", "Kabul"],
+        "country_id": [233, 233, 1],
+        "state_code": ["CA", "TX", "KAB"],
+    })
+    cities_df = pl.DataFrame({"name": ["La Verne", "Austin", "Houston"],
+                              "state_id": [10, 11, 11]})
+    return build_geography_index(countries_df, states_df, cities_df)
+
+
+def test_lookups():
+    index = small_index()
+    assert index["countries"] == ["United States", "Afghanistan"]
+    assert index["country_ids"]["United States"] == 233
+    states = country_states(index, 233)
+    assert states["names"] == ["California", "Texas"]
+    assert states["codes"] == ["CA", "TX"]
+    assert states["id_by_code"]["TX"] == 11
+    assert states["id_by_name"]["California"] == 10
+    assert state_cities(index, 11) == ["Austin", "Houston"]
+
+
+def test_missing_entries_are_empty():
+    index = small_index()
+    assert country_states(index, 999)["names"] == []
+    assert state_cities(index, 20) == []
+
+
+def test_matches_filtering_the_bundled_states():
+    countries_df = pl.read_csv("app_data/countries.csv")
+    states_df = pl.read_csv("app_data/states.csv")
+    index = build_geography_index(
+        countries_df, states_df,
+        pl.DataFrame({"name": [], "state_id": []},
+                     schema={"name": pl.String, "state_id": pl.Int64}))
+    for country_id in countries_df.get_column("id").to_list()[:50]:
+        expected = states_df.filter(pl.col("country_id") == country_id)
+        assert country_states(index, country_id)["names"] == (
+            expected.get_column("name").to_list())
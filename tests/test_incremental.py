@@ -0,0 +1,72 @@
+""" Incremental updates of the encoder statistics and the forest. """
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.incremental import fit, partitions
+from util.incremental import (
+    EncoderStatistics,
+    encoder_statistics,
+    target_encoder,
+    update_pipeline,
+)
+
+
+@pytest.fixture(scope="module")
+def data():
+    return partitions(3, 1_000, fraud_rate=0.1)
+
+
+def test_updates_match_a_full_refit(data):
+    pipeline = fit(*data[0], trees=3)
+    statistics = encoder_statistics(pipeline, *data[0])
+    for train_x, train_y in data[1:]:
+        statistics = update_pipeline(pipeline, statistics, train_x, train_y,
+                                     new_trees=2)
+    refit = fit(pd.concat([train_x for train_x, _ in data]),
+                np.concatenate([train_y for _, train_y in data]), trees=3)
+
+    encoder, _ = target_encoder(pipeline)
+    expected, _ = target_encoder(refit)
+    np.testing.assert_allclose(encoder.target_mean_, expected.target_mean_)
+    for actual, wanted in zip(encoder.encodings_, expected.encodings_):
+        np.testing.assert_allclose(actual, wanted)
+    for actual, wanted in zip(encoder.categories_, expected.categories_):
+        np.testing.assert_array_equal(actual, wanted)
+    assert len(pipeline.named_steps["model"].estimators_) == 3 + 2 * 2
+    assert statistics.total_count == sum(len(y) for _, y in data)
+
+
+def test_replace_trees_keeps_the_forest_size(data):
+    pipeline = fit(*data[0], trees=4)
+    oldest = pipeline.named_steps["model"].estimators_[2:]
+    statistics = encoder_statistics(pipeline, *data[0])
+    update_pipeline(pipeline, statistics, *data[1], new_trees=2,
+                    replace_trees=True)
+    estimators = pipeline.named_steps["model"].estimators_
+    assert len(estimators) == 4
+    assert estimators[:2] == oldest
+    assert pipeline.named_steps["model"].warm_start is False
+
+
+def test_update_needs_every_class(data):
+    pipeline = fit(*data[0], trees=2)
+    statistics = encoder_statistics(pipeline, *data[0])
+    train_x, train_y = data[1]
+    with pytest.raises(ValueError, match="every class"):
+        update_pipeline(pipeline, statistics, train_x,
+                        np.zeros_like(train_y), new_trees=1)
+
+
+def test_merge_with_missing_values():
+    first = EncoderStatistics.from_data(
+        pd.DataFrame({"zip": ["a", None, "b"]}), [1, 0, 0], ["zip"])
+    second = EncoderStatistics.from_data(
+        pd.DataFrame({"zip": ["b", "c", None]}), [1, 1, 1], ["zip"])
+    merged = first.merge(second)
+    assert merged.categories[0].tolist() == ["a", "b", "c", None]
+    assert merged.counts[0].tolist() == [1, 2, 1, 2]
+    assert merged.sums[0].tolist() == [1, 1, 1, 1]
+    with pytest.raises(ValueError, match="different columns"):
+        first.merge(EncoderStatistics.from_data(
+            pd.DataFrame({"mcc": [1]}), [0], ["mcc"]))
@@ -0,0 +1,46 @@
+""" The streaming ingest and its Parquet cache. """
+import polars as pl
+
+from benchmarks.synthetic import generate_transactions
+from util.ingest import (
+    SOURCE_SCHEMA,
+    cache_path,
+    ingest_csv,
+    list_partitions,
+    load_cached,
+)
+from util.preprocessing import preprocess_dataset
+
+
+def write_csv(path, rows, seed=0):
+    generate_transactions(rows, fraud_rate=0.2, seed=seed).write_csv(path)
+    return path
+
+
+def test_matches_eager_preprocessing(tmp_path):
+    source = write_csv(tmp_path / "transactions.csv", 500)
+    path = ingest_csv(source, tmp_path / "cache")
+    expected = preprocess_dataset(
+        pl.read_csv(source, dtypes=SOURCE_SCHEMA), include_target=True)
+    assert load_cached(path).equals(expected)
+
+
+def test_cache_reused_until_source_changes(tmp_path):
+    source = write_csv(tmp_path / "transactions.csv", 100)
+    path = ingest_csv(source, tmp_path / "cache")
+    modified = path.stat().st_mtime_ns
+    assert ingest_csv(source, tmp_path / "cache") == path
+    assert path.stat().st_mtime_ns == modified
+    assert not list((tmp_path / "cache").glob("*.partial"))
+
+    write_csv(source, 100, seed=1)
+    assert cache_path(source, tmp_path / "cache") != path
+    assert len(load_cached(ingest_csv(source, tmp_path / "cache"))) == 100
+
+
+def test_partitions_in_name_order(tmp_path):
+    for name in ("b.csv", "a.csv", "notes.txt"):
+        (tmp_path / name).write_text("")
+    assert list_partitions(tmp_path) == [tmp_path / "a.csv",
+                                         tmp_path / "b.csv"]
+    assert list_partitions(tmp_path / "a.csv") == [tmp_path / "a.csv"]
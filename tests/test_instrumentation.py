@@ -0,0 +1,75 @@
+""" Per-stage latency instrumentation. """
+import pickle
+
+import numpy as np
+import pytest
+from prometheus_client import CollectorRegistry, Histogram
+
+from util.compiled_pipeline import compile_pipeline
+from util.instrumentation import (
+    PrometheusStages,
+    StageProfile,
+    StageRecorder,
+    batch_size_label,
+    timed,
+    timed_predict_proba,
+    track_resources,
+)
+
+
+def test_batch_size_label():
+    assert [batch_size_label(size) for size in (0, 1, 2, 10, 11, 1_000)] == [
+        "1", "1", "<=10", "<=10", "<=100", "<=1000"]
+
+
+@pytest.mark.parametrize("compiled", [False, True])
+def test_timed_predict_proba(pipeline, score_df, compiled):
+    model = compile_pipeline(pipeline) if compiled else pipeline
+    profile = StageProfile()
+    np.testing.assert_allclose(
+        timed_predict_proba(model, score_df, len(score_df), profile),
+        pipeline.predict_proba(score_df))
+    stages = {stage for stage, _ in profile.timings}
+    assert {"target_encoding", "scaling", "forest"} <= stages
+    assert {batch for _, batch in profile.timings} == {"<=1000"}
+
+
+def test_no_recorder_times_nothing():
+    with timed(None, "stage", 1):
+        pass
+    assert StageProfile(sample_rate=0.0).sample() is None
+    profile = StageProfile()
+    assert profile.sample() is profile
+    with pytest.raises(TypeError, match="record"):
+        StageRecorder()
+
+
+def test_profile_merges_across_processes():
+    worker = StageProfile()
+    worker.record("forest", 10, 0.5)
+    profile = StageProfile()
+    profile.record("forest", 10, 0.25)
+    profile.merge(pickle.loads(pickle.dumps(worker)))  # noqa: S301
+    row, = profile.summary()
+    assert row["stage"] == "forest"
+    assert row["count"] == 2
+    assert row["total_ms"] == pytest.approx(750)
+    assert "forest" in profile.format_summary()
+
+
+def test_prometheus_stages():
+    registry = CollectorRegistry()
+    histogram = Histogram("stage_seconds", "Stages", ["stage", "batch_size"],
+                          registry=registry)
+    with timed(PrometheusStages(histogram), "response", 5):
+        pass
+    assert registry.get_sample_value(
+        "stage_seconds_count", {"stage": "response", "batch_size": "<=10"}
+    ) == 1
+
+
+def test_track_resources():
+    with track_resources() as usage:
+        np.ones(1_000_000).sum()
+    assert usage["seconds"] > 0
+    assert usage["peak_memory_mb"] >= 0
@@ -0,0 +1,59 @@
+""" Memory-mapped compiled engines and the loaders picking them up. """
+import json
+
+import joblib
+import numpy as np
+import pytest
+
+from service.model_versions import load_engine
+from util.compiled_pipeline import (
+    FOREST_ARRAYS,
+    MANIFEST,
+    CompiledPipeline,
+    compile_pipeline,
+)
+from util.is_fraud import load_model
+
+
+@pytest.fixture(scope="module")
+def engine_dir(pipeline, tmp_path_factory):
+    path = tmp_path_factory.mktemp("engine")
+    compile_pipeline(pipeline).save(path)
+    return path
+
+
+def test_arrays_memory_mapped_read_only(engine_dir):
+    engine = CompiledPipeline.load(engine_dir)
+    for name in FOREST_ARRAYS:
+        array = getattr(engine, name)
+        assert isinstance(array, np.memmap)
+        assert not array.flags.writeable
+
+
+def test_unsupported_version_refused(engine_dir, tmp_path):
+    for path in engine_dir.iterdir():
+        (tmp_path / path.name).write_bytes(path.read_bytes())
+    manifest = json.loads((tmp_path / MANIFEST).read_text())
+    manifest["version"] = 99
+    (tmp_path / MANIFEST).write_text(json.dumps(manifest))
+    with pytest.raises(ValueError, match="version 99"):
+        CompiledPipeline.load(tmp_path)
+
+
+def test_load_model(pipeline, engine_dir, score_df, tmp_path):
+    joblib.dump(pipeline, tmp_path / "pipeline.joblib")
+    expected = pipeline.predict_proba(score_df)
+    for model in (load_model(engine_dir),
+                  load_model(str(tmp_path / "pipeline.joblib"))):
+        assert isinstance(model, CompiledPipeline)
+        np.testing.assert_allclose(model.predict_proba(score_df), expected)
+    assert not isinstance(
+        load_model(str(tmp_path / "pipeline.joblib"), compiled=False),
+        CompiledPipeline)
+
+
+def test_bento_model_maps_its_engine(bento_model, pipeline, score_df):
+    engine = load_engine(bento_model)
+    assert isinstance(engine.threshold, np.memmap)
+    np.testing.assert_allclose(engine.predict_proba(score_df),
+                               pipeline.predict_proba(score_df))
@@ -0,0 +1,93 @@
+""" Hot-swapping the runner's model and scoring candidates in shadow. """
+import numpy as np
+import pytest
+
+from benchmarks.compiled_pipeline import train_pipeline
+from service.fraud_detection_runner import FraudDetectionModelRunner
+from util.compiled_pipeline import compile_pipeline
+
+
+@pytest.fixture(scope="module")
+def candidate():
+    return train_pipeline(2_000, n_estimators=3, max_depth=4, n_jobs=1)
+
+
+@pytest.fixture(scope="module")
+def candidate_model(candidate):
+    import bentoml
+
+    from service.model_versions import COMPILED_MODEL_DIR
+
+    model = bentoml.sklearn.save_model("fraud-detection-candidate", candidate)
+    compile_pipeline(candidate).save(model.path_of(COMPILED_MODEL_DIR))
+    return model
+
+
+def score(runner, data):
+    return FraudDetectionModelRunner.is_fraud.func(runner, data)[
+        "is_fraud_proba"].to_numpy()
+
+
+def test_swap_model(bento_model, candidate_model, pipeline, candidate,
+                    score_df):
+    runner = FraudDetectionModelRunner(bento_model)
+    np.testing.assert_allclose(score(runner, score_df),
+                               pipeline.predict_proba(score_df)[:, 1])
+    status = FraudDetectionModelRunner.swap_model.func(
+        runner, str(candidate_model.tag))
+    assert status["active"] == str(candidate_model.tag)
+    assert status["generation"] == 1
+    np.testing.assert_allclose(score(runner, score_df),
+                               candidate.predict_proba(score_df)[:, 1])
+    # Swapping to the active version does nothing.
+    assert FraudDetectionModelRunner.swap_model.func(
+        runner, str(candidate_model.tag))["generation"] == 1
+    FraudDetectionModelRunner.swap_model.func(runner, str(bento_model.tag))
+    assert sorted(runner.models) == [1, 2]
+
+
+def test_fraud_proba_scores_each_generation(bento_model, candidate_model,
+                                            pipeline, candidate, score_df):
+    runner = FraudDetectionModelRunner(bento_model)
+    old_features = runner.active.engine.transform(score_df)
+    FraudDetectionModelRunner.swap_model.func(runner,
+                                              str(candidate_model.tag))
+    new_features = runner.active.engine.transform(score_df)
+
+    def tagged(features, generation):
+        return np.column_stack(
+            [features, np.full(len(features), generation, features.dtype)])
+
+    features = np.concatenate([tagged(old_features[:50], 0),
+                               tagged(new_features[50:], 1)])
+    result = FraudDetectionModelRunner.fraud_proba.func(runner, features)
+    expected = np.concatenate([pipeline.predict_proba(score_df)[:50, 1],
+                               candidate.predict_proba(score_df)[50:, 1]])
+    np.testing.assert_allclose(result[:, 0], expected, atol=1e-6)
+    assert (result[:, 1] == 1).all()
+
+    # Generations no longer kept get no probability.
+    FraudDetectionModelRunner.swap_model.func(runner, str(bento_model.tag))
+    result = FraudDetectionModelRunner.fraud_proba.func(
+        runner, tagged(old_features, 0))
+    assert np.isnan(result[:, 0]).all()
+    assert (result[:, 1] == 2).all()
+
+
+def test_shadow_scoring(bento_model, candidate_model, pipeline, candidate,
+                        score_df):
+    runner = FraudDetectionModelRunner(
+        bento_model, shadow_tag=str(candidate_model.tag))
+    score(runner, score_df.head(120))
+    score(runner, score_df.tail(80))
+    runner.shadow_executor.shutdown(wait=True)
+    stats = FraudDetectionModelRunner.model_status.func(runner)["shadow"]
+    assert stats["candidate"] == str(candidate_model.tag)
+    assert stats["active"] == str(bento_model.tag)
+    assert (stats["batches"], stats["transactions"]) == (2, 200)
+    divergence = np.abs(pipeline.predict_proba(score_df)[:, 1]
+                        - candidate.predict_proba(score_df)[:, 1])
+    assert stats["max_divergence"] == pytest.approx(divergence.max())
+    assert stats["mean_divergence"] == pytest.approx(divergence.mean())
+    assert FraudDetectionModelRunner.set_shadow.func(runner, "")[
+        "shadow"] is None
@@ -0,0 +1,60 @@
+""" The runner's prediction cache. """
+import numpy as np
+import pandas as pd
+
+from service.fraud_detection_runner import FraudDetectionModelRunner
+from service.prediction_cache import PredictionCache, key_columns, row_keys
+from util.compiled_pipeline import compile_pipeline
+
+
+def test_lru_eviction():
+    cache = PredictionCache(max_entries=2, ttl_seconds=60)
+    cache.store(["a", "b"], np.array([0.1, 0.2]))
+    cache.lookup(["a"])
+    cache.store(["c"], np.array([0.3]))
+    probabilities, missing = cache.lookup(["a", "b", "c"])
+    assert missing.tolist() == [False, True, False]
+    np.testing.assert_array_equal(probabilities[[0, 2]], [0.1, 0.3])
+    assert cache.evictions == 1
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_expired_entries_miss():
+    cache = PredictionCache(max_entries=10, ttl_seconds=0)
+    cache.store(["a"], np.array([0.5]))
+    _, missing = cache.lookup(["a"])
+    assert missing.tolist() == [True]
+    assert len(cache) == 0
+
+
+def test_keys_are_canonical(pipeline, score_df):
+    columns = key_columns(compile_pipeline(pipeline))
+    assert set(columns) <= set(score_df.columns)
+    assert columns["Zip"] is True
+    assert columns["Amount"] is False
+    row = score_df[score_df["Zip"] != "ONLINE"].head(1)
+    spellings = pd.concat([row] * 3, ignore_index=True)
+    spellings["Zip"] = spellings["Zip"].astype(object)
+    zip_code = int(float(row["Zip"].iloc[0]))
+    spellings.loc[:, "Zip"] = [zip_code, float(zip_code), f"{zip_code}.0"]
+    keys = row_keys(columns, spellings, "model:1")
+    assert keys[0] == keys[1] == keys[2]
+    assert keys[0][0] == "model:1"
+    assert row_keys(columns, spellings, "model:2")[0] != keys[0]
+
+
+def test_runner_answers_retries_from_the_cache(bento_model, pipeline,
+                                               score_df):
+    runner = FraudDetectionModelRunner(bento_model, cache_size=1_000)
+    batch = score_df.head(40)
+    first = FraudDetectionModelRunner.is_fraud.func(runner, batch)
+    retried = FraudDetectionModelRunner.is_fraud.func(
+        runner, pd.concat([batch.iloc[10:20], score_df.iloc[40:50],
+                           batch.iloc[10:20]]))
+    assert (runner.cache.hits, runner.cache.misses) == (20, 50)
+    np.testing.assert_array_equal(retried["is_fraud_proba"].to_numpy()[:10],
+                                  first["is_fraud_proba"].to_numpy()[10:20])
+    np.testing.assert_allclose(
+        retried["is_fraud_proba"],
+        pipeline.predict_proba(retried.drop(
+            columns=["is_fraud_proba", "is_legit_proba", "is_fraud"]))[:, 1])
@@ -0,0 +1,45 @@
+""" The shared preprocessing matches the original per-row code. """
+import polars as pl
+
+from benchmarks.preprocessing import legacy_preprocess_dataset, sample_dataset
+from benchmarks.synthetic import generate_transactions
+from util.preprocessing import preprocess_dataset
+
+
+def test_matches_legacy_on_sample():
+    data_df = sample_dataset(500)
+    assert preprocess_dataset(data_df, include_target=True).equals(
+        legacy_preprocess_dataset(data_df))
+
+
+def test_matches_legacy_on_synthetic():
+    data_df = generate_transactions(1_000, fraud_rate=0.2)
+    assert preprocess_dataset(data_df, include_target=True).equals(
+        legacy_preprocess_dataset(data_df))
+
+
+def test_values():
+    data_df = pl.DataFrame({
+        "Time": ["07:05", "23:59"],
+        "Amount": ["$12.50", "$-3.00"],
+        "Merchant State": ["CA", None],
+        "Zip": [91750.0, None],
+        "Errors?": [None, "Bad PIN"],
+        "Is Fraud?": ["No", "Yes"],
+    })
+    result = preprocess_dataset(data_df, include_target=True)
+    assert "Time" not in result.columns
+    assert result["Hour"].to_list() == [7, 23]
+    assert result["Minute"].to_list() == [5, 59]
+    assert result["Amount"].to_list() == [12.5, -3.0]
+    assert result["Merchant State"].to_list() == ["CA", "ONLINE"]
+    assert result["Zip"].to_list() == ["91750.0", "ONLINE"]
+    assert result["Errors?"].to_list() == ["No", "Bad PIN"]
+    assert result["Is Fraud?"].to_list() == [0, 1]
+
+
+def test_lazy_input_stays_lazy():
+    data_df = generate_transactions(10)
+    plan = preprocess_dataset(data_df.lazy())
+    assert isinstance(plan, pl.LazyFrame)
+    assert plan.collect().equals(preprocess_dataset(data_df))
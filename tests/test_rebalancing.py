@@ -0,0 +1,78 @@
+""" Class rebalancing strategies. """
+import numpy as np
+import pytest
+
+from benchmarks.rebalancing import split
+from util.rebalancing import (
+    budget_rows,
+    dropped_majority_rows,
+    majority_budget,
+    rebalance,
+)
+
+
+@pytest.fixture(scope="module")
+def train():
+    train_x, train_y, _, _ = split(2_000, fraud_rate=0.05)
+    return train_x, train_y
+
+
+def class_counts(labels):
+    return np.bincount(np.asarray(labels, dtype=np.int64), minlength=2)
+
+
+@pytest.mark.parametrize("strategy", ["smote", "chunked_smote"])
+def test_smote_balances_the_classes(train, strategy):
+    train_x, train_y = train
+    rebalanced_x, rebalanced_y, fit_params = rebalance(train_x, train_y,
+                                                       strategy)
+    legit, fraud = class_counts(rebalanced_y)
+    assert legit == class_counts(train_y.to_series())[0]
+    assert fraud == pytest.approx(legit, rel=0.05)
+    assert list(rebalanced_x.columns) == train_x.columns
+    assert len(rebalanced_x) == len(rebalanced_y)
+    assert fit_params == {}
+
+
+def test_chunked_smote_drops_majority_rows_over_budget(train, capsys):
+    train_x, train_y = train
+    budget_mb = 0.05
+    kept = majority_budget(train_x, budget_mb)
+    dropped = dropped_majority_rows(train_x, train_y, budget_mb)
+    legit = class_counts(train_y.to_series())[0]
+    assert 0 < kept < legit
+    assert dropped == legit - kept
+    _, rebalanced_y, _ = rebalance(train_x, train_y, "chunked_smote",
+                                   memory_budget_mb=budget_mb)
+    assert class_counts(rebalanced_y)[0] == kept
+    assert f"dropping {dropped} of its {legit} rows" in capsys.readouterr().out
+    assert dropped_majority_rows(train_x, train_y, 4096) == 0
+
+
+def test_undersample(train):
+    train_x, train_y = train
+    fraud = class_counts(train_y.to_series())[1]
+    _, rebalanced_y, _ = rebalance(train_x, train_y, "undersample",
+                                   majority_ratio=2.0)
+    assert class_counts(rebalanced_y).tolist() == [2 * fraud, fraud]
+
+
+def test_class_weight(train):
+    train_x, train_y = train
+    rebalanced_x, labels, fit_params = rebalance(train_x, train_y,
+                                                 "class_weight")
+    assert len(rebalanced_x) == len(train_x)
+    weights = fit_params["model__sample_weight"]
+    counts = class_counts(labels)
+    # Both classes weigh the same in total.
+    assert weights[labels == 1].sum() == pytest.approx(
+        weights[labels == 0].sum())
+    assert weights[labels == 1][0] > weights[labels == 0][0]
+    assert counts.sum() == len(weights)
+
+
+def test_budget_rows_and_unknown_strategy(train):
+    train_x, train_y = train
+    assert budget_rows(train_x, 4096) > len(train_x)
+    with pytest.raises(ValueError, match="Unknown rebalancing strategy"):
+        rebalance(train_x, train_y, "oversample")
@@ -0,0 +1,45 @@
+""" The micro-batching runner's is_fraud method. """
+import numpy as np
+import pandas as pd
+import pytest
+
+from service.fraud_detection_runner import FraudDetectionModelRunner
+
+
+def is_fraud(runner, input_df):
+    return FraudDetectionModelRunner.is_fraud.func(runner, input_df)
+
+
+@pytest.fixture(scope="module")
+def runner(bento_model):
+    return FraudDetectionModelRunner(bento_model)
+
+
+def test_is_fraud_is_batchable_along_rows():
+    config = FraudDetectionModelRunner.is_fraud.config
+    assert config.batchable
+    assert config.batch_dim == (0, 0)
+
+
+def test_scores_with_the_pipeline(runner, pipeline, score_df):
+    result = is_fraud(runner, score_df)
+    expected = pipeline.predict_proba(score_df)[:, 1]
+    np.testing.assert_allclose(result["is_fraud_proba"], expected)
+    np.testing.assert_allclose(result["is_legit_proba"], 1 - expected)
+    np.testing.assert_array_equal(result["is_fraud"],
+                                  pipeline.predict(score_df))
+
+
+def test_merged_batch_matches_separate_requests(runner, score_df):
+    first, second = score_df.iloc[:30], score_df.iloc[30:50]
+    merged = is_fraud(runner, pd.concat([first, second]))
+    separate = pd.concat([is_fraud(runner, first), is_fraud(runner, second)])
+    pd.testing.assert_frame_equal(merged, separate)
+
+
+def test_input_left_untouched(runner, score_df):
+    input_df = score_df.head(10).copy()
+    result = is_fraud(runner, input_df)
+    pd.testing.assert_frame_equal(input_df, score_df.head(10))
+    assert list(result.columns) == [*score_df.columns, "is_fraud_proba",
+                                    "is_legit_proba", "is_fraud"]
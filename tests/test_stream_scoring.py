@@ -0,0 +1,94 @@
+""" The asynchronous JSONL streaming scorer. """
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from util.batch_scoring import PREDICTION_COLUMN, PROBABILITY_COLUMN
+from util.compiled_pipeline import compile_pipeline
+from util.stream_scoring import (
+    load_checkpoint,
+    parse_records,
+    save_checkpoint,
+    score_lines,
+    score_stream,
+)
+
+
+@pytest.fixture(scope="module")
+def engine(pipeline):
+    return compile_pipeline(pipeline)
+
+
+@pytest.fixture(scope="module")
+def feed(raw_df):
+    return [json.dumps({"id": idx, **record}).encode()
+            for idx, record in enumerate(raw_df.head(60).to_dicts())]
+
+
+@pytest.fixture(scope="module")
+def expected(pipeline, score_df):
+    return pipeline.predict_proba(score_df.head(60))[:, 1]
+
+
+def read_jsonl(path):
+    with open(path) as output:
+        return [json.loads(line) for line in output]
+
+
+def test_score_lines_keeps_other_fields(engine, feed, expected):
+    scored = [json.loads(line)
+              for line in score_lines(feed[:5], engine).splitlines()]
+    assert [record["id"] for record in scored] == list(range(5))
+    np.testing.assert_allclose(
+        [record[PROBABILITY_COLUMN] for record in scored], expected[:5])
+    assert all(record[PREDICTION_COLUMN] in (0, 1) for record in scored)
+
+
+def test_bad_records_get_an_error(engine, feed):
+    bad = json.dumps({"id": "bad", "Amount": 12}).encode()
+    scored = [json.loads(line) for line
+              in score_lines([feed[0], bad, feed[1]], engine).splitlines()]
+    assert [record.get("id") for record in scored] == [0, None, 1]
+    assert scored[1]["error"].startswith("TypeError: Amount")
+    assert json.loads(scored[1]["record"])["id"] == "bad"
+
+
+def test_parse_records_refuses_other_json_types():
+    with pytest.raises(TypeError, match="Card"):
+        parse_records([b'{"Card": true}'])
+    _, data_df = parse_records([b'{"Zip": 94107}'])
+    assert data_df["Zip"].to_list() == [94107.0]
+
+
+def test_score_stream_resumes_from_its_checkpoint(engine, feed, expected,
+                                                  tmp_path):
+    source, output = tmp_path / "feed.jsonl", tmp_path / "scored.jsonl"
+    checkpoint = tmp_path / "scored.checkpoint"
+    source.write_bytes(b"\n".join(feed[:40]) + b"\n")
+    written = asyncio.run(score_stream(
+        str(source), str(output), engine, batch_size=7, workers=3,
+        checkpoint=str(checkpoint)))
+    assert written == 40
+    assert load_checkpoint(str(checkpoint), str(source)) == (
+        source.stat().st_size)
+
+    with open(source, "ab") as source_file:
+        source_file.write(b"\n".join(feed[40:]))
+    assert asyncio.run(score_stream(
+        str(source), str(output), engine, batch_size=7,
+        checkpoint=str(checkpoint))) == 20
+    scored = read_jsonl(output)
+    assert [record["id"] for record in scored] == list(range(60))
+    np.testing.assert_allclose(
+        [record[PROBABILITY_COLUMN] for record in scored], expected)
+
+
+def test_checkpoint_of_another_source(tmp_path):
+    checkpoint = str(tmp_path / "checkpoint")
+    assert load_checkpoint(checkpoint, "feed.jsonl") == 0
+    save_checkpoint(checkpoint, "feed.jsonl", 42)
+    assert load_checkpoint(checkpoint, "feed.jsonl") == 42
+    with pytest.raises(ValueError, match="other.jsonl"):
+        load_checkpoint(checkpoint, "other.jsonl")
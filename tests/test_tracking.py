@@ -0,0 +1,98 @@
+""" Journaled tracking calls replayed into an mlflow file store. """
+import json
+
+import pytest
+
+from util import tracking
+
+
+@pytest.fixture
+def journal(tmp_path, monkeypatch):
+    """ Journal offline, yielding the directory and a file store URI. """
+    monkeypatch.setattr(tracking, "_tracker", None)
+    directory = tmp_path / "tracking"
+    tracking_uri = f"file:{tmp_path}/mlruns"
+    tracker = tracking.configure(directory, tracking_uri, offline=True)
+    yield directory, tracking_uri
+    tracker.close()
+
+
+def server_runs(tracking_uri, experiment):
+    from mlflow import MlflowClient
+
+    client = MlflowClient(tracking_uri)
+    experiment_id = client.get_experiment_by_name(experiment).experiment_id
+    return client, {run.info.run_name: run for run in client.search_runs(
+        [experiment_id])}
+
+
+def test_batch_chunks_stay_within_the_limits():
+    params = [(f"p{index}", "1") for index in range(250)]
+    metrics = [(f"m{index}", 1.0, 0, 0) for index in range(2_500)]
+    chunks = tracking.batch_chunks(params, metrics)
+    for chunk_params, chunk_metrics in chunks:
+        assert len(chunk_params) <= tracking.MAX_BATCH_PARAMS
+        assert len(chunk_metrics) <= tracking.MAX_BATCH_METRICS
+        assert (len(chunk_params) + len(chunk_metrics)
+                <= tracking.MAX_BATCH_ENTITIES)
+    assert [param for chunk, _ in chunks for param in chunk] == params
+    assert [metric for _, chunk in chunks for metric in chunk] == metrics
+    assert tracking.batch_chunks([], []) == []
+
+
+def test_offline_calls_are_journaled(journal):
+    directory, _ = journal
+    with tracking.start_run(experiment="/tests") as run_id:
+        tracking.log_params({"alpha": 1})
+        tracking.log_metrics({"recall": 0.5})
+    tracking.log_param("outside", "ignored")
+    journal_file, = (directory / "journal").iterdir()
+    entries = [json.loads(line) for line in journal_file.read_text()
+               .splitlines()]
+    assert [entry["op"] for entry in entries] == [
+        "create_run", "log_batch", "log_batch", "end_run"]
+    assert {entry["run"] for entry in entries} == {run_id}
+    assert entries[1]["params"] == {"alpha": "1"}
+    assert not (directory.parent / "mlruns").exists()
+
+
+def test_replay_sends_everything_once(journal):
+    directory, tracking_uri = journal
+    params = {f"param{index}": index for index in range(150)}
+    with tracking.start_run(run_name="parent", experiment="/tests"):
+        with tracking.start_run(run_name="trial", nested=True):
+            tracking.log_params(params)
+            tracking.log_metrics({"recall": 0.5}, step=1)
+        tracking.log_dict({"trials": 1}, "summary.json")
+    with pytest.raises(KeyError), tracking.start_run(run_name="failed",
+                                                     experiment="/tests"):
+        raise KeyError("trial")
+
+    assert tracking.replay(directory, tracking_uri) > 0
+    assert tracking.replay(directory, tracking_uri) == 0
+    client, runs = server_runs(tracking_uri, "/tests")
+    assert sorted(runs) == ["failed", "parent", "trial"]
+    trial, parent = runs["trial"], runs["parent"]
+    assert trial.data.params == {key: str(value)
+                                 for key, value in params.items()}
+    assert trial.data.metrics == {"recall": 0.5}
+    assert trial.data.tags["mlflow.parentRunId"] == parent.info.run_id
+    assert trial.info.status == "FINISHED"
+    assert runs["failed"].info.status == "FAILED"
+    assert [artifact.path for artifact
+            in client.list_artifacts(parent.info.run_id)] == ["summary.json"]
+
+
+def test_replay_resumes_a_run(journal):
+    directory, tracking_uri = journal
+    with tracking.start_run(run_name="run", experiment="/tests") as run_id:
+        tracking.log_params({"alpha": 1})
+    tracking.replay(directory, tracking_uri)
+    with tracking.start_run(run_id=run_id):
+        tracking.log_metrics({"recall": 0.75})
+    assert tracking.replay(directory, tracking_uri) == 2
+    _, runs = server_runs(tracking_uri, "/tests")
+    assert list(runs) == ["run"]
+    assert runs["run"].data.params == {"alpha": "1"}
+    assert runs["run"].data.metrics == {"recall": 0.75}
+    assert runs["run"].data.tags[tracking.LOCAL_RUN_ID_TAG] == run_id
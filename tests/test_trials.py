@@ -0,0 +1,55 @@
+""" Hyperparameter search trials. """
+import pytest
+
+from util.compiled_pipeline import compile_pipeline
+from util.trials import (
+    expand_search_space,
+    model_size_mb,
+    select_best,
+    serving_profile,
+)
+
+
+def test_expand_grid():
+    trials = expand_search_space({"n_estimators": [10, 50],
+                                  "max_depth": [None, 20],
+                                  "rebalance": "undersample"})
+    assert len(trials) == 4
+    assert {"n_estimators": 50, "max_depth": None,
+            "rebalance": "undersample"} in trials
+    assert expand_search_space({}) == [{}]
+
+
+def test_expand_samples_a_seeded_subset():
+    search_space = {"n_estimators": [1, 2, 3, 4], "max_depth": [5, 6, 7]}
+    trials = expand_search_space(search_space, max_trials=5, seed=1)
+    assert len(trials) == 5
+    assert trials == expand_search_space(search_space, max_trials=5, seed=1)
+    assert all(trial in expand_search_space(search_space)
+               for trial in trials)
+
+
+def test_expand_refuses_unknown_parameters():
+    with pytest.raises(ValueError, match="criterion"):
+        expand_search_space({"criterion": ["gini"]})
+
+
+def test_select_best():
+    results = [
+        {"validate_recall": 0.90, "serving_p50_ms": 0.5, "model_size_mb": 9},
+        {"validate_recall": 0.89, "serving_p50_ms": 0.2, "model_size_mb": 5},
+        {"validate_recall": 0.89, "serving_p50_ms": 0.2, "model_size_mb": 3},
+        {"validate_recall": 0.80, "serving_p50_ms": 0.1, "model_size_mb": 1},
+    ]
+    assert select_best(results) == 0
+    assert select_best(results, recall_tolerance=0.02) == 2
+    assert select_best(results, recall_tolerance=0.2) == 3
+
+
+def test_serving_profile(pipeline, score_df):
+    profile = serving_profile(pipeline, score_df, repeat=20, batch_size=50)
+    engine = compile_pipeline(pipeline)
+    assert profile["node_count"] == len(engine.left)
+    assert profile["model_size_mb"] == model_size_mb(engine) > 0
+    assert 0 < profile["serving_p50_ms"] <= profile["serving_p99_ms"]
+    assert profile["serving_batch_ms"] > 0
@@ -0,0 +1,170 @@
+""" Per-card velocity features, backfilled and streamed. """
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from benchmarks.synthetic import generate_transactions
+from benchmarks.velocity import assert_equal_features, busy_transactions
+from service.fraud_detection_runner import FraudDetectionModelRunner
+from util.categories import (
+    encode_categories,
+    extend_dictionaries,
+    inference_pipeline,
+)
+from util.compiled_pipeline import compile_pipeline
+from util.is_fraud import predict_file, predict_transaction
+from util.preprocessing import preprocess_dataset
+from util.velocity import (
+    VELOCITY_COLUMNS,
+    VelocityStore,
+    backfill,
+    event_minutes,
+    missing_velocity_columns,
+    require_velocity_columns,
+)
+
+
+@pytest.fixture(scope="module")
+def busy_df():
+    return busy_transactions(3_000, users=20)
+
+
+@pytest.fixture(scope="module")
+def velocity_pipeline():
+    """ A small pipeline reading the velocity features, fitted like the
+    flow does with ``--velocity-features``.
+    """
+    from feature_pipeline import build_pipeline
+
+    data_df = backfill(preprocess_busy(
+        generate_transactions(3_000, fraud_rate=0.1, users=20),
+        include_target=True), by_time=True)
+    dictionaries = extend_dictionaries(data_df)
+    data_df = encode_categories(data_df, dictionaries).to_pandas()
+    pipeline = build_pipeline(n_estimators=5, max_depth=6, n_jobs=1,
+                              velocity=True)
+    pipeline.set_params(model__verbose=0)
+    pipeline.fit(data_df.drop(columns="Is Fraud?"),
+                 data_df["Is Fraud?"].to_numpy())
+    return inference_pipeline(pipeline, dictionaries)
+
+
+@pytest.fixture(scope="module")
+def velocity_model(velocity_pipeline):
+    """ The velocity pipeline imported into bentoml. """
+    import bentoml
+
+    from service.model_versions import COMPILED_MODEL_DIR
+
+    model = bentoml.sklearn.save_model("fraud-detection-velocity",
+                                       velocity_pipeline)
+    compile_pipeline(velocity_pipeline).save(
+        model.path_of(COMPILED_MODEL_DIR))
+    return model
+
+
+def preprocess_busy(data_df, include_target=False):
+    """ Preprocess transactions packed into one month. """
+    return preprocess_dataset(data_df.with_columns(
+        pl.lit(2019).alias("Year"), pl.lit(1).alias("Month")),
+        include_target=include_target)
+
+
+def test_backfill_matches_the_store(busy_df):
+    assert_equal_features(backfill(busy_df), VelocityStore().features(
+        busy_df))
+    order = np.argsort(event_minutes(busy_df), kind="stable")
+    assert_equal_features(backfill(busy_df, by_time=True)[order],
+                          VelocityStore().features(busy_df[order]))
+    features = backfill(busy_df)
+    assert features.drop(VELOCITY_COLUMNS).equals(busy_df)
+    assert (features["Card Transactions 24h"]
+            >= features["Card Merchants 24h"]).all()
+    assert (features["Card Minutes Since Last"] <= 24 * 60).all()
+
+
+def test_store_windows():
+    store = VelocityStore()
+    assert store.update(1, 0, 0, 1_000, 7) == (1, 10.0, 1, 10.0, 1, 1_440)
+    assert store.update(1, 0, 30, 250, 7) == (2, 12.5, 2, 12.5, 1, 30)
+    # Windows hold the transactions less than an hour or a day old.
+    assert store.update(1, 0, 90, 100, 8) == (1, 1.0, 3, 13.5, 2, 60)
+    # Late transactions count as happening at the card's latest time.
+    assert store.update(1, 0, 10, 100, 9) == (2, 2.0, 4, 14.5, 3, 0)
+    assert store.update(1, 0, 90 + 1_440, 100, 9) == (1, 1.0, 1, 1.0, 1,
+                                                      1_440)
+    assert store.update(2, 0, 0, 100, 7)[0] == 1
+    assert len(store) == 2
+
+
+def test_snapshot_restores_the_history(busy_df, tmp_path):
+    store = VelocityStore()
+    store.features(busy_df)
+    path = tmp_path / "velocity.npz"
+    store.snapshot(str(path))
+    restored = VelocityStore.restore(str(path))
+    assert len(restored) == len(store)
+    more_df = busy_transactions(500, users=20, seed=1)
+    assert_equal_features(store.features(more_df),
+                          restored.features(more_df))
+
+
+def test_offline_scorers_need_the_features(velocity_pipeline, pipeline,
+                                           busy_df):
+    engine = compile_pipeline(velocity_pipeline)
+    columns = busy_df.columns
+    assert missing_velocity_columns(velocity_pipeline, columns) == list(
+        VELOCITY_COLUMNS)
+    assert missing_velocity_columns(engine, columns) == list(
+        VELOCITY_COLUMNS)
+    assert missing_velocity_columns(pipeline, columns) == []
+    assert missing_velocity_columns(engine, backfill(busy_df).columns) == []
+    with pytest.raises(ValueError, match="Card Amount 1h"):
+        require_velocity_columns(engine, columns, "Batch scoring")
+    with pytest.raises(ValueError, match="Transaction scoring"):
+        predict_transaction(engine, busy_df.head(1).to_pandas())
+
+
+def test_predict_file_backfills(velocity_pipeline):
+    raw_df = generate_transactions(300, users=20, seed=2).drop("Is Fraud?")
+    expected = velocity_pipeline.predict(backfill(
+        preprocess_dataset(raw_df), by_time=True).to_pandas())
+    assert predict_file(velocity_pipeline, raw_df)[
+        "Predicted_Is_Fraud?"].to_list() == expected.tolist()
+
+
+def test_runner_counts_retries_once(velocity_model, velocity_pipeline,
+                                    busy_df):
+    runner = FraudDetectionModelRunner(velocity_model, cache_size=1_000)
+    assert runner.velocity is not None
+    first_df, more_df = (busy_df.head(40).to_pandas(),
+                         busy_df.slice(40, 10).to_pandas())
+    first = FraudDetectionModelRunner.is_fraud.func(runner, first_df)
+    retried = FraudDetectionModelRunner.is_fraud.func(
+        runner, pd.concat([first_df.iloc[10:20], more_df, more_df]))
+    assert (runner.cache.hits, runner.cache.misses) == (10, 60)
+
+    # Each transaction entered the card histories once, in arrival order.
+    expected = velocity_pipeline.predict_proba(
+        backfill(busy_df.head(50)).to_pandas())[:, 1]
+    np.testing.assert_allclose(first["is_fraud_proba"], expected[:40])
+    proba = retried["is_fraud_proba"].to_numpy()
+    np.testing.assert_array_equal(proba[:10], expected[10:20])
+    np.testing.assert_allclose(proba[10:20], expected[40:])
+    np.testing.assert_array_equal(proba[20:], proba[10:20])
+
+
+def test_runner_snapshots_off_the_request_path(velocity_model, busy_df,
+                                               tmp_path):
+    path = tmp_path / "velocity.npz"
+    runner = FraudDetectionModelRunner(
+        velocity_model, velocity_snapshot=str(path), snapshot_interval=0)
+    FraudDetectionModelRunner.is_fraud.func(runner,
+                                            busy_df.head(100).to_pandas())
+    runner.snapshot_executor.shutdown(wait=True)
+    restored = VelocityStore.restore(str(path))
+    assert len(restored) == len(runner.velocity)
+    more_df = busy_df.slice(100, 50)
+    assert_equal_features(runner.velocity.features(more_df),
+                          restored.features(more_df))
@@ -0,0 +1,117 @@
+""" Content-addressed storage of the DataFrames flow steps hand over.
+
+Metaflow pickles every DataFrame assigned to a step, then unpickles a full
+copy in every step reading it, every foreach branch included. Steps store
+their frames here instead, once, as Parquet files in a directory named after
+a key hashing everything the frames depend on: the source of the step and
+its helper modules, its parameters and the keys of its inputs. Only a small
+``StepArtifacts`` reference is passed between steps, and the frames are
+memory-mapped on read.
+
+A step finding its key already stored skips its work, so re-running the
+flow on unchanged data and code only redoes the steps downstream of what
+changed.
+"""
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from pathlib import Path
+
+import polars as pl
+
+from util.ingest import load_cached
+
+# Bump when the layout of stored artifacts changes.
+ARTIFACT_VERSION = 1
+
+
+def step_key(sources, inputs=(), parameters=None):
+    """ Return the key of a step's outputs.
+
+    ``sources`` are the step function and the modules whose code shapes its
+    outputs, ``inputs`` the keys or content-addressed paths of the data it
+    reads and ``parameters`` a JSON-serializable dict of its settings.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"v{ARTIFACT_VERSION}-polars{pl.__version__}".encode())
+    for source in sources:
+        digest.update(inspect.getsource(source).encode())
+    for key in inputs:
+        digest.update(str(key).encode())
+    digest.update(json.dumps(parameters or {}, sort_keys=True,
+                             default=str).encode())
+    return digest.hexdigest()
+
+
+class StepArtifacts:
+    """ Reference to the frames and metadata a step stored. """
+
+    def __init__(self, path, names, metadata=None):
+        self.path = str(path)
+        self.names = list(names)
+        self.metadata = metadata or {}
+
+    @property
+    def key(self):
+        """ The content key the artifacts are stored under. """
+        return Path(self.path).name
+
+    def frame_path(self, name):
+        """ Return the Parquet file of a stored frame. """
+        return Path(self.path) / f"{name}.parquet"
+
+    def load(self, name):
+        """ Memory-map a stored frame into a DataFrame. """
+        return load_cached(self.frame_path(name))
+
+
+def _manifest_path(path):
+    return Path(path) / "manifest.json"
+
+
+def find_artifacts(store_dir, step_name, key):
+    """ Return the artifacts a step stored under ``key``, or None. """
+    path = Path(store_dir) / step_name / key
+    if not _manifest_path(path).exists():
+        return None
+    manifest = json.loads(_manifest_path(path).read_text())
+    return StepArtifacts(path, manifest["frames"], manifest["metadata"])
+
+
+def store_artifacts(store_dir, step_name, key, frames, metadata=None,
+                    compression="zstd"):
+    """ Store a step's frames, a dict of polars DataFrames, and its
+    JSON-serializable metadata under ``key``.
+
+    The files are written to a temporary directory renamed once complete,
+    so an interrupted step never leaves partial artifacts behind.
+    """
+    path = Path(store_dir) / step_name / key
+    partial_path = path.with_name(f"{key}.partial-{os.getpid()}")
+    shutil.rmtree(partial_path, ignore_errors=True)
+    partial_path.mkdir(parents=True)
+    for name, frame in frames.items():
+        frame.write_parquet(partial_path / f"{name}.parquet",
+                            compression=compression)
+    _manifest_path(partial_path).write_text(json.dumps(
+        {"frames": list(frames), "metadata": metadata or {}}))
+    try:
+        os.replace(partial_path, path)
+    except OSError:
+        # Another run stored the same key first, its files are identical.
+        shutil.rmtree(partial_path, ignore_errors=True)
+    return find_artifacts(store_dir, step_name, key)
+
+
+def stored_step(store_dir, step_name, key, compute):
+    """ Return the artifacts a step stored under ``key``, calling
+    ``compute`` for its (frames, metadata) and storing them when missing.
+    """
+    artifacts = find_artifacts(store_dir, step_name, key)
+    if artifacts is not None:
+        print(f"Reusing {step_name} artifacts {key}")
+        return artifacts
+    frames, metadata = compute()
+    return store_artifacts(store_dir, step_name, key, frames, metadata)
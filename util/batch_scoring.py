@@ -0,0 +1,203 @@
+""" Chunked, parallel, bounded-memory scoring of transaction files.
+
+The CSV is read in chunks, each chunk is preprocessed and scored on a thread
+or process pool, and scored chunks are handed back in file order as soon as
+they are ready. Only a bounded number of chunks is in flight at any time, so
+memory stays flat however large the file is. Results can be streamed into a
+Parquet or CSV file. Run an offline backfill from the command line with:
+
+    python -m util.batch_scoring transactions.csv scored.parquet \
+--model model/compiled_pipeline
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import polars as pl
+
+from util.evaluation import predict_classes
+from util.ingest import SOURCE_SCHEMA
+from util.instrumentation import StageProfile, timed, timed_predict_proba
+from util.is_fraud import load_model
+from util.preprocessing import preprocess_dataset
+from util.velocity import require_velocity_columns
+
+PREDICTION_COLUMN = "Predicted_Is_Fraud?"
+PROBABILITY_COLUMN = "Is_Fraud_Proba"
+
+# Model loaded once per worker process when scoring on a process pool.
+_worker_model = None
+
+
+def load_worker_model(model_path):
+    """ Process pool initializer, load the model in the worker process. """
+    global _worker_model
+    _worker_model = load_model(model_path)
+
+
+def score_chunk(chunk_df, model=None, recorder=None):
+    """ Return a raw transactions chunk with its prediction columns added,
+    timing each stage with ``recorder`` if one is given. A model reading
+    velocity features needs them in the chunk, see
+    ``util.velocity.require_velocity_columns``.
+    """
+    model = _worker_model if model is None else model
+    batch_size = len(chunk_df)
+    with timed(recorder, "preprocess", batch_size):
+        data_df = preprocess_dataset(chunk_df)
+    require_velocity_columns(model, data_df.columns, "Batch scoring")
+    probabilities = timed_predict_proba(model, data_df, batch_size, recorder)
+    with timed(recorder, "response", batch_size):
+        fraud_index = list(model.classes_).index(1)
+        return chunk_df.with_columns(
+            pl.Series(PREDICTION_COLUMN,
+                      predict_classes(model, probabilities)),
+            pl.Series(PROBABILITY_COLUMN, probabilities[:, fraud_index]),
+        )
+
+
+def _score_chunk_task(chunk_df, model, profiled):
+    """ Score a chunk in a pool worker, returning its own profile so timings
+    also make it back from worker processes.
+    """
+    profile = StageProfile() if profiled else None
+    return score_chunk(chunk_df, model, profile), profile
+
+
+@contextmanager
+def spooled_csv(source):
+    """ Yield a path for the source CSV, spooling file objects to disk. """
+    if isinstance(source, (str, os.PathLike)):
+        yield source
+        return
+    with tempfile.NamedTemporaryFile(suffix=".csv") as spooled:
+        shutil.copyfileobj(source, spooled)
+        spooled.flush()
+        yield spooled.name
+
+
+def count_rows(source):
+    """ Count the transactions in a CSV path or file object. """
+    with spooled_csv(source) as path:
+        return pl.scan_csv(path).select(pl.len()).collect().item()
+
+
+def read_chunks(path, chunk_size):
+    """ Yield the CSV at ``path`` as DataFrames of about chunk_size rows. """
+    columns = pl.read_csv(path, n_rows=0).columns
+    reader = pl.read_csv_batched(
+        path,
+        batch_size=chunk_size,
+        dtypes={column: dtype for column, dtype in SOURCE_SCHEMA.items()
+                if column in columns},
+    )
+    while batches := reader.next_batches(1):
+        yield from batches
+
+
+def score_batches(source, model, chunk_size=50_000, workers=4,
+                  processes=False, profile=None):
+    """ Score a transactions CSV chunk by chunk, yielding scored chunks in
+    file order.
+
+    ``source`` is a path or a file object. With ``processes`` the chunks are
+    scored on a process pool and ``model`` must be a model path that each
+    worker loads, otherwise they are scored on a thread pool sharing
+    ``model``, which may be a path or an already loaded model. Stage timings
+    are added to ``profile``, a ``StageProfile``, when one is given.
+    """
+    if processes:
+        # Forking a process that already runs polars threads can deadlock.
+        executor = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_worker_model,
+            initargs=(model,)
+        )
+        model = None
+    else:
+        if isinstance(model, (str, os.PathLike)):
+            model = load_model(model)
+        executor = ThreadPoolExecutor(workers)
+
+    def collect(future):
+        scored_df, chunk_profile = future.result()
+        if profile is not None:
+            profile.merge(chunk_profile)
+        return scored_df
+
+    with executor, spooled_csv(source) as path:
+        pending = deque()
+        for chunk_df in read_chunks(path, chunk_size):
+            pending.append(executor.submit(_score_chunk_task, chunk_df, model,
+                                           profile is not None))
+            # Keep a bounded number of chunks in flight.
+            if len(pending) >= 2 * workers:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
+
+
+def write_batches(scored_chunks, output):
+    """ Stream scored chunks into a Parquet or CSV file, by extension.
+
+    Yields the number of rows written so far after every chunk.
+    """
+    import pyarrow.parquet as pq
+
+    written = 0
+    if str(output).endswith(".parquet"):
+        writer = None
+        try:
+            for chunk_df in scored_chunks:
+                table = chunk_df.to_arrow()
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema,
+                                              compression="zstd")
+                writer.write_table(table)
+                written += len(chunk_df)
+                yield written
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open(output, "wb") as csv_file:
+            for chunk_df in scored_chunks:
+                chunk_df.write_csv(csv_file, include_header=written == 0)
+                written += len(chunk_df)
+                yield written
+
+
+def main():
+    """ Score a transactions CSV into a Parquet or CSV file. """
+    parser = argparse.ArgumentParser(description="Score a transactions CSV \
+in parallel chunks.")
+    parser.add_argument("source", help="Transactions CSV file")
+    parser.add_argument("output", help="Output .parquet or .csv file")
+    parser.add_argument("--model", default="model/inference_pipeline.joblib",
+                        help="Joblib pipeline or compiled model directory")
+    parser.add_argument("--chunk-size", type=int, default=50_000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--processes", action="store_true",
+                        help="Score on a process pool instead of threads")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print per-stage timings when done")
+    args = parser.parse_args()
+
+    total = count_rows(args.source)
+    profile = StageProfile() if args.profile else None
+    scored_chunks = score_batches(args.source, args.model, args.chunk_size,
+                                  args.workers, args.processes, profile)
+    for written in write_batches(scored_chunks, args.output):
+        print(f"Scored {written}/{total} transactions", flush=True)
+    if profile is not None:
+        print(profile.format_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+""" Integer codes for the categorical columns, shared by training and
+serving.
+
+Category dictionaries list the values of each categorical column in code
+order, the missing value included. They are extended with unseen values as
+new data arrives, so a value keeps its code across training runs and
+incremental updates. Codes are int32, and values a dictionary does not know
+map to the ``UNKNOWN_CODE`` bucket.
+
+Training encodes the data once with polars before fitting. The registered
+inference pipeline starts with a ``CategoryCodes`` step holding the
+dictionaries, so serving maps raw values to the very same codes, with
+vectorized sorted lookups, and the dictionaries are always saved with the
+model they were trained with.
+"""
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+# Bump when the encoding of values into codes changes.
+DICTIONARY_VERSION = 1
+
+CATEGORICAL_COLUMNS = ("Use Chip", "Merchant Name", "Merchant City",
+                       "Merchant State", "Zip", "Errors?")
+UNKNOWN_CODE = -1
+# Name of the inference pipeline step mapping values to codes.
+CODES_STEP = "category_codes"
+
+
+def _canonical(column, dtype):
+    """ Return a polars expression of a column's values as strings, whole
+    numbers written as integers. Zip codes arrive as 94107.0, "94107.0" or
+    94107 depending on the source and must all share a code.
+    """
+    import polars as pl
+
+    expression = pl.col(column)
+    if dtype.is_float():
+        expression = expression.cast(pl.Int64)
+    return expression.cast(pl.String).str.replace(r"^(-?\d+)\.0$", "${1}")
+
+
+def canonical_strings(values):
+    """ Return NumPy values as strings like ``_canonical`` does, and a mask
+    of the missing ones.
+    """
+    values = np.atleast_1d(np.asarray(values))
+    if values.dtype.kind == "f":
+        missing = np.isnan(values)
+        strings = np.where(missing, 0, values).astype(np.int64).astype(str)
+    elif values.dtype == object:
+        missing = np.asarray([value is None or value != value
+                              for value in values], dtype=bool)
+        strings = np.asarray([
+            "" if is_missing
+            else str(int(value)) if isinstance(value, float)
+            else str(value)
+            for value, is_missing in zip(values, missing)
+        ])
+    else:
+        missing = np.zeros(len(values), dtype=bool)
+        strings = values.astype(str)
+    whole = np.flatnonzero(np.char.endswith(strings, ".0"))
+    if len(whole):
+        heads = np.asarray([string[:-2] for string in strings[whole]])
+        numeric = np.char.isdigit(np.char.lstrip(heads, "-"))
+        strings = strings.astype(object)
+        strings[whole[numeric]] = heads[numeric]
+        strings = strings.astype(str)
+    return strings, missing
+
+
+def extend_dictionaries(data_df, dictionaries=None):
+    """ Return the category dictionaries extended with the values of the
+    polars ``data_df`` they do not know yet, in order of appearance.
+    """
+    dictionaries = dict(dictionaries or {})
+    for column in CATEGORICAL_COLUMNS:
+        known = dictionaries.get(column, [])
+        values = data_df.select(
+            _canonical(column, data_df.schema[column])
+        ).to_series().unique(maintain_order=True)
+        new = values.drop_nulls().filter(
+            ~values.drop_nulls().is_in(known)).to_list()
+        if values.null_count() and None not in known:
+            new.append(None)
+        dictionaries[column] = known + new
+    return dictionaries
+
+
+def encode_categories(data_df, dictionaries):
+    """ Replace the categorical columns of the polars ``data_df`` by their
+    int32 codes.
+    """
+    import polars as pl
+
+    expressions = []
+    for column in CATEGORICAL_COLUMNS:
+        values = dictionaries[column]
+        codes = {value: code for code, value in enumerate(values)
+                 if value is not None}
+        null_code = values.index(None) if None in values else UNKNOWN_CODE
+        expressions.append(
+            _canonical(column, data_df.schema[column]).replace(
+                list(codes), list(codes.values()), default=UNKNOWN_CODE,
+                return_dtype=pl.Int32
+            ).fill_null(null_code).alias(column))
+    return data_df.with_columns(expressions)
+
+
+def lookup_table(values):
+    """ Return the sorted non-missing values of a dictionary as strings,
+    their codes and the code of the missing value.
+    """
+    present = [(value, code) for code, value in enumerate(values)
+               if value is not None]
+    strings = np.asarray([value for value, _ in present], dtype=str)
+    codes = np.asarray([code for _, code in present], dtype=np.int32)
+    order = np.argsort(strings, kind="stable")
+    null_code = values.index(None) if None in values else UNKNOWN_CODE
+    return strings[order], codes[order], null_code
+
+
+def lookup_codes(strings, codes, null_code, values):
+    """ Map raw values to their int32 codes with a sorted lookup table from
+    ``lookup_table``, unknown values to ``UNKNOWN_CODE``.
+    """
+    values, missing = canonical_strings(values)
+    result = np.full(len(values), UNKNOWN_CODE, dtype=np.int32)
+    if len(strings):
+        positions = np.minimum(np.searchsorted(strings, values),
+                               len(strings) - 1)
+        found = strings[positions] == values
+        result[found] = codes[positions[found]]
+    result[missing] = null_code
+    return result
+
+
+class CategoryCodes(TransformerMixin, BaseEstimator):
+    """ Pipeline step replacing categorical columns by their codes. """
+
+    def __init__(self, dictionaries=None):
+        self.dictionaries = dictionaries
+
+    def fit(self, X=None, y=None):  # noqa: N803
+        """ Build the lookup tables of the dictionaries. """
+        self.version_ = DICTIONARY_VERSION
+        self.tables_ = {column: lookup_table(values)
+                        for column, values in self.dictionaries.items()}
+        return self
+
+    def transform(self, X):  # noqa: N803
+        """ Return a copy of the DataFrame with codes instead of values. """
+        if hasattr(X, "to_pandas"):
+            X = X.to_pandas()  # noqa: N806
+        X = X.copy()  # noqa: N806
+        for column, table in self.tables_.items():
+            X[column] = lookup_codes(*table, X[column].to_numpy())
+        return X
+
+    def to_dict(self):
+        """ Return the versioned dictionaries as a JSON-serializable dict. """
+        return {"version": DICTIONARY_VERSION,
+                "dictionaries": self.dictionaries}
+
+
+def inference_pipeline(training_pipeline, dictionaries):
+    """ Return the pipeline to serve, mapping raw values to codes before the
+    fitted training pipeline's steps.
+    """
+    from sklearn.pipeline import Pipeline
+
+    return Pipeline([(CODES_STEP, CategoryCodes(dictionaries).fit()),
+                     *training_pipeline.steps])
@@ -0,0 +1,198 @@
+""" Compaction of a fitted forest into smaller, faster variants.
+
+Trees grown with unlimited depth are large on disk and slow to walk. A
+compaction variant prunes the fitted trees without retraining:
+
+- ``max_depth``: internal nodes at that depth become leaves.
+- ``min_samples_leaf``: splits leaving fewer training samples than that in
+  either child are undone, from the root down.
+- ``ccp_alpha``: minimal cost-complexity pruning, every subtree whose
+  impurity decrease does not pay for its extra leaves at that price is
+  collapsed, as ``ccp_alpha`` does at fit time.
+- ``precision``: "float32" compiles the forest with float32 thresholds and
+  leaf probabilities next to its int32 node indices, halving its size.
+
+A pruned node becomes a leaf predicting the class distribution of the
+training samples that reached it. Each variant is measured for size, load
+time, latency and recall, so the smallest one losing little recall can be
+served.
+"""
+import copy
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# Parameters of a compaction variant.
+COMPACTION_PARAMETERS = ("max_depth", "min_samples_leaf", "ccp_alpha",
+                         "precision")
+# sklearn's markers of leaves in tree node arrays.
+TREE_LEAF = -1
+TREE_UNDEFINED = -2
+
+
+def check_variants(variants):
+    """ Raise when a list of compaction variants has unknown parameters. """
+    for variant in variants:
+        unknown = set(variant) - set(COMPACTION_PARAMETERS)
+        if unknown:
+            message = (f"Unknown compaction parameters {sorted(unknown)}, "
+                       f"use any of {COMPACTION_PARAMETERS}")
+            raise ValueError(message)
+
+
+def variant_name(variant):
+    """ Return a short name for a compaction variant. """
+    if not variant:
+        return "full"
+    return ",".join(f"{key}={value}" for key, value in sorted(
+        variant.items()))
+
+
+def _levels(left, right):
+    """ Return the node indices of a tree level by level from the root. """
+    levels = []
+    frontier = np.zeros(1, dtype=np.int64)
+    while len(frontier):
+        levels.append(frontier)
+        children = np.concatenate([left[frontier], right[frontier]])
+        frontier = children[children != TREE_LEAF]
+    return levels
+
+
+def _collapsed(nodes, levels, max_depth, min_samples_leaf, ccp_alpha):
+    """ Return the mask of internal nodes to turn into leaves. """
+    left, right = nodes["left_child"], nodes["right_child"]
+    internal = left != TREE_LEAF
+    collapse = np.zeros(len(nodes), dtype=bool)
+    if max_depth is not None:
+        for level in levels[max_depth:]:
+            collapse[level] = True
+    if min_samples_leaf:
+        samples = nodes["n_node_samples"]
+        small = np.minimum(samples[np.where(internal, left, 0)],
+                           samples[np.where(internal, right, 0)])
+        collapse |= internal & (small < min_samples_leaf)
+    collapse &= internal
+    if ccp_alpha:
+        # Subtree cost R(T) + alpha |leaves(T)|, children before parents.
+        weights = nodes["weighted_n_node_samples"]
+        leaf_cost = weights / weights[0] * nodes["impurity"] + ccp_alpha
+        cost = leaf_cost.copy()
+        for level in reversed(levels):
+            split = level[internal[level] & ~collapse[level]]
+            keep_cost = cost[left[split]] + cost[right[split]]
+            pruned = leaf_cost[split] <= keep_cost
+            collapse[split[pruned]] = True
+            cost[split] = np.where(pruned, leaf_cost[split], keep_cost)
+    return collapse
+
+
+def compact_tree(tree, max_depth=None, min_samples_leaf=None, ccp_alpha=0.0):
+    """ Return a pruned copy of a fitted sklearn ``Tree``. """
+    cls, args, state = tree.__reduce__()
+    nodes, values = state["nodes"], state["values"]
+    levels = _levels(nodes["left_child"], nodes["right_child"])
+    collapse = _collapsed(nodes, levels, max_depth, min_samples_leaf,
+                          ccp_alpha)
+
+    # Nodes still reachable from the root, renumbered in their preorder.
+    kept = np.zeros(len(nodes), dtype=bool)
+    kept[0] = True
+    depths = np.zeros(len(nodes), dtype=np.int64)
+    for depth, level in enumerate(levels):
+        depths[level] = depth
+        split = level[kept[level] & ~collapse[level]
+                      & (nodes["left_child"][level] != TREE_LEAF)]
+        kept[nodes["left_child"][split]] = True
+        kept[nodes["right_child"][split]] = True
+    new_index = np.cumsum(kept) - 1
+
+    pruned = nodes[kept]
+    leaf = (pruned["left_child"] == TREE_LEAF) | collapse[kept]
+    for child in ("left_child", "right_child"):
+        pruned[child] = np.where(
+            leaf, TREE_LEAF, new_index[np.maximum(pruned[child], 0)])
+    pruned["feature"] = np.where(leaf, TREE_UNDEFINED, pruned["feature"])
+    pruned["threshold"] = np.where(leaf, TREE_UNDEFINED,
+                                   pruned["threshold"])
+    compacted = cls(*args)
+    compacted.__setstate__({
+        "max_depth": int(depths[kept].max()),
+        "node_count": int(kept.sum()),
+        "nodes": np.ascontiguousarray(pruned),
+        "values": np.ascontiguousarray(values[kept]),
+    })
+    return compacted
+
+
+def compact_pipeline(pipeline, max_depth=None, min_samples_leaf=None,
+                     ccp_alpha=0.0, precision=None):
+    """ Return a copy of a fitted pipeline with its forest compacted. """
+    from util.compiled_pipeline import PRECISION_ATTRIBUTE
+
+    compacted = copy.deepcopy(pipeline)
+    if max_depth is not None or min_samples_leaf or ccp_alpha:
+        for estimator in compacted.named_steps["model"].estimators_:
+            estimator.tree_ = compact_tree(estimator.tree_, max_depth,
+                                           min_samples_leaf, ccp_alpha)
+    if precision is not None:
+        setattr(compacted, PRECISION_ATTRIBUTE, precision)
+    return compacted
+
+
+def _directory_size(path):
+    """ Return the total size of the files in a directory in bytes. """
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+def measure_variant(pipeline, data_x, data_y, decision_threshold):
+    """ Measure a pipeline's on-disk and in-memory size, load time, serving
+    latency and recall on a polars split at ``decision_threshold``.
+    """
+    from joblib import dump, load
+
+    from util.compiled_pipeline import CompiledPipeline, compile_pipeline
+    from util.evaluation import evaluate, fraud_probabilities
+    from util.trials import serving_profile
+
+    engine = compile_pipeline(pipeline)
+    with tempfile.TemporaryDirectory() as directory:
+        pipeline_path = os.path.join(directory, "pipeline.joblib")
+        dump(pipeline, pipeline_path)
+        start = time.perf_counter()
+        load(pipeline_path)
+        pipeline_load = time.perf_counter() - start
+        engine_path = os.path.join(directory, "compiled_pipeline")
+        engine.save(engine_path)
+        start = time.perf_counter()
+        CompiledPipeline.load(engine_path)
+        engine_load = time.perf_counter() - start
+        sizes = {
+            "pipeline_size_mb": os.path.getsize(pipeline_path) / 1024 ** 2,
+            "compiled_size_mb": _directory_size(engine_path) / 1024 ** 2,
+        }
+    result = evaluate(data_y.to_series().to_numpy(),
+                      fraud_probabilities(engine, data_x),
+                      threshold=decision_threshold)
+    return {
+        **sizes,
+        "pipeline_load_ms": pipeline_load * 1_000,
+        "compiled_load_ms": engine_load * 1_000,
+        "max_depth": int(engine.depth),
+        "recall": result["recall"],
+        "precision": result["precision"],
+        **serving_profile(pipeline, data_x.to_pandas()),
+    }
+
+
+def select_variant(results, recall_tolerance=0.0):
+    """ Return the index of the smallest variant whose recall is within
+    ``recall_tolerance`` of the first, uncompacted one.
+    """
+    floor = results[0]["recall"] - recall_tolerance
+    candidates = [idx for idx, result in enumerate(results)
+                  if result["recall"] >= floor]
+    return min(candidates, key=lambda idx: (results[idx]["compiled_size_mb"],
+                                            results[idx]["serving_p50_ms"]))
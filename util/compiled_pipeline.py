@@ -0,0 +1,373 @@
+""" Compile a fitted inference pipeline into a compact NumPy scoring engine.
+
+The pipeline produced by ``feature_pipeline.build_pipeline`` spends most of
+its time scoring a single transaction in sklearn/pandas validation and
+dispatch. The compiled engine keeps only the numbers that matter (target
+encoder lookup tables, scaler center and scale, and the forest's nodes
+flattened into a handful of arrays) and scores rows with plain array
+indexing, without building any DataFrame. Columns with category
+dictionaries are looked up into int32 codes, and the codes index an array
+of encodings whose last slot is the unknown bucket.
+
+A compiled engine is saved as a directory holding a small JSON manifest and
+one ``.npy`` file per array. Loading memory-maps the arrays read-only, so
+load time barely depends on model size and every worker process on a host
+shares a single page-cache copy of the trees.
+
+Export a fitted joblib pipeline from the command line with:
+
+    python -m util.compiled_pipeline model/inference_pipeline.joblib \
+model/compiled_pipeline
+"""
+import argparse
+import json
+from collections.abc import Mapping
+from pathlib import Path
+
+import numpy as np
+from joblib import load
+
+from util.categories import CODES_STEP, lookup_codes
+from util.evaluation import THRESHOLD_ATTRIBUTE, predict_classes
+
+FORMAT_VERSION = 2
+# Versions this code can still load.
+SUPPORTED_VERSIONS = (1, 2)
+MANIFEST = "manifest.json"
+FOREST_ARRAYS = ("left", "right", "feature", "threshold", "leaf_proba",
+                 "roots")
+# Attribute of the inference pipeline holding the float precision its forest
+# is compiled with, "float64" when missing.
+PRECISION_ATTRIBUTE = "forest_precision_"
+
+ENCODE = "encode"
+SCALE = "scale"
+# Target encoding of a dictionary coded column, an ENCODE stage feature.
+CODES = "codes"
+
+
+def _lookup(categories, encodings, default, values):
+    """ Map category values to their encodings, unknown ones to default. """
+    if categories.dtype.kind == "U":
+        if values.dtype.kind != "U":
+            values = values.astype(str)
+    elif values.dtype != categories.dtype:
+        try:
+            values = values.astype(categories.dtype)
+        except (TypeError, ValueError):
+            return np.full(len(values), default)
+    if len(categories) == 0:
+        return np.full(len(values), default)
+    positions = np.minimum(np.searchsorted(categories, values),
+                           len(categories) - 1)
+    found = categories[positions] == values
+    if categories.dtype.kind == "f":
+        found |= np.isnan(categories[positions]) & np.isnan(values)
+    return np.where(found, encodings[positions], default)
+
+
+def _as_columns(data):
+    """ Return a column accessor for a mapping, records or a DataFrame. """
+    if isinstance(data, Mapping):
+        return data
+    if isinstance(data, (list, tuple)):
+        return {
+            column: [record[column] for record in data]
+            for column in data[0]
+        }
+    return data
+
+
+class CompiledPipeline:
+    """ NumPy-only equivalent of the fitted fraud detection pipeline. """
+
+    def __init__(self, features, classes, left, right, feature, threshold,
+                 leaf_proba, roots, depth, decision_threshold=None):
+        self.features = features
+        self.classes_ = classes
+        self.left = left
+        self.right = right
+        self.feature = feature
+        self.threshold = threshold
+        self.leaf_proba = leaf_proba
+        self.roots = roots
+        self.depth = depth
+        # Fraud probability from which predict flags a transaction, None
+        # when it was not tuned, see ``util.evaluation.flag_fraud``.
+        self.decision_threshold = decision_threshold
+
+    @property
+    def feature_columns(self):
+        """ Input columns the engine reads, in feature order. """
+        return [column for _, column, _ in self.features]
+
+    def feature_values(self, data, kind):
+        """ Compute the features of one kind (ENCODE or SCALE), returned as
+        a mapping of feature position to values.
+        """
+        columns = _as_columns(data)
+        values = {}
+        for idx, (feature_kind, column, params) in enumerate(self.features):
+            if (ENCODE if feature_kind == CODES else feature_kind) != kind:
+                continue
+            raw = np.atleast_1d(np.asarray(columns[column]))
+            if feature_kind == CODES:
+                strings, codes, null_code, table = params
+                values[idx] = table[lookup_codes(strings, codes, null_code,
+                                                 raw)]
+            elif kind == ENCODE:
+                categories, encodings, default = params
+                values[idx] = _lookup(categories, encodings, default, raw)
+            else:
+                center, scale = params
+                values[idx] = (raw.astype(np.float64) - center) / scale
+        return values
+
+    def stack_features(self, values):
+        """ Stack feature values from ``feature_values`` into the float32
+        matrix the forest is evaluated on.
+        """
+        # sklearn evaluates trees on float32 inputs, do the same for parity.
+        return np.column_stack(
+            [values[idx] for idx in range(len(self.features))]
+        ).astype(np.float32)
+
+    def transform(self, data):
+        """ Build the float32 feature matrix the forest is evaluated on. """
+        columns = _as_columns(data)
+        return self.stack_features({**self.feature_values(columns, ENCODE),
+                                    **self.feature_values(columns, SCALE)})
+
+    def predict_proba(self, data):
+        """ Return class probabilities for one or more transactions. """
+        return self.score_features(self.transform(data))
+
+    def score_features(self, features):
+        """ Return class probabilities for an already transformed feature
+        matrix, as built by ``transform``.
+        """
+        rows = np.arange(len(features))
+        nodes = np.repeat(self.roots[:, np.newaxis], len(features), axis=1)
+        # Leaves point back to themselves, so walking the maximum depth
+        # leaves every row sitting on its leaf in every tree.
+        for _ in range(self.depth):
+            go_left = features[rows, self.feature[nodes]] \
+                <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.leaf_proba[nodes].mean(axis=0, dtype=np.float64)
+
+    def predict(self, data):
+        """ Return the predicted class for one or more transactions, fraud
+        from the decision threshold on.
+        """
+        return predict_classes(self, self.predict_proba(data))
+
+    def save(self, path):
+        """ Save the compiled engine as a directory of ``.npy`` arrays. """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        features = []
+        for idx, (kind, column, params) in enumerate(self.features):
+            if kind == ENCODE:
+                categories, encodings, default = params
+                np.save(path / f"categories_{idx}.npy", categories)
+                np.save(path / f"encodings_{idx}.npy", encodings)
+                features.append(
+                    {"kind": kind, "column": column, "default": default})
+            elif kind == CODES:
+                strings, codes, null_code, table = params
+                np.save(path / f"strings_{idx}.npy", strings)
+                np.save(path / f"codes_{idx}.npy", codes)
+                np.save(path / f"table_{idx}.npy", table)
+                features.append(
+                    {"kind": kind, "column": column, "null_code": null_code})
+            else:
+                center, scale = params
+                features.append({"kind": kind, "column": column,
+                                 "center": center, "scale": scale})
+        for name in FOREST_ARRAYS:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        manifest = {
+            "version": FORMAT_VERSION,
+            "features": features,
+            "classes": self.classes_.tolist(),
+            "depth": self.depth,
+            "decision_threshold": self.decision_threshold,
+        }
+        (path / MANIFEST).write_text(json.dumps(manifest, indent=2))
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        """ Load a compiled engine saved with ``save``.
+
+        Arrays are memory-mapped read-only by default, pass ``mmap_mode=None``
+        to read them fully into memory instead.
+        """
+        path = Path(path)
+        manifest = json.loads((path / MANIFEST).read_text())
+        if manifest["version"] not in SUPPORTED_VERSIONS:
+            message = ("Unsupported compiled model version "
+                       f"{manifest['version']}")
+            raise ValueError(message)
+
+        def array(name):
+            return np.load(path / f"{name}.npy", mmap_mode=mmap_mode)
+
+        features = []
+        for idx, spec in enumerate(manifest["features"]):
+            if spec["kind"] == ENCODE:
+                params = (array(f"categories_{idx}"),
+                          array(f"encodings_{idx}"), spec["default"])
+            elif spec["kind"] == CODES:
+                params = (array(f"strings_{idx}"), array(f"codes_{idx}"),
+                          spec["null_code"], array(f"table_{idx}"))
+            else:
+                params = (spec["center"], spec["scale"])
+            features.append((spec["kind"], spec["column"], params))
+        return cls(
+            features=features,
+            classes=np.asarray(manifest["classes"]),
+            depth=manifest["depth"],
+            decision_threshold=manifest.get("decision_threshold"),
+            **{name: array(name) for name in FOREST_ARRAYS}
+        )
+
+
+def _compile_encoder(encoder, columns, tables):
+    """ Return feature specs for a fitted binary TargetEncoder, folding the
+    lookup ``tables`` of dictionary coded columns in.
+    """
+    if encoder.target_type_ != "binary":
+        message = "Only binary target encoders can be compiled"
+        raise ValueError(message)
+    features = []
+    for column, categories, encodings in zip(columns, encoder.categories_,
+                                             encoder.encodings_):
+        default = float(encoder.target_mean_)
+        if column in tables:
+            strings, codes, null_code = tables[column]
+            code_count = max(codes.max(initial=-1), null_code) + 1
+            # Encodings by code, the last slot is the unknown code's.
+            table = np.append(
+                _lookup(categories, encodings.astype(np.float64), default,
+                        np.arange(code_count, dtype=np.int32)),
+                default)
+            features.append((CODES, column,
+                             (strings, codes, null_code, table)))
+            continue
+        if categories.dtype == object:
+            categories = categories.astype(str)
+        features.append((
+            ENCODE,
+            column,
+            (categories, encodings.astype(np.float64), default)
+        ))
+    return features
+
+
+def _compile_scaler(scaler, columns):
+    """ Return feature specs for a fitted RobustScaler. """
+    count = len(columns)
+    center = scaler.center_ if scaler.with_centering else np.zeros(count)
+    scale = scaler.scale_ if scaler.with_scaling else np.ones(count)
+    return [
+        (SCALE, column, (float(center[idx]), float(scale[idx])))
+        for idx, column in enumerate(columns)
+    ]
+
+
+def _compile_features(feature_union, tables):
+    """ Flatten a FeatureUnion of ColumnTransformers into feature specs. """
+    from sklearn.preprocessing import RobustScaler, TargetEncoder
+
+    features = []
+    for _, column_transformer in feature_union.transformer_list:
+        for name, transformer, columns in column_transformer.transformers_:
+            if name == "remainder":
+                continue
+            if isinstance(transformer, TargetEncoder):
+                features.extend(
+                    _compile_encoder(transformer, columns, tables))
+            elif isinstance(transformer, RobustScaler):
+                features.extend(_compile_scaler(transformer, columns))
+            else:
+                message = f"Cannot compile transformer {type(transformer)}"
+                raise TypeError(message)
+    return features
+
+
+def _float32_thresholds(threshold):
+    """ Round split thresholds down to float32. Features are float32, so a
+    feature is at most the rounded threshold exactly when it is at most the
+    original one, and every row takes the same path.
+    """
+    rounded = threshold.astype(np.float32)
+    above = rounded > threshold
+    rounded[above] = np.nextafter(rounded[above], np.float32(-np.inf))
+    return rounded
+
+
+def _compile_forest(forest, precision="float64"):
+    """ Flatten the trees of a fitted forest into shared node arrays, with
+    thresholds and leaf probabilities in the given float ``precision``.
+    """
+    left, right, feature, threshold, leaf_proba, roots = [], [], [], [], [], []
+    depth = 0
+    offset = 0
+    for estimator in forest.estimators_:
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+        left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+        right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        value = tree.value[:, 0, :]
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0] = 1
+        leaf_proba.append(value / normalizer)
+        roots.append(offset)
+        depth = max(depth, tree.max_depth)
+        offset += tree.node_count
+    threshold = np.concatenate(threshold)
+    if precision == "float32":
+        threshold = _float32_thresholds(threshold)
+    return {
+        "left": np.concatenate(left).astype(np.int32),
+        "right": np.concatenate(right).astype(np.int32),
+        "feature": np.concatenate(feature).astype(np.int32),
+        "threshold": threshold,
+        "leaf_proba": np.concatenate(leaf_proba).astype(precision),
+        "roots": np.asarray(roots, dtype=np.int32),
+        "depth": depth,
+    }
+
+
+def compile_pipeline(pipeline):
+    """ Compile a fitted pipeline from ``build_pipeline`` into an engine. """
+    feature_engineering = pipeline.named_steps["feature_engineering"]
+    model = pipeline.named_steps["model"]
+    codes_step = pipeline.named_steps.get(CODES_STEP)
+    return CompiledPipeline(
+        features=_compile_features(
+            feature_engineering.named_steps["features"],
+            codes_step.tables_ if codes_step is not None else {}),
+        classes=np.asarray(model.classes_),
+        decision_threshold=getattr(pipeline, THRESHOLD_ATTRIBUTE, None),
+        **_compile_forest(model, getattr(pipeline, PRECISION_ATTRIBUTE,
+                                         "float64"))
+    )
+
+
+def main():
+    """ Compile a joblib pipeline file into a compiled engine directory. """
+    parser = argparse.ArgumentParser(description="Compile a fitted \
+inference pipeline into a NumPy scoring engine.")
+    parser.add_argument("pipeline", help="Fitted joblib pipeline")
+    parser.add_argument("output", help="Compiled engine output directory")
+    args = parser.parse_args()
+    compile_pipeline(load(args.pipeline)).save(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,586 @@
+""" Constant-memory profiles of scored traffic, to compare with training.
+
+A ``TrafficProfile`` summarizes transactions with fixed-size sketches, each
+updated with a few vectorized operations per batch:
+
+- numeric columns (``Amount``) in a log-bucketed histogram answering any
+  quantile within a relative accuracy, in the manner of DDSketch;
+- categorical columns (``Merchant Name``, ``Zip``, ``MCC``) in a count-min
+  sketch of their values, plus the most frequent values seen so far;
+- fraud probabilities in a fixed histogram over [0, 1].
+
+Sketches only ever add counts, so profiles built by different workers, or
+over different periods, merge by adding their counters up. Training saves the
+profile of its validation split with the registered model as a baseline, and
+``compare`` reports how far traffic has drifted from it: population
+stability index (PSI) per column, quantile shifts, values that became
+frequent and the change in predicted probabilities.
+
+Categorical values are keyed like the category dictionaries write them,
+whole numbers by their value whether they arrive as 94107, 94107.0 or
+"94107", so a training split of codes, decoded with its dictionaries, and
+raw serving traffic land in the same counters. Only other strings are
+hashed, so most columns are keyed without converting values to strings.
+
+Merge snapshots saved by the service and compare them with a baseline with:
+
+    python -m util.drift baseline.json snapshots/*.json
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+from util.categories import canonical_strings
+
+NUMERIC_COLUMNS = ("Amount",)
+CATEGORICAL_COLUMNS = ("Merchant Name", "Zip", "MCC")
+PROBABILITY_COLUMN = "is_fraud_proba"
+# Attribute of the inference pipeline, and file of the bento model, holding
+# the baseline profile of the training data.
+PROFILE_ATTRIBUTE = "traffic_profile_"
+PROFILE_FILE = "traffic_profile.json"
+PROFILE_VERSION = 1
+# Odd 64-bit multipliers of the count-min sketch's multiply-shift hashes,
+# one per row.
+HASH_MULTIPLIERS = np.array([
+    0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9,
+    0xD6E8FEB86659FD93, 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53,
+], dtype=np.uint64)
+# Strings are hashed on at most this many leading characters.
+MAX_HASHED_CHARS = 64
+# Share floor of empty bins in the population stability index.
+PSI_FLOOR = 1e-4
+QUANTILES = (0.01, 0.5, 0.9, 0.99)
+
+
+def population_stability(expected, actual):
+    """ Return the population stability index of two histograms over the
+    same bins. Below 0.1 is usually read as stable, above 0.25 as drifted.
+    """
+    expected = np.asarray(expected, dtype=np.float64)
+    actual = np.asarray(actual, dtype=np.float64)
+    if expected.sum() <= 0 or actual.sum() <= 0:
+        return None
+    expected = np.maximum(expected / expected.sum(), PSI_FLOOR)
+    actual = np.maximum(actual / actual.sum(), PSI_FLOOR)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def _splitmix64(seed, count):
+    """ Return ``count`` pseudo-random odd 64-bit integers, the same on
+    every platform and NumPy version.
+    """
+    mask = (1 << 64) - 1
+    numbers = []
+    for _ in range(count):
+        seed = (seed + 0x9E3779B97F4A7C15) & mask
+        number = ((seed ^ (seed >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        number = ((number ^ (number >> 27)) * 0x94D049BB133111EB) & mask
+        numbers.append((number ^ (number >> 31)) | 1)
+    return np.array(numbers, dtype=np.uint64)
+
+
+# Multipliers of each character position in the string hash.
+CHAR_MULTIPLIERS = _splitmix64(2023, MAX_HASHED_CHARS)
+
+
+# Constants of the final mix of MurmurHash3.
+MIX_SHIFT = np.uint64(33)
+MIX_MULTIPLIERS = (np.uint64(0xFF51AFD7ED558CCD),
+                   np.uint64(0xC4CEB9FE1A85EC53))
+# Key of missing values.
+MISSING_KEY = np.uint64(0x8000000000000000)
+
+
+def hash_strings(strings):
+    """ Return stable 64-bit hashes of an array of strings, multiplying
+    their code points by per-position multipliers and mixing the sum.
+    """
+    strings = np.ascontiguousarray(strings, dtype=str)
+    chars = strings.view(np.uint32).reshape(len(strings),
+                                            strings.dtype.itemsize // 4)
+    chars = chars[:, :MAX_HASHED_CHARS].astype(np.uint64)
+    hashes = (chars * CHAR_MULTIPLIERS[:chars.shape[1]]).sum(
+        axis=1, dtype=np.uint64)
+    # Every bit of the hash depends on every character.
+    for multiplier in MIX_MULTIPLIERS:
+        hashes ^= hashes >> MIX_SHIFT
+        hashes *= multiplier
+    hashes ^= hashes >> MIX_SHIFT
+    return hashes
+
+
+def _integer(value):
+    """ Return the integer a category value stands for, like 94107 for
+    94107.0 or "94107.0", or None when it is not one.
+    """
+    if isinstance(value, str):
+        head = value[:-2] if value.endswith(".0") else value
+        if head.lstrip("-").isdigit():
+            return int(head)
+        return None
+    return int(value)
+
+
+def category_keys(values):
+    """ Return 64-bit keys of raw or decoded category values. Values
+    ``canonical_strings`` writes alike share a key: whole numbers, and
+    strings of them, are keyed by their value, other strings by their hash
+    and missing values by ``MISSING_KEY``.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in "iub":
+        return values.astype(np.int64).view(np.uint64)
+    if values.dtype.kind == "f":
+        missing = np.isnan(values)
+        keys = np.where(missing, 0, values).astype(np.int64).view(np.uint64)
+        keys[missing] = MISSING_KEY
+        return keys
+    keys = np.empty(len(values), dtype=np.uint64)
+    strings = []
+    for position, value in enumerate(values.tolist()):
+        if value is None or value != value:
+            keys[position] = MISSING_KEY
+            continue
+        integer = _integer(value)
+        if integer is None:
+            strings.append((position, str(value)))
+        else:
+            keys[position] = integer & 0xFFFFFFFFFFFFFFFF
+    if strings:
+        positions, texts = zip(*strings)
+        keys[list(positions)] = hash_strings(texts)
+    return keys
+
+
+def category_labels(values):
+    """ Return category values as canonical strings, missing ones empty. """
+    strings, missing = canonical_strings(values)
+    return np.where(missing, "", strings).tolist()
+
+
+def _add_counts(counts, positions):
+    """ Add one to the counters at each position, repeated ones included. """
+    if len(positions) * 8 < len(counts):
+        np.add.at(counts, positions, 1)
+    else:
+        counts += np.bincount(positions, minlength=len(counts))
+
+
+def decode_codes(codes, dictionary):
+    """ Return the values of int32 category codes, unknown ones missing. """
+    table = np.asarray(list(dictionary) + [None], dtype=object)
+    return table[np.asarray(codes)]
+
+
+class QuantileSketch:
+    """ Log-bucketed histogram answering quantiles within a relative
+    accuracy. Magnitudes below ``min_value`` count as zero and above
+    ``max_value`` fall in the last bucket.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-3,
+                 max_value=1e9):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.offset = int(np.ceil(np.log(min_value) / self.log_gamma))
+        self.size = int(np.ceil(np.log(max_value) / self.log_gamma)) \
+            - self.offset + 1
+        # Negative buckets by decreasing magnitude, zero, then positive
+        # buckets by increasing magnitude, so counts are in value order.
+        self.counts = np.zeros(2 * self.size + 1, dtype=np.int64)
+        self.missing = 0
+
+    @property
+    def count(self):
+        """ Number of values sketched, missing ones excluded. """
+        return int(self.counts.sum())
+
+    def update(self, values):
+        """ Add an array of values. """
+        values = np.asarray(values, dtype=np.float64)
+        finite = np.isfinite(values)
+        self.missing += len(values) - int(np.count_nonzero(finite))
+        values = values[finite]
+        magnitude = np.abs(values)
+        index = np.ceil(np.log(np.maximum(magnitude, self.min_value))
+                        / self.log_gamma).astype(np.int64) - self.offset
+        np.clip(index, 0, self.size - 1, out=index)
+        index += 1
+        np.negative(index, out=index, where=values < 0)
+        index[magnitude < self.min_value] = 0
+        _add_counts(self.counts, index + self.size)
+
+    def merge(self, other):
+        """ Add the counts of a sketch with the same parameters. """
+        self.counts += other.counts
+        self.missing += other.missing
+        return self
+
+    def _buckets(self):
+        """ Return the bucket values in ascending order and their counts. """
+        representative = 2 * self.gamma ** (
+            np.arange(self.size) + self.offset) / (self.gamma + 1)
+        values = np.concatenate([-representative[::-1], [0.0],
+                                 representative])
+        return values, self.counts
+
+    def quantile(self, quantiles):
+        """ Return the values at the given quantiles, NaN when empty. """
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        values, counts = self._buckets()
+        cumulative = np.cumsum(counts)
+        if not cumulative[-1]:
+            return np.full(quantiles.shape, np.nan)
+        ranks = quantiles * (cumulative[-1] - 1)
+        return values[np.searchsorted(cumulative, ranks, side="right")]
+
+    def cdf(self, points):
+        """ Return the share of values at or below each point. """
+        values, counts = self._buckets()
+        cumulative = np.concatenate([[0], np.cumsum(counts)])
+        positions = np.searchsorted(values, points, side="right")
+        return cumulative[positions] / max(cumulative[-1], 1)
+
+    def compare(self, baseline):
+        """ Return the PSI over the baseline's deciles and the quantile
+        shifts from the baseline.
+        """
+        edges = np.unique(baseline.quantile(np.linspace(0.1, 0.9, 9)))
+        shares = np.diff(np.concatenate([[0.0], baseline.cdf(edges), [1.0]]))
+        actual = np.diff(np.concatenate([[0.0], self.cdf(edges), [1.0]]))
+        report = {"psi": (population_stability(shares, actual)
+                          if self.count and baseline.count else None)}
+        for quantile, value, expected in zip(
+                QUANTILES, self.quantile(QUANTILES),
+                baseline.quantile(QUANTILES)):
+            report[f"p{quantile * 100:g}"] = float(value)
+            report[f"baseline_p{quantile * 100:g}"] = float(expected)
+        return report
+
+    def to_dict(self):
+        """ Return the sketch as JSON-serializable data, sparse. """
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "min_value": self.min_value,
+            "max_value": self.max_value,
+            "counts": _sparse(self.counts),
+            "missing": self.missing,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a sketch saved with ``to_dict``. """
+        sketch = cls(data["relative_accuracy"], data["min_value"],
+                     data["max_value"])
+        _dense(data["counts"], sketch.counts)
+        sketch.missing = data["missing"]
+        return sketch
+
+
+class CategorySketch:
+    """ Count-min sketch of a categorical column's values, keeping track of
+    its ``top`` most frequent values.
+    """
+
+    def __init__(self, width=1024, depth=4, top=50):
+        if width & (width - 1) or not 0 < depth <= len(HASH_MULTIPLIERS):
+            message = ("width must be a power of two and depth at most "
+                       f"{len(HASH_MULTIPLIERS)}")
+            raise ValueError(message)
+        self.width = width
+        self.depth = depth
+        self.top = top
+        self.shift = np.uint64(64 - (width.bit_length() - 1))
+        # The rows of counters, one after the other.
+        self.counts = np.zeros(depth * width, dtype=np.int64)
+        self.rows = (np.arange(depth) * width)[:, np.newaxis]
+        self.total = 0
+        # Keys of the most frequent values, the values, and the lowest
+        # estimate among them when they were picked.
+        self.heavy = {}
+        self.heavy_floor = 0
+
+    def _indexes(self, keys):
+        """ Return the counter of each key in every row. """
+        hashes = keys * HASH_MULTIPLIERS[:self.depth, np.newaxis]
+        return (hashes >> self.shift).astype(np.intp) + self.rows
+
+    def estimate(self, keys):
+        """ Return upper bounds of the counts of values by key. """
+        return self.counts[self._indexes(keys)].min(axis=0)
+
+    def update(self, values):
+        """ Add an array of raw values. """
+        values = np.asarray(values)
+        keys = category_keys(values)
+        _add_counts(self.counts, self._indexes(keys).ravel())
+        self.total += len(keys)
+        if len(keys) > 1:
+            keys, first = np.unique(keys, return_index=True)
+            values = values[first]
+        self._keep_heavy(keys, values)
+
+    def _keep_heavy(self, keys, values):
+        """ Keep the ``top`` most frequent of the current heavy values and
+        the given ones.
+        """
+        if len(self.heavy) >= self.top:
+            # Counts only grow, so values at or below the floor cannot
+            # displace any current heavy value.
+            rising = self.estimate(keys) > self.heavy_floor
+            if not rising.any():
+                return
+            keys, values = keys[rising], values[rising]
+        heavy = dict(self.heavy)
+        heavy.update(zip(keys.tolist(), category_labels(values)))
+        candidates = np.fromiter(heavy, dtype=np.uint64, count=len(heavy))
+        estimates = self.estimate(candidates)
+        if len(candidates) > self.top:
+            order = np.argsort(-estimates, kind="stable")[:self.top]
+            candidates, estimates = candidates[order], estimates[order]
+        self.heavy = {key: heavy[key] for key in candidates.tolist()}
+        self.heavy_floor = (int(estimates.min())
+                            if len(candidates) >= self.top else 0)
+
+    def heavy_hitters(self):
+        """ Return the most frequent values and their estimated shares,
+        most frequent first.
+        """
+        if not self.heavy:
+            return []
+        keys = np.fromiter(self.heavy, dtype=np.uint64,
+                           count=len(self.heavy))
+        shares = self.estimate(keys) / max(self.total, 1)
+        order = np.argsort(-shares, kind="stable")
+        return [(self.heavy[key], float(share)) for key, share
+                in zip(keys[order].tolist(), shares[order])]
+
+    def merge(self, other):
+        """ Add the counts of a sketch with the same parameters. """
+        self.counts += other.counts
+        self.total += other.total
+        keys = np.fromiter(other.heavy, dtype=np.uint64,
+                           count=len(other.heavy))
+        self._keep_heavy(keys, np.asarray(list(other.heavy.values()),
+                                          dtype=object))
+        return self
+
+    def compare(self, baseline, new_values=10):
+        """ Return the PSI over the baseline's most frequent values, the
+        rest pooled in one bin, and the values now among the most frequent
+        that were not in the baseline's.
+        """
+        top = baseline.heavy_hitters()
+        report = {"psi": None, "new_top_values": []}
+        if not top or not self.total:
+            return report
+        keys = category_keys(
+            np.asarray([value for value, _ in top], dtype=object))
+        expected = np.asarray([share for _, share in top])
+        actual = self.estimate(keys) / self.total
+        report["psi"] = population_stability(
+            np.append(expected, max(1 - expected.sum(), 0)),
+            np.append(actual, max(1 - actual.sum(), 0)))
+        known = {value for value, _ in top}
+        report["new_top_values"] = [
+            {"value": value, "share": share}
+            for value, share in self.heavy_hitters()
+            if value not in known][:new_values]
+        return report
+
+    def to_dict(self):
+        """ Return the sketch as JSON-serializable data. """
+        return {
+            "width": self.width,
+            "depth": self.depth,
+            "top": self.top,
+            "counts": self.counts.reshape(self.depth, -1).tolist(),
+            "total": self.total,
+            "heavy": list(self.heavy.values()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a sketch saved with ``to_dict``. """
+        sketch = cls(data["width"], data["depth"], data["top"])
+        sketch.counts[:] = np.ravel(data["counts"])
+        sketch.total = data["total"]
+        labels = np.asarray(data["heavy"], dtype=object)
+        sketch._keep_heavy(category_keys(labels), labels)
+        return sketch
+
+
+class TrafficProfile:
+    """ Sketches of the transactions and fraud probabilities of a period of
+    traffic, thread-safe.
+    """
+
+    def __init__(self, numeric=NUMERIC_COLUMNS,
+                 categorical=CATEGORICAL_COLUMNS, probability_bins=20):
+        self.numeric = {column: QuantileSketch() for column in numeric}
+        self.categorical = {column: CategorySketch()
+                            for column in categorical}
+        self.probabilities = np.zeros(probability_bins, dtype=np.int64)
+        self.probability_sum = 0.0
+        self.transactions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def columns(self):
+        """ Input columns the profile sketches. """
+        return (*self.numeric, *self.categorical)
+
+    def update(self, data, fraud_proba=None, dictionaries=None):
+        """ Add a batch of transactions, a DataFrame or a mapping of
+        columns, and optionally their fraud probabilities. Columns coded
+        with category ``dictionaries`` are decoded first.
+        """
+        columns = {}
+        for column in self.columns:
+            if column in data:
+                values = np.asarray(data[column])
+                if dictionaries and column in dictionaries:
+                    values = decode_codes(values, dictionaries[column])
+                columns[column] = values
+        if fraud_proba is not None:
+            fraud_proba = np.asarray(fraud_proba, dtype=np.float64)
+            bins = len(self.probabilities)
+            index = np.minimum((fraud_proba * bins).astype(np.int64),
+                               bins - 1)
+            probabilities = np.bincount(index, minlength=bins)
+        with self._lock:
+            self.transactions += len(next(iter(columns.values()), ()))
+            for column, values in columns.items():
+                if column in self.numeric:
+                    self.numeric[column].update(values)
+                else:
+                    self.categorical[column].update(values)
+            if fraud_proba is not None:
+                self.probabilities += probabilities
+                self.probability_sum += float(fraud_proba.sum())
+
+    def merge(self, other):
+        """ Add another profile of the same columns, such as another
+        worker's or another period's.
+        """
+        with self._lock:
+            for column, sketch in self.numeric.items():
+                sketch.merge(other.numeric[column])
+            for column, sketch in self.categorical.items():
+                sketch.merge(other.categorical[column])
+            self.probabilities += other.probabilities
+            self.probability_sum += other.probability_sum
+            self.transactions += other.transactions
+        return self
+
+    def compare(self, baseline):
+        """ Return how far this traffic drifted from a baseline profile. """
+        with self._lock:
+            report = {
+                "transactions": self.transactions,
+                "baseline_transactions": baseline.transactions,
+                "features": {},
+            }
+            for column, sketch in self.numeric.items():
+                if column in baseline.numeric:
+                    report["features"][column] = sketch.compare(
+                        baseline.numeric[column])
+            for column, sketch in self.categorical.items():
+                if column in baseline.categorical:
+                    report["features"][column] = sketch.compare(
+                        baseline.categorical[column])
+            scored = self.probabilities.sum()
+            baseline_scored = baseline.probabilities.sum()
+            report[PROBABILITY_COLUMN] = {
+                "psi": population_stability(baseline.probabilities,
+                                            self.probabilities),
+                "mean": (self.probability_sum / scored if scored
+                         else None),
+                "baseline_mean": (baseline.probability_sum
+                                  / baseline_scored if baseline_scored
+                                  else None),
+            }
+        return report
+
+    def to_dict(self):
+        """ Return the profile as JSON-serializable data. """
+        with self._lock:
+            return {
+                "version": PROFILE_VERSION,
+                "transactions": self.transactions,
+                "numeric": {column: sketch.to_dict()
+                            for column, sketch in self.numeric.items()},
+                "categorical": {column: sketch.to_dict() for column, sketch
+                                in self.categorical.items()},
+                "probabilities": self.probabilities.tolist(),
+                "probability_sum": self.probability_sum,
+            }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Rebuild a profile saved with ``to_dict``. """
+        if data["version"] != PROFILE_VERSION:
+            message = f"Unsupported traffic profile version {data['version']}"
+            raise ValueError(message)
+        profile = cls(numeric=(), categorical=(),
+                      probability_bins=len(data["probabilities"]))
+        profile.numeric = {column: QuantileSketch.from_dict(sketch)
+                           for column, sketch in data["numeric"].items()}
+        profile.categorical = {
+            column: CategorySketch.from_dict(sketch)
+            for column, sketch in data["categorical"].items()}
+        profile.probabilities[:] = data["probabilities"]
+        profile.probability_sum = data["probability_sum"]
+        profile.transactions = data["transactions"]
+        return profile
+
+    def save(self, path):
+        """ Atomically save the profile as JSON. """
+        partial_path = f"{path}.partial"
+        with open(partial_path, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file)
+        os.replace(partial_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """ Load a profile saved with ``save``. """
+        with open(path, encoding="utf-8") as file:
+            return cls.from_dict(json.load(file))
+
+
+def _sparse(counts):
+    """ Return the non-zero counts of an array and their positions. """
+    positions = np.flatnonzero(counts)
+    return [positions.tolist(), counts[positions].tolist()]
+
+
+def _dense(sparse, counts):
+    """ Fill an array with counts saved by ``_sparse``. """
+    positions, values = sparse
+    counts[np.asarray(positions, dtype=np.int64)] = values
+
+
+def main():
+    """ Merge traffic profile snapshots and compare them with a baseline. """
+    parser = argparse.ArgumentParser(description="Merge traffic profile \
+snapshots and report their drift from a baseline profile.")
+    parser.add_argument("baseline", help="Baseline profile JSON file")
+    parser.add_argument("snapshots", nargs="+",
+                        help="Profile snapshots to merge")
+    args = parser.parse_args()
+    baseline = TrafficProfile.load(args.baseline)
+    traffic = TrafficProfile.load(args.snapshots[0])
+    for path in args.snapshots[1:]:
+        traffic.merge(TrafficProfile.load(path))
+    print(json.dumps(traffic.compare(baseline), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+""" Country, state and city lookups for the Streamlit app's dropdowns. """
+import polars as pl
+
+NO_STATES = {"names": [], "codes": [], "id_by_name": {}, "id_by_code": {}}
+
+
+def build_geography_index(countries_df, states_df, cities_df):
+    """ Precompute the country→state→city hierarchy as plain dictionaries,
+    so populating a dropdown is a dictionary lookup instead of a filter.
+    """
+    states = {}
+    for country_id, names, codes, ids in states_df.group_by(
+            "country_id", maintain_order=True).agg(
+                pl.col("name"), pl.col("state_code"), pl.col("id")
+            ).iter_rows():
+        states[country_id] = {
+            "names": names,
+            "codes": codes,
+            "id_by_name": dict(zip(names, ids)),
+            "id_by_code": dict(zip(codes, ids)),
+        }
+    cities = dict(cities_df.group_by("state_id", maintain_order=True).agg(
+        pl.col("name")).iter_rows())
+    country_names = countries_df.get_column("name").to_list()
+    return {
+        "countries": country_names,
+        "country_ids": dict(zip(country_names,
+                                countries_df.get_column("id").to_list())),
+        "states": states,
+        "cities": cities,
+    }
+
+
+def country_states(index, country_id):
+    """ Return the names, codes and id lookups of a country's states. """
+    return index["states"].get(country_id, NO_STATES)
+
+
+def state_cities(index, state_id):
+    """ Return the city names of a state. """
+    return index["cities"].get(state_id, [])
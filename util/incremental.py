@@ -0,0 +1,196 @@
+""" Incremental updates of a trained pipeline from new transactions.
+
+A binary TargetEncoder's encodings only depend on the count and the sum of
+the target per category, so keeping those sufficient statistics around lets
+the encoder absorb new data without seeing the old data again. The forest
+grows new trees on the new data with ``warm_start``, optionally dropping as
+many of its oldest trees. Updating therefore costs time proportional to the
+new data only.
+
+The RobustScaler's center and scale (median and interquartile range) cannot
+be updated exactly from summaries and are kept as fitted.
+"""
+import numpy as np
+import pandas as pd
+
+
+def _unique(values):
+    """ Return the sorted categories of ``values``, missing values last as
+    in sklearn's encoders, and the category index of every value.
+    """
+    values = np.asarray(values)
+    missing = pd.isna(values)
+    categories, inverse = np.unique(values[~missing], return_inverse=True)
+    codes = np.empty(len(values), dtype=np.intp)
+    codes[~missing] = inverse
+    if missing.any():
+        codes[missing] = len(categories)
+        categories = np.append(
+            categories, None if values.dtype == object else np.nan)
+    return categories, codes
+
+
+class EncoderStatistics:
+    """ Per-category target counts and sums of a binary TargetEncoder. """
+
+    def __init__(self, columns, categories, counts, sums):
+        self.columns = list(columns)
+        self.categories = categories
+        self.counts = counts
+        self.sums = sums
+
+    @property
+    def total_count(self):
+        """ Number of rows the statistics were computed on. """
+        return float(self.counts[0].sum())
+
+    @property
+    def total_sum(self):
+        """ Sum of the target over those rows. """
+        return float(self.sums[0].sum())
+
+    @classmethod
+    def from_data(cls, data_df, target, columns):
+        """ Compute the statistics of ``columns`` of a pandas DataFrame. """
+        target = np.asarray(target, dtype=np.float64)
+        categories, counts, sums = [], [], []
+        for column in columns:
+            column_categories, codes = _unique(data_df[column].to_numpy())
+            categories.append(column_categories)
+            counts.append(np.bincount(codes, minlength=len(column_categories))
+                          .astype(np.float64))
+            sums.append(np.bincount(codes, weights=target,
+                                    minlength=len(column_categories)))
+        return cls(columns, categories, counts, sums)
+
+    def merge(self, other):
+        """ Return the statistics of both datasets together. """
+        if other.columns != self.columns:
+            message = "Cannot merge statistics of different columns"
+            raise ValueError(message)
+        categories, counts, sums = [], [], []
+        for idx in range(len(self.columns)):
+            merged, codes = _unique(np.concatenate(
+                [self.categories[idx], other.categories[idx]]))
+            categories.append(merged)
+            counts.append(np.bincount(
+                codes, weights=np.concatenate(
+                    [self.counts[idx], other.counts[idx]]),
+                minlength=len(merged)))
+            sums.append(np.bincount(
+                codes, weights=np.concatenate(
+                    [self.sums[idx], other.sums[idx]]),
+                minlength=len(merged)))
+        return EncoderStatistics(self.columns, categories, counts, sums)
+
+    def encodings(self, smooth="auto"):
+        """ Return the target mean and the per-category encodings a binary
+        TargetEncoder fitted on the same data would learn.
+        """
+        target_mean = self.total_sum / self.total_count
+        encodings = []
+        for counts, sums in zip(self.counts, self.sums):
+            with np.errstate(divide="ignore", invalid="ignore"):
+                means = sums / counts
+                if smooth == "auto":
+                    # Empirical Bayes shrinkage, the target being 0 or 1
+                    # the per-category variance follows from counts and sums.
+                    variance = target_mean * (1 - target_mean)
+                    squared_diffs = sums - sums ** 2 / counts
+                    shrinkage = variance * counts / (
+                        variance * counts + squared_diffs / counts)
+                    encoding = np.where(
+                        np.isnan(shrinkage), target_mean,
+                        shrinkage * means + (1 - shrinkage) * target_mean)
+                else:
+                    encoding = (sums + smooth * target_mean) / (
+                        counts + smooth)
+            encodings.append(encoding)
+        return target_mean, encodings
+
+    def apply(self, encoder):
+        """ Set a fitted TargetEncoder's categories and encodings to the
+        ones learned from these statistics.
+        """
+        encoder.target_mean_, encoder.encodings_ = self.encodings(
+            encoder.smooth)
+        encoder.categories_ = list(self.categories)
+
+
+def load_run(flow_name, run_id):
+    """ Return a Metaflow run by id, whoever started it.
+
+    Every step process starts in the namespace of the current user, so
+    each step reading the base run leaves it.
+    """
+    from metaflow import Run, namespace
+
+    namespace(None)
+    return Run(f"{flow_name}/{run_id}")
+
+
+def base_run(flow_name, run_id=None):
+    """ Return the Metaflow run whose model is updated, the latest
+    successful run of the flow unless a run id is given.
+    """
+    from metaflow import Flow
+
+    if run_id:
+        run = load_run(flow_name, run_id)
+    else:
+        run = Flow(flow_name).latest_successful_run
+    if run is None or "encoder_statistics" not in run.data:
+        message = ("No run with incremental training state to update, "
+                   "train a full model first")
+        raise ValueError(message)
+    return run
+
+
+def target_encoder(pipeline):
+    """ Return the fitted TargetEncoder of a pipeline from build_pipeline,
+    and the columns it encodes.
+    """
+    union = pipeline.named_steps["feature_engineering"].named_steps[
+        "features"]
+    column_transformer = dict(union.transformer_list)["categories"]
+    encoder = column_transformer.named_transformers_["target_encode"]
+    return encoder, list(encoder.feature_names_in_)
+
+
+def encoder_statistics(pipeline, train_x, train_y):
+    """ Return the statistics of the data the pipeline's TargetEncoder was
+    fitted on, ``train_x`` being a pandas DataFrame.
+    """
+    _, columns = target_encoder(pipeline)
+    return EncoderStatistics.from_data(train_x, train_y, columns)
+
+
+def update_pipeline(pipeline, statistics, train_x, train_y, new_trees,
+                    replace_trees=False, sample_weight=None):
+    """ Update a fitted pipeline in place with new training data.
+
+    The new trees are grown on the new data encoded with the statistics
+    from before it, so they never see their own targets in the encodings.
+    The encoder is then updated with the new data. With ``replace_trees``
+    as many of the oldest trees are dropped, keeping the forest size.
+    Returns the updated statistics.
+    """
+    train_y = np.asarray(train_y)
+    forest = pipeline.named_steps["model"]
+    if len(np.unique(train_y)) != len(forest.classes_):
+        message = "New data must contain every class to grow trees on it"
+        raise ValueError(message)
+    features = pipeline.named_steps["feature_engineering"].transform(train_x)
+
+    if replace_trees:
+        forest.estimators_ = forest.estimators_[new_trees:]
+    forest.set_params(warm_start=True,
+                      n_estimators=len(forest.estimators_) + new_trees)
+    forest.fit(features, train_y, sample_weight=sample_weight)
+    forest.set_params(warm_start=False)
+
+    encoder, columns = target_encoder(pipeline)
+    statistics = statistics.merge(
+        EncoderStatistics.from_data(train_x, train_y, columns))
+    statistics.apply(encoder)
+    return statistics
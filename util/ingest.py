@@ -0,0 +1,89 @@
+""" Out-of-core ingest of the raw transactions CSV into a Parquet cache.
+
+The CSV is scanned lazily and preprocessed by the streaming engine, so it is
+never fully materialized in memory. The result is written once as a typed,
+compressed Parquet file whose name contains a hash of the source file, so
+later runs on the same file find it and skip CSV parsing completely.
+"""
+import hashlib
+import os
+from pathlib import Path
+
+import polars as pl
+
+from util.preprocessing import preprocess_lazy
+
+# Bump when the preprocessing changes so stale caches are not reused.
+CACHE_VERSION = 1
+
+SOURCE_SCHEMA = {
+    "User": pl.Int64,
+    "Card": pl.Int64,
+    "Year": pl.Int64,
+    "Month": pl.Int64,
+    "Day": pl.Int64,
+    "Time": pl.String,
+    "Amount": pl.String,
+    "Use Chip": pl.String,
+    "Merchant Name": pl.Int64,
+    "Merchant City": pl.String,
+    "Merchant State": pl.String,
+    "Zip": pl.Float64,
+    "MCC": pl.Int64,
+    "Errors?": pl.String,
+    "Is Fraud?": pl.String,
+}
+
+
+def file_digest(path, chunk_size=8 * 1024 * 1024):
+    """ Return the blake2b hex digest of a file, read in chunks. """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as source:
+        while chunk := source.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_partitions(source):
+    """ Return the CSV partitions of a source, either a single CSV file or a
+    directory of them, in file name order.
+    """
+    source = Path(source)
+    if source.is_dir():
+        return sorted(source.glob("*.csv"))
+    return [source]
+
+
+def cache_path(source_file, cache_dir):
+    """ Return the Parquet cache location for a source CSV file. """
+    name = f"{Path(source_file).stem}-v{CACHE_VERSION}-\
+{file_digest(source_file)}.parquet"
+    return Path(cache_dir) / name
+
+
+def ingest_csv(source_file, cache_dir, compression="zstd"):
+    """ Preprocess a transactions CSV into the Parquet cache if needed.
+
+    Returns the path to the cached Parquet file. The file is written to a
+    temporary name and renamed once complete, so an interrupted run never
+    leaves a partial cache behind.
+    """
+    path = cache_path(source_file, cache_dir)
+    if path.exists():
+        print(f"Using cached dataset {path}")
+        return path
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_suffix(".parquet.partial")
+    plan = preprocess_lazy(
+        pl.scan_csv(source_file, dtypes=SOURCE_SCHEMA),
+        include_target=True
+    )
+    plan.sink_parquet(partial_path, compression=compression)
+    os.replace(partial_path, path)
+    return path
+
+
+def load_cached(path):
+    """ Memory-map a cached Parquet dataset into a DataFrame. """
+    return pl.read_parquet(path, memory_map=True)
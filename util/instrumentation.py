@@ -0,0 +1,211 @@
+""" Per-stage latency instrumentation for scoring transactions.
+
+Recorders time named stages (target encoding, scaling, forest traversal,
+response building, ...) labelled with a bucketed batch size. ``StageProfile``
+keeps the timings in memory for offline profiling, ``PrometheusStages``
+observes them into a Prometheus histogram for the service. Both sample a
+configurable share of calls, and passing ``None`` instead of a recorder
+turns timing off entirely. ``track_resources`` measures the wall-clock and
+peak memory of coarser jobs such as training steps.
+"""
+import math
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+from util.categories import CODES_STEP
+from util.compiled_pipeline import ENCODE, SCALE, CompiledPipeline
+
+# Histogram buckets in seconds, from 50 microseconds to 2.5 seconds.
+STAGE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf"))
+
+# Stage names of the FeatureUnion parts built by build_pipeline.
+UNION_STAGES = {"categories": "target_encoding", "scaled": "scaling"}
+
+
+def batch_size_label(batch_size):
+    """ Bucket a batch size into a power of ten to bound label counts. """
+    if batch_size <= 1:
+        return "1"
+    return f"<={10 ** math.ceil(math.log10(batch_size))}"
+
+
+class StageRecorder(ABC):
+    """ Base class for recorders, subclasses implement ``record``. """
+
+    def __init__(self, sample_rate=1.0):
+        self.sample_rate = sample_rate
+
+    def sample(self):
+        """ Return the recorder for a sampled call and None otherwise. """
+        if self.sample_rate >= 1 or random.random() < self.sample_rate:
+            return self
+        return None
+
+    @abstractmethod
+    def record(self, stage, batch_size, seconds):
+        """ Record the duration of one stage. """
+
+    @contextmanager
+    def stage(self, stage, batch_size):
+        """ Time the body of the ``with`` block as ``stage``. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, batch_size, time.perf_counter() - start)
+
+
+def timed(recorder, stage, batch_size):
+    """ Time a stage with ``recorder``, or do nothing if it is None. """
+    if recorder is None:
+        return nullcontext()
+    return recorder.stage(stage, batch_size)
+
+
+class StageProfile(StageRecorder):
+    """ Keep stage timings in memory for offline profiling. """
+
+    def __init__(self, sample_rate=1.0):
+        super().__init__(sample_rate)
+        self.timings = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Pickle the timings without the lock. """
+        return {"sample_rate": self.sample_rate,
+                "timings": dict(self.timings)}
+
+    def __setstate__(self, state):
+        """ Restore pickled timings with a fresh lock. """
+        self.__init__(state["sample_rate"])
+        self.timings.update(state["timings"])
+
+    def record(self, stage, batch_size, seconds):
+        """ Store the duration under its stage and batch size bucket. """
+        with self._lock:
+            self.timings[(stage, batch_size_label(batch_size))].append(
+                seconds)
+
+    def merge(self, other):
+        """ Add the timings of another profile, e.g. a worker process's. """
+        with self._lock:
+            for key, seconds in other.timings.items():
+                self.timings[key].extend(seconds)
+
+    def summary(self):
+        """ Return count, total and latency percentiles per stage. """
+        rows = []
+        for (stage, batch_size), seconds in sorted(self.timings.items()):
+            milliseconds = np.asarray(seconds) * 1_000
+            rows.append({
+                "stage": stage,
+                "batch_size": batch_size,
+                "count": len(milliseconds),
+                "total_ms": float(milliseconds.sum()),
+                "p50_ms": float(np.percentile(milliseconds, 50)),
+                "p99_ms": float(np.percentile(milliseconds, 99)),
+            })
+        return rows
+
+    def format_summary(self):
+        """ Return the summary as a printable table. """
+        lines = [f"{'stage':>18} {'batch':>9} {'count':>7} {'total ms':>10} "
+                 f"{'p50 ms':>8} {'p99 ms':>8}"]
+        for row in self.summary():
+            lines.append(
+                f"{row['stage']:>18} {row['batch_size']:>9} "
+                f"{row['count']:>7} {row['total_ms']:>10.2f} "
+                f"{row['p50_ms']:>8.3f} {row['p99_ms']:>8.3f}")
+        return "\n".join(lines)
+
+
+class PrometheusStages(StageRecorder):
+    """ Observe stage timings into a Prometheus histogram with ``stage`` and
+    ``batch_size`` labels.
+    """
+
+    def __init__(self, histogram, sample_rate=1.0):
+        super().__init__(sample_rate)
+        self.histogram = histogram
+
+    def record(self, stage, batch_size, seconds):
+        """ Observe the duration in the histogram. """
+        self.histogram.labels(
+            stage=stage, batch_size=batch_size_label(batch_size)
+        ).observe(seconds)
+
+
+def timed_predict_proba(model, data, batch_size, recorder=None):
+    """ Run ``predict_proba`` stage by stage, timing each one.
+
+    Works with both the sklearn pipeline from ``build_pipeline`` and its
+    compiled engine, and returns the same probabilities as calling
+    ``model.predict_proba(data)``.
+    """
+    if recorder is None:
+        return model.predict_proba(data)
+    if isinstance(model, CompiledPipeline):
+        with timed(recorder, "target_encoding", batch_size):
+            encoded = model.feature_values(data, ENCODE)
+        with timed(recorder, "scaling", batch_size):
+            scaled = model.feature_values(data, SCALE)
+        features = model.stack_features({**encoded, **scaled})
+        with timed(recorder, "forest", batch_size):
+            return model.score_features(features)
+
+    if CODES_STEP in model.named_steps:
+        with timed(recorder, "category_codes", batch_size):
+            data = model.named_steps[CODES_STEP].transform(data)
+    union = model.named_steps["feature_engineering"].named_steps["features"]
+    parts = []
+    for name, transformer in union.transformer_list:
+        with timed(recorder, UNION_STAGES.get(name, name), batch_size):
+            parts.append(transformer.transform(data))
+    with timed(recorder, "forest", batch_size):
+        return model.named_steps["model"].predict_proba(np.hstack(parts))
+
+
+def _rss_bytes():
+    """ Return the resident set size of this process, or None if unknown. """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+@contextmanager
+def track_resources(interval=0.05):
+    """ Measure the wall-clock and peak resident memory of the ``with`` block.
+
+    Yields a dict filled with ``seconds`` and ``peak_memory_mb`` when the
+    block exits. Memory is sampled from a background thread every
+    ``interval`` seconds, so the peak is relative to the whole process.
+    """
+    usage = {}
+    samples = [_rss_bytes() or 0]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            samples.append(_rss_bytes() or 0)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        usage["seconds"] = time.perf_counter() - start
+        done.set()
+        sampler.join()
+        samples.append(_rss_bytes() or 0)
+        usage["peak_memory_mb"] = max(samples) / 1024 ** 2
@@ -1,37 +1,55 @@
 """ Use the trained model to predict if a transaction is fraudulent or not. """
+import os
+
 import polars as pl
-import streamlit as st
+from joblib import load
+
+from util import preprocessing
+from util.compiled_pipeline import CompiledPipeline, compile_pipeline
+from util.evaluation import predict_classes
+from util.velocity import (
+    backfill,
+    missing_velocity_columns,
+    require_velocity_columns,
+)
+
+
+def load_model(path, compiled=True):
+    """ Load the joblib inference pipeline, compiled for fast scoring unless
+    told otherwise. A directory is loaded as an already compiled,
+    memory-mapped engine.
+    """
+    if os.path.isdir(path):
+        return CompiledPipeline.load(path)
+    model = load(path)
+    if compiled:
+        model = compile_pipeline(model)
+    return model
 
 
 def preprocess_dataset(data_df):
     """ Preprocess dataset for EDA. """
-    new_data_df = data_df.with_columns(
-        Hour = pl.col("Time").map_elements(
-            lambda x: x[:2]).cast(pl.Int64, strict=True),
-        Minute = pl.col("Time").map_elements(
-            lambda x: x[3:]).cast(pl.Int64, strict=True),
-    ).drop("Time").with_columns(
-        pl.col("Amount").map_elements(
-            lambda x: x.replace("$", "")).cast(pl.Float64, strict=True)
-    ).with_columns(
-        pl.col("Merchant State").fill_null("ONLINE")
-    ).with_columns(
-        pl.col("Zip").cast(pl.String, strict=True).fill_null("ONLINE")
-    ).with_columns(
-        pl.col("Errors?").fill_null(value="No")
-    )
-    return new_data_df
+    return preprocessing.preprocess_dataset(data_df)
 
 
 def predict_transaction(model, data_df):
     """ Use our model to predict if the transaction is fraudulent or legitimate
-    and return the results in a dataframe.
+    and return the predicted class with the probability of each class.
+    A lone transaction has no card history, so a model reading velocity
+    features needs them in ``data_df``.
     """
-    st.single_transact = model.predict(data_df), model.predict_proba(
-        data_df)[0]
+    require_velocity_columns(model, data_df.columns, "Transaction scoring")
+    probabilities = model.predict_proba(data_df)
+    return int(predict_classes(model, probabilities)[0]), probabilities[0]
 
 
 def predict_file(model, data_df):
-    """ Use our model to verify multiple transactions from a file. """
+    """ Use our model to verify multiple transactions from a file. For large
+    files use ``util.batch_scoring``, which scores in parallel chunks.
+    Velocity features the model reads are backfilled from the file itself.
+    """
     data_df = preprocess_dataset(data_df)
-    st.multiple_transacts = pl.DataFrame({"Predicted_Is_Fraud?": model.predict(data_df)})
+    if missing_velocity_columns(model, data_df.columns):
+        data_df = backfill(data_df, by_time=True)
+    return pl.DataFrame({"Predicted_Is_Fraud?": predict_classes(
+        model, model.predict_proba(data_df))})
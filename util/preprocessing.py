@@ -0,0 +1,45 @@
+""" Shared preprocessing used by both the training flow and the serving code.
+
+Every transformation is a native polars expression evaluated in a single
+projection over a lazy plan, so no python code runs per row.
+"""
+import polars as pl
+
+TARGET_COLUMN = "Is Fraud?"
+
+
+def preprocessing_expressions(include_target=False):
+    """ Return the list of expressions that clean a raw transactions frame. """
+    time = pl.col("Time")
+    expressions = [
+        time.str.slice(0, 2).cast(pl.Int64, strict=True).alias("Hour"),
+        time.str.slice(3).cast(pl.Int64, strict=True).alias("Minute"),
+        pl.col("Amount").str.replace_all("$", "", literal=True).cast(
+            pl.Float64, strict=True),
+        pl.col("Merchant State").fill_null("ONLINE"),
+        pl.col("Zip").cast(pl.String, strict=True).fill_null("ONLINE"),
+        pl.col("Errors?").fill_null(value="No"),
+    ]
+    if include_target:
+        expressions.append(
+            (pl.col(TARGET_COLUMN) != "No").cast(pl.Int64))
+    return expressions
+
+
+def preprocess_lazy(data, include_target=False):
+    """ Build the lazy preprocessing plan for a DataFrame or LazyFrame. """
+    return data.lazy().with_columns(
+        preprocessing_expressions(include_target)
+    ).drop("Time")
+
+
+def preprocess_dataset(data, include_target=False):
+    """ Preprocess a raw transactions dataset in one pass.
+
+    A LazyFrame input returns a LazyFrame so callers can keep extending the
+    plan, a DataFrame input is collected and returned as a DataFrame.
+    """
+    plan = preprocess_lazy(data, include_target)
+    if isinstance(data, pl.LazyFrame):
+        return plan
+    return plan.collect()
@@ -0,0 +1,148 @@
+""" Class rebalancing strategies for training on highly imbalanced data.
+
+Fraud is roughly 0.1% of the transactions, so oversampling the whole training
+set with SMOTE creates millions of synthetic rows. The strategies here trade
+that for bounded memory:
+
+- ``smote``: SMOTE over the full training set, the original behaviour.
+- ``chunked_smote``: SMOTE over chunks of the majority class, each with all
+  the fraud rows, keeping the majority class within the memory budget. When
+  it does not fit, a random sample of it is kept and the number of rows
+  dropped is reported, see ``dropped_majority_rows``.
+- ``undersample``: keep every fraud row and a random sample of legitimate
+  rows, ``majority_ratio`` legitimate rows per fraud row.
+- ``class_weight``: keep the data as is and weight samples inversely to
+  their class frequency when fitting the forest.
+"""
+import numpy as np
+import polars as pl
+
+STRATEGIES = ("smote", "chunked_smote", "undersample", "class_weight")
+
+
+def _class_indices(train_y):
+    """ Return the row indices of the majority and minority classes. """
+    labels = train_y.to_series().to_numpy()
+    values, counts = np.unique(labels, return_counts=True)
+    minority = values[np.argmin(counts)]
+    return np.flatnonzero(labels != minority), np.flatnonzero(
+        labels == minority)
+
+
+def budget_rows(train_x, memory_budget_mb):
+    """ Return how many training rows fit in the memory budget, assuming the
+    rebalanced copy, its pandas conversion and SMOTE's working set each need
+    about as much as the rows themselves.
+    """
+    row_bytes = train_x.estimated_size() / max(len(train_x), 1)
+    return max(int(memory_budget_mb * 1024 ** 2 / (3 * row_bytes)), 1)
+
+
+def majority_budget(train_x, memory_budget_mb):
+    """ Return how many majority rows ``chunked_smote`` keeps at most: half
+    of the budget, the other half is for synthetic fraud rows.
+    """
+    return budget_rows(train_x, memory_budget_mb) // 2
+
+
+def dropped_majority_rows(train_x, train_y, memory_budget_mb):
+    """ Return how many majority rows ``chunked_smote`` drops to stay within
+    the memory budget.
+    """
+    majority, _ = _class_indices(train_y)
+    return max(len(majority) - majority_budget(train_x, memory_budget_mb), 0)
+
+
+def _smote(train_x, train_y, random_state):
+    """ Oversample the minority class over the full training set. """
+    from imblearn.over_sampling import SMOTE
+
+    train_x_res, train_y_res = SMOTE(random_state=random_state).fit_resample(
+        train_x.to_pandas(), train_y.to_pandas())
+    return train_x_res, train_y_res.to_numpy().ravel(), {}
+
+
+def _chunked_smote(train_x, train_y, memory_budget_mb, random_state):
+    """ Oversample the minority class chunk by chunk of majority rows. """
+    from imblearn.over_sampling import SMOTE
+
+    rng = np.random.default_rng(random_state)
+    majority, minority = _class_indices(train_y)
+    max_majority = majority_budget(train_x, memory_budget_mb)
+    if len(majority) > max_majority:
+        print(f"Majority class over the memory budget, dropping "
+              f"{len(majority) - max_majority} of its {len(majority)} rows")
+        majority = rng.choice(majority, max_majority, replace=False)
+    rng.shuffle(majority)
+
+    minority_x = train_x[minority]
+    minority_y = train_y[minority]
+    chunk_size = max(len(minority), max_majority // 8, 1)
+    x_parts, y_parts = [minority_x], [minority_y]
+    for start in range(0, len(majority), chunk_size):
+        chunk = majority[start:start + chunk_size]
+        if len(chunk) <= len(minority):
+            # SMOTE would oversample the majority rows of a short last
+            # chunk, there is no fraud to add for it.
+            x_parts.append(train_x[chunk])
+            y_parts.append(train_y[chunk])
+            continue
+        chunk_x = pl.concat([train_x[chunk], minority_x])
+        chunk_y = pl.concat([train_y[chunk], minority_y])
+        sampler = SMOTE(random_state=random_state)
+        chunk_x_res, chunk_y_res = sampler.fit_resample(
+            chunk_x.to_pandas(), chunk_y.to_pandas())
+        # imblearn keeps the input rows first and appends synthetic rows,
+        # keep the chunk's majority rows and the synthetic fraud rows only.
+        x_parts += [train_x[chunk],
+                    pl.from_pandas(chunk_x_res.iloc[len(chunk_x):])]
+        y_parts += [train_y[chunk],
+                    pl.from_pandas(chunk_y_res.iloc[len(chunk_y):])]
+    return (
+        pl.concat(x_parts, how="vertical_relaxed").to_pandas(),
+        pl.concat(y_parts, how="vertical_relaxed").to_series().to_numpy(),
+        {},
+    )
+
+
+def _undersample(train_x, train_y, majority_ratio, random_state):
+    """ Keep every minority row and a sample of the majority rows. """
+    rng = np.random.default_rng(random_state)
+    majority, minority = _class_indices(train_y)
+    keep = min(len(majority), int(len(minority) * majority_ratio))
+    rows = np.sort(np.concatenate([
+        minority, rng.choice(majority, keep, replace=False)]))
+    return (train_x[rows].to_pandas(),
+            train_y[rows].to_series().to_numpy(), {})
+
+
+def _class_weight(train_x, train_y):
+    """ Keep all rows and weight them inversely to their class frequency. """
+    from sklearn.utils.class_weight import compute_sample_weight
+
+    labels = train_y.to_series().to_numpy()
+    return (train_x.to_pandas(), labels,
+            {"model__sample_weight": compute_sample_weight("balanced",
+                                                           labels)})
+
+
+def rebalance(train_x, train_y, strategy="smote", memory_budget_mb=4096,
+              majority_ratio=1.0, random_state=0):
+    """ Rebalance the training set with the given strategy.
+
+    ``train_x`` and ``train_y`` are polars DataFrames. Returns the features
+    as a pandas DataFrame, the labels as a NumPy array and the extra fit
+    parameters for the training pipeline.
+    """
+    if strategy == "smote":
+        return _smote(train_x, train_y, random_state)
+    if strategy == "chunked_smote":
+        return _chunked_smote(train_x, train_y, memory_budget_mb,
+                              random_state)
+    if strategy == "undersample":
+        return _undersample(train_x, train_y, majority_ratio, random_state)
+    if strategy == "class_weight":
+        return _class_weight(train_x, train_y)
+    message = (f"Unknown rebalancing strategy {strategy!r}, use one of "
+               f"{STRATEGIES}")
+    raise ValueError(message)
@@ -0,0 +1,318 @@
+""" Asynchronous scoring of JSONL transaction feeds.
+
+Raw transactions, one JSON object per line, are read from a file, which can
+be tailed as it grows, or from stdin. Records are batched until a batch is
+full or its oldest record has waited long enough, and batches are parsed,
+preprocessed with the shared preprocessing and scored on a thread or process
+pool while reading goes on. Scored records are written as JSONL in input
+order, each with its prediction columns added.
+
+Every stage is connected by a bounded queue, so a slow writer or slow
+scoring pauses reading instead of buffering the feed in memory. After each
+batch is written and flushed, the input offset following it is saved to a
+checkpoint file, and a restarted scorer resumes from there: every record is
+scored at least once, records written after the last checkpoint may be
+written again. Run from the command line with:
+
+    python -m util.stream_scoring feed.jsonl scored.jsonl --follow \
+--checkpoint scored.checkpoint --model model/compiled_pipeline
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import polars as pl
+
+from util.batch_scoring import (
+    PREDICTION_COLUMN,
+    PROBABILITY_COLUMN,
+    load_worker_model,
+    score_chunk,
+)
+from util.ingest import SOURCE_SCHEMA
+from util.is_fraud import load_model
+from util.preprocessing import TARGET_COLUMN
+from util.velocity import require_velocity_columns
+
+FEATURE_SCHEMA = {column: dtype for column, dtype in SOURCE_SCHEMA.items()
+                  if column != TARGET_COLUMN}
+# JSON values accepted for each column dtype.
+JSON_TYPES = {pl.Int64: (int,), pl.Float64: (int, float), pl.String: (str,)}
+
+
+def load_checkpoint(path, source):
+    """ Return the input offset saved in a checkpoint file, 0 if none. """
+    if path is None or not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint["source"] != str(source):
+        message = (f"Checkpoint {path} is for {checkpoint['source']}, not "
+                   f"{source}")
+        raise ValueError(message)
+    return checkpoint["offset"]
+
+
+def save_checkpoint(path, source, offset):
+    """ Atomically save the input offset up to which results are written. """
+    partial_path = f"{path}.partial"
+    with open(partial_path, "w") as checkpoint_file:
+        json.dump({"source": str(source), "offset": offset}, checkpoint_file)
+    os.replace(partial_path, path)
+
+
+def _typed_column(records, column, dtype):
+    """ Return a column of the records as a Series of the given dtype,
+    raising on values of another JSON type rather than losing them.
+    """
+    values = [record.get(column) for record in records]
+    types = JSON_TYPES[dtype]
+    for value in values:
+        if value is not None and (isinstance(value, bool)
+                                  or not isinstance(value, types)):
+            message = f"{column} must be {dtype}, not {value!r}"
+            raise TypeError(message)
+    return pl.Series(column, values, dtype=dtype)
+
+
+def parse_records(lines):
+    """ Return the objects of JSONL lines, and a DataFrame of them typed like
+    the source CSV for preprocessing. Fields a record leaves out are missing
+    values.
+    """
+    records = [json.loads(line) for line in lines]
+    data_df = pl.DataFrame([
+        _typed_column(records, column, dtype)
+        for column, dtype in FEATURE_SCHEMA.items()
+    ])
+    return records, data_df
+
+
+def score_lines(lines, model=None):
+    """ Score JSONL lines, returning the records with their prediction
+    columns added as JSONL bytes. Other fields, such as ids, are kept.
+
+    When a batch cannot be parsed or scored, its records are scored one by
+    one and the failing ones are written back with an ``error`` field.
+    """
+    try:
+        records, data_df = parse_records(lines)
+        scored_df = score_chunk(data_df, model)
+        predictions = scored_df.get_column(PREDICTION_COLUMN).to_list()
+        probabilities = scored_df.get_column(PROBABILITY_COLUMN).to_list()
+        return "".join(
+            json.dumps({**record, PREDICTION_COLUMN: prediction,
+                        PROBABILITY_COLUMN: probability}) + "\n"
+            for record, prediction, probability
+            in zip(records, predictions, probabilities)
+        ).encode()
+    except Exception as error:
+        if len(lines) == 1:
+            return json.dumps({
+                "error": f"{type(error).__name__}: {error}",
+                "record": lines[0].decode(errors="replace"),
+            }).encode() + b"\n"
+        return b"".join(score_lines([line], model) for line in lines)
+
+
+async def read_lines(stream, records, offset, follow, poll_interval, stop,
+                     read_size=1024 * 1024):
+    """ Put (line, end offset) pairs read from a binary stream on the
+    ``records`` queue, then None.
+
+    At the end of the stream, wait for it to grow when ``follow`` is set, a
+    trailing line without a newline is only taken once the stream ends.
+    """
+    read = getattr(stream, "read1", stream.read)
+    remainder = b""
+    while not stop.is_set():
+        data = await asyncio.to_thread(read, read_size)
+        if not data:
+            if follow:
+                await asyncio.sleep(poll_interval)
+                continue
+            break
+        *lines, remainder = (remainder + data).split(b"\n")
+        for line in lines:
+            offset += len(line) + 1
+            if line.strip():
+                await records.put((line, offset))
+    if remainder.strip() and not stop.is_set():
+        await records.put((remainder, offset + len(remainder)))
+    await records.put(None)
+
+
+async def batch_records(records, batches, batch_size, max_wait, submit):
+    """ Group records into batches of ``batch_size`` or of what arrived
+    within ``max_wait`` seconds of their first record, submit them for
+    scoring and put (scoring future, end offset, size) on ``batches``,
+    then None.
+    """
+    loop = asyncio.get_running_loop()
+    done = False
+    while not done:
+        record = await records.get()
+        if record is None:
+            break
+        lines, offset = [record[0]], record[1]
+        deadline = loop.time() + max_wait
+        while len(lines) < batch_size:
+            try:
+                record = records.get_nowait()
+            except asyncio.QueueEmpty:
+                try:
+                    record = await asyncio.wait_for(
+                        records.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    break
+            if record is None:
+                done = True
+                break
+            lines.append(record[0])
+            offset = record[1]
+        await batches.put((submit(lines), offset, len(lines)))
+    await batches.put(None)
+
+
+async def write_results(batches, output, checkpoint, source, progress=None):
+    """ Write scored batches in input order, saving the checkpoint after
+    each one. Returns the number of records written.
+    """
+    written = 0
+    while (batch := await batches.get()) is not None:
+        future, offset, size = batch
+        scored = await future
+        await asyncio.to_thread(_write_flushed, output, scored)
+        written += size
+        if checkpoint is not None:
+            await asyncio.to_thread(save_checkpoint, checkpoint, source,
+                                    offset)
+        if progress is not None:
+            progress(written, offset)
+    return written
+
+
+def _write_flushed(output, data):
+    """ Write to a binary file and make sure it reached the disk. """
+    output.write(data)
+    output.flush()
+    if output.seekable():
+        os.fsync(output.fileno())
+
+
+async def score_stream(source, output, model, batch_size=1_000,
+                       max_wait=0.2, workers=4, processes=False,
+                       follow=False, poll_interval=0.5, checkpoint=None,
+                       progress=None):
+    """ Score a JSONL feed into a JSONL output until the feed ends, or until
+    SIGINT or SIGTERM when following it.
+
+    ``source`` and ``output`` are paths, or "-" for stdin and stdout.
+    ``model`` is a model path, or with threads an already loaded model.
+    Returns the number of records scored. Records carry no velocity
+    features, so models reading them are refused before reading starts.
+    """
+    loaded = (load_model(model) if isinstance(model, (str, os.PathLike))
+              else model)
+    require_velocity_columns(loaded, FEATURE_SCHEMA, "Stream scoring")
+    if processes:
+        # Only loaded for the check, each worker process loads its own.
+        del loaded
+        executor = ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_worker_model,
+            initargs=(model,)
+        )
+        model = None
+    else:
+        model = loaded
+        executor = ThreadPoolExecutor(workers)
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    offset = load_checkpoint(checkpoint, source)
+
+    def submit(lines):
+        return loop.run_in_executor(executor, score_lines, lines, model)
+
+    # Unwound in reverse: the executor is shut down before the files are
+    # closed and the signal handlers removed.
+    with contextlib.ExitStack() as stack:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+            stack.callback(loop.remove_signal_handler, signum)
+        if source == "-":
+            stream = sys.stdin.buffer
+            # Offsets of stdin count from the start of the piped data.
+            skipped = 0
+            while skipped < offset:
+                data = stream.read(min(offset - skipped, 1024 * 1024))
+                if not data:
+                    break
+                skipped += len(data)
+        else:
+            stream = stack.enter_context(open(source, "rb"))
+            stream.seek(offset)
+        output_file = (sys.stdout.buffer if output == "-"
+                       else stack.enter_context(open(output, "ab")))
+        stack.enter_context(executor)
+        # Records waiting to be batched, and batches being scored.
+        records = asyncio.Queue(4 * batch_size)
+        batches = asyncio.Queue(2 * workers)
+        _, _, written = await asyncio.gather(
+            read_lines(stream, records, offset, follow, poll_interval, stop),
+            batch_records(records, batches, batch_size, max_wait, submit),
+            write_results(batches, output_file, checkpoint, source,
+                          progress),
+        )
+    return written
+
+
+def main():
+    """ Score a JSONL transactions feed into a JSONL file. """
+    parser = argparse.ArgumentParser(description="Score a JSONL feed of raw \
+transactions.")
+    parser.add_argument("source", help="JSONL file, or - for stdin")
+    parser.add_argument("output", help="JSONL file appended to, or - for \
+stdout")
+    parser.add_argument("--model", default="model/inference_pipeline.joblib",
+                        help="Joblib pipeline or compiled model directory")
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    parser.add_argument("--max-wait-ms", type=float, default=200,
+                        help="Score a partial batch once its first record \
+has waited this long")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--processes", action="store_true",
+                        help="Score on a process pool instead of threads")
+    parser.add_argument("--follow", action="store_true",
+                        help="Keep waiting for new records at the end of the \
+file, until interrupted")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--checkpoint", help="File saving the input offset \
+scored so far, to resume from")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    def progress(written, offset):
+        print(f"Scored {written} transactions, offset {offset}",
+              file=sys.stderr, flush=True)
+
+    written = asyncio.run(score_stream(
+        args.source, args.output, args.model, args.batch_size,
+        args.max_wait_ms / 1000, args.workers, args.processes, args.follow,
+        args.poll_interval, args.checkpoint, progress))
+    print(f"Scored {written} transactions in "
+          f"{time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
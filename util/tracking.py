@@ -0,0 +1,459 @@
+""" Buffered, asynchronous experiment tracking for the training flow.
+
+Flow steps used to open the mlflow run at the start of every step and make
+one blocking HTTP request per logged param, metric or artifact, so a slow
+or missing tracking server stalled or failed training. Here every call is
+appended to a journal instead, one JSON line per call in a file per process
+under the tracking directory, and artifacts and models are written next to
+it. Run ids are generated locally, so nothing waits for the server.
+
+A background thread replays the journals into the tracking server every few
+seconds, in batches: all the params and metrics a run logged since the last
+replay go in one ``log_batch`` request. What is left is replayed when the
+process exits. In offline mode nothing is sent, and the journals are replayed
+later, from any machine reaching the server, with:
+
+    python -m util.tracking data/cache/tracking --tracking-uri URI
+
+Replaying is incremental and resumable: the offsets reached in every journal
+and the server run id of every local one are kept in ``sync.json``.
+"""
+import argparse
+import atexit
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+
+TRACKING_URI = "http://127.0.0.1:5000"
+# Seconds between two replays of the journals into the tracking server.
+FLUSH_INTERVAL = 5.0
+# Seconds to wait for the tracking server to answer before giving up on a
+# replay, instead of the minute of retries of mlflow's client.
+HEALTH_TIMEOUT = 5.0
+# Tag holding the local id of a run on the tracking server.
+LOCAL_RUN_ID_TAG = "tracking.local_run_id"
+# Limits of a log_batch request enforced by mlflow servers.
+MAX_BATCH_PARAMS = 100
+MAX_BATCH_METRICS = 1000
+MAX_BATCH_ENTITIES = 1000
+
+_tracker = None
+_active_runs = []
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+@functools.lru_cache(maxsize=None)
+def _context_tags():
+    """ Return the tags mlflow gives new runs: user, source, git commit. """
+    from mlflow.tracking.context.registry import resolve_tags
+
+    return {key: str(value) for key, value in resolve_tags().items()}
+
+
+class Tracker:
+    """ Journal of the tracking calls of a process, replayed in the
+    background unless offline.
+    """
+
+    def __init__(self, directory, tracking_uri=TRACKING_URI, offline=False,
+                 flush_interval=FLUSH_INTERVAL):
+        self.directory = Path(directory)
+        self.tracking_uri = tracking_uri
+        self.offline = offline
+        self.flush_interval = flush_interval
+        self.journal_path = (
+            self.directory / "journal"
+            / f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+              ".jsonl")
+        self._files = contextlib.ExitStack()
+        self._journal = None
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        if not offline:
+            self._thread = threading.Thread(target=self._replay_loop,
+                                            name="tracking", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def artifact_path(self, run_id, artifact_file):
+        """ Return where a run's artifact is written before it is sent. """
+        return self.directory / "artifacts" / run_id / artifact_file
+
+    def record(self, op, run_id, **fields):
+        """ Append a call to the journal. """
+        with self._lock:
+            if self._journal is None:
+                self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+                self._journal = self._files.enter_context(
+                    self.journal_path.open("a"))
+            self._sequence += 1
+            self._journal.write(json.dumps({
+                "op": op, "run": run_id, "time": _now_ms(),
+                "sequence": self._sequence, **fields}) + "\n")
+            # Readable by the replay thread and other processes right away.
+            self._journal.flush()
+
+    def flush(self):
+        """ Replay the journals soon, without waiting for it. """
+        self._wake.set()
+
+    def _replay(self, blocking):
+        try:
+            replay(self.directory, self.tracking_uri, blocking=blocking)
+        except Exception as error:  # noqa: BLE001
+            # Kept in the journals, replayed next time.
+            print(f"Tracking server unavailable, calls kept in "
+                  f"{self.directory}: {error}")
+
+    def _replay_loop(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if not self._stopped.is_set():
+                self._replay(blocking=False)
+
+    def close(self):
+        """ Stop the replay thread and replay what is left, if online. """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._wake.set()
+            self._thread.join()
+        with self._lock:
+            self._files.close()
+            self._journal = None
+        if not self.offline:
+            self._replay(blocking=True)
+
+
+def configure(directory, tracking_uri=TRACKING_URI, offline=False,
+              flush_interval=FLUSH_INTERVAL):
+    """ Journal the tracking calls of this process under ``directory``. """
+    global _tracker
+    if _tracker is not None:
+        _tracker.close()
+    _tracker = Tracker(directory, tracking_uri, offline, flush_interval)
+    return _tracker
+
+
+def _active_tracker():
+    if _tracker is None:
+        message = "Call util.tracking.configure first"
+        raise RuntimeError(message)
+    return _tracker
+
+
+@contextlib.contextmanager
+def start_run(run_id=None, run_name=None, nested=False, experiment=None):
+    """ Make a run active, a new one unless ``run_id`` is given, and yield
+    its id.
+
+    A new nested run is a child of the active one, other new runs go to
+    ``experiment``. The run is ended, finished or failed, on exit.
+    """
+    tracker = _active_tracker()
+    if run_id is None:
+        run_id = uuid.uuid4().hex
+        parent_id = _active_runs[-1] if nested and _active_runs else None
+        tracker.record("create_run", run_id, experiment=experiment,
+                       name=run_name, parent=parent_id,
+                       tags=_context_tags())
+    _active_runs.append(run_id)
+    status = "FAILED"
+    try:
+        yield run_id
+        status = "FINISHED"
+    finally:
+        _active_runs.pop()
+        tracker.record("end_run", run_id, status=status)
+        tracker.flush()
+
+
+def log_params(params):
+    """ Log params to the active run, if any. """
+    if _active_runs:
+        _active_tracker().record(
+            "log_batch", _active_runs[-1],
+            params={key: str(value) for key, value in params.items()})
+
+
+def log_param(key, value):
+    """ Log a param to the active run, if any. """
+    log_params({key: value})
+
+
+def log_metrics(metrics, step=0):
+    """ Log metrics to the active run, if any. """
+    if _active_runs:
+        timestamp = _now_ms()
+        _active_tracker().record(
+            "log_batch", _active_runs[-1],
+            metrics=[[key, float(value), timestamp, step]
+                     for key, value in metrics.items()])
+
+
+def log_dict(dictionary, artifact_file):
+    """ Log a JSON artifact to the active run, if any. """
+    if not _active_runs:
+        return
+    tracker = _active_tracker()
+    path = tracker.artifact_path(_active_runs[-1], artifact_file)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(dictionary, indent=2))
+    tracker.record("log_artifacts", _active_runs[-1],
+                   local_path=str(path.relative_to(tracker.directory)),
+                   artifact_path=os.path.dirname(artifact_file) or None)
+
+
+def log_model(sk_model, artifact_path):
+    """ Save a scikit-learn model as an artifact of the active run. """
+    import mlflow
+
+    tracker = _active_tracker()
+    path = tracker.artifact_path(_active_runs[-1], artifact_path)
+    # Left over by an earlier attempt at the same step.
+    shutil.rmtree(path, ignore_errors=True)
+    mlflow.sklearn.save_model(sk_model, path)
+    tracker.record("log_artifacts", _active_runs[-1],
+                   local_path=str(path.relative_to(tracker.directory)),
+                   artifact_path=artifact_path)
+
+
+def register_model(artifact_path, name):
+    """ Register a model logged to the active run once it is sent. """
+    _active_tracker().record("register_model", _active_runs[-1],
+                             artifact_path=artifact_path, name=name)
+
+
+def batch_chunks(params, metrics):
+    """ Split the params and metrics of a run into the (params, metrics)
+    pairs of log_batch requests within the server's limits.
+    """
+    params = list(params)
+    metrics = list(metrics)
+    chunks = []
+    while params or metrics:
+        chunk_params = params[:MAX_BATCH_PARAMS]
+        count = min(MAX_BATCH_METRICS,
+                    MAX_BATCH_ENTITIES - len(chunk_params))
+        chunks.append((chunk_params, metrics[:count]))
+        params = params[len(chunk_params):]
+        metrics = metrics[count:]
+    return chunks
+
+
+def _read_entries(path, offset):
+    """ Return the complete journal lines of a file after ``offset``, with
+    the offset following each.
+    """
+    entries = []
+    with open(path, "rb") as journal:
+        journal.seek(offset)
+        for line in journal:
+            if not line.endswith(b"\n"):
+                # Still being written.
+                break
+            offset += len(line)
+            entries.append((json.loads(line), offset))
+    return entries
+
+
+class _Replay:
+    """ Sends journal entries to a tracking server, keeping track of what
+    was sent in the state file.
+    """
+
+    def __init__(self, directory, tracking_uri):
+        from mlflow import MlflowClient
+
+        self.directory = Path(directory)
+        self.client = MlflowClient(tracking_uri)
+        self.state_path = self.directory / "sync.json"
+        self.state = {"offsets": {}, "runs": {}}
+        if self.state_path.exists():
+            self.state = json.loads(self.state_path.read_text())
+        self.experiments = {}
+        self.sent = 0
+
+    def save(self):
+        partial_path = self.state_path.with_suffix(".partial")
+        partial_path.write_text(json.dumps(self.state))
+        os.replace(partial_path, self.state_path)
+
+    def server_run(self, run_id):
+        return self.state["runs"][run_id]["id"]
+
+    def experiment_id(self, entry):
+        if entry["parent"] is not None:
+            return self.state["runs"][entry["parent"]]["experiment"]
+        name = entry["experiment"]
+        if name is None:
+            return "0"
+        if name not in self.experiments:
+            experiment = self.client.get_experiment_by_name(name)
+            self.experiments[name] = (
+                experiment.experiment_id if experiment is not None
+                else self.client.create_experiment(name))
+        return self.experiments[name]
+
+    def create_run(self, entry):
+        from mlflow.utils.mlflow_tags import (
+            MLFLOW_PARENT_RUN_ID,
+            MLFLOW_RUN_NAME,
+        )
+
+        tags = {**entry["tags"], LOCAL_RUN_ID_TAG: entry["run"]}
+        if entry["name"] is not None:
+            tags[MLFLOW_RUN_NAME] = entry["name"]
+        if entry["parent"] is not None:
+            tags[MLFLOW_PARENT_RUN_ID] = self.server_run(entry["parent"])
+        experiment_id = self.experiment_id(entry)
+        run = self.client.create_run(experiment_id,
+                                     start_time=entry["time"], tags=tags,
+                                     run_name=entry["name"])
+        self.state["runs"][entry["run"]] = {"id": run.info.run_id,
+                                            "experiment": experiment_id}
+
+    def log_batches(self, batches):
+        from mlflow.entities import Metric, Param
+
+        for run_id, (params, metrics) in batches.items():
+            for chunk_params, chunk_metrics in batch_chunks(
+                    [Param(key, value) for key, value in params.items()],
+                    [Metric(*metric) for metric in metrics]):
+                self.client.log_batch(self.server_run(run_id),
+                                      metrics=chunk_metrics,
+                                      params=chunk_params)
+
+    def send(self, entry):
+        from mlflow.exceptions import MlflowException
+
+        run_id = self.server_run(entry["run"])
+        if entry["op"] == "end_run":
+            self.client.set_terminated(run_id, entry["status"],
+                                       entry["time"])
+        elif entry["op"] == "log_artifacts":
+            path = self.directory / entry["local_path"]
+            if path.is_dir():
+                self.client.log_artifacts(run_id, str(path),
+                                          entry["artifact_path"])
+            else:
+                self.client.log_artifact(run_id, str(path),
+                                         entry["artifact_path"])
+        elif entry["op"] == "register_model":
+            try:
+                self.client.create_registered_model(entry["name"])
+            except MlflowException as error:
+                if error.error_code != "RESOURCE_ALREADY_EXISTS":
+                    raise
+            artifact_uri = self.client.get_run(run_id).info.artifact_uri
+            self.client.create_model_version(
+                entry["name"], f"{artifact_uri}/{entry['artifact_path']}",
+                run_id)
+        else:
+            message = f"Unknown tracking call {entry['op']}"
+            raise ValueError(message)
+
+    def replay_journal(self, path, entries):
+        """ Send the entries of a journal, merging consecutive params and
+        metrics into one batch per run.
+        """
+        batches = {}
+        offset = self.state["offsets"].get(path.name, 0)
+        for entry, end in entries:
+            if entry["op"] == "log_batch":
+                params, metrics = batches.setdefault(entry["run"], ({}, []))
+                params.update(entry.get("params", {}))
+                metrics.extend(entry.get("metrics", []))
+            elif entry["op"] != "create_run":
+                self.log_batches(batches)
+                batches = {}
+                self.send(entry)
+                # Sent entries are not replayed again if a later one fails.
+                self.state["offsets"][path.name] = offset = end
+                self.save()
+            self.sent += 1
+        self.log_batches(batches)
+        if entries:
+            self.state["offsets"][path.name] = max(offset, entries[-1][1])
+            self.save()
+
+    def run(self):
+        journals = {
+            path: _read_entries(path, self.state["offsets"].get(path.name, 0))
+            for path in sorted((self.directory / "journal").glob("*.jsonl"))
+        }
+        # Runs are created first, their calls may be journaled by any process.
+        creates = sorted(
+            (entry for entries in journals.values() for entry, _ in entries
+             if entry["op"] == "create_run"
+             and entry["run"] not in self.state["runs"]),
+            key=lambda entry: entry["time"])
+        for entry in creates:
+            self.create_run(entry)
+            self.save()
+        for path, entries in journals.items():
+            self.replay_journal(path, entries)
+        return self.sent
+
+
+def _check_server(tracking_uri):
+    """ Raise unless an HTTP tracking server answers its health check. """
+    import requests
+
+    if tracking_uri.startswith(("http://", "https://")):
+        requests.get(f"{tracking_uri.rstrip('/')}/health",
+                     timeout=HEALTH_TIMEOUT).raise_for_status()
+
+
+def replay(directory, tracking_uri=TRACKING_URI, blocking=True):
+    """ Send the journaled calls not sent yet to the tracking server and
+    return how many were sent.
+
+    Only one process replays a directory at a time. Without ``blocking``,
+    nothing is sent while another one is at it.
+    """
+    directory = Path(directory)
+    if not (directory / "journal").is_dir():
+        return 0
+    with open(directory / "sync.lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX
+                        | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            return 0
+        try:
+            _check_server(tracking_uri)
+            return _Replay(directory, tracking_uri).run()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main():
+    """ Replay the tracking calls journaled offline. """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("directory", help="tracking directory of the flow, "
+                                          "under its cache directory")
+    parser.add_argument("--tracking-uri", default=TRACKING_URI)
+    args = parser.parse_args()
+    sent = replay(args.directory, args.tracking_uri)
+    print(f"Sent {sent} tracking call(s) to {args.tracking_uri}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+""" Hyperparameter search trials for the training flow.
+
+A search space maps hyperparameter names to the values to try, for example::
+
+    {"n_estimators": [10, 50], "max_depth": [null, 20],
+     "rebalance": ["undersample", "class_weight"]}
+
+and is expanded into the grid of trials the flow fans out over. Each trial is
+scored for recall and for what it would cost to serve, so the selection can
+trade a little recall for a faster or smaller model.
+"""
+import itertools
+import random
+import time
+
+import numpy as np
+
+from util.compiled_pipeline import FOREST_ARRAYS, compile_pipeline
+
+# Keyword arguments of build_pipeline, plus the rebalancing strategy.
+SEARCH_PARAMETERS = ("n_estimators", "max_depth", "min_samples_leaf",
+                     "smooth", "rebalance")
+
+
+def expand_search_space(search_space, max_trials=None, seed=0):
+    """ Return the grid of trials of a search space as a list of dicts.
+
+    Parameters left out of the search space keep their defaults. When the
+    grid has more than ``max_trials`` trials, a random subset is kept.
+    """
+    unknown = set(search_space) - set(SEARCH_PARAMETERS)
+    if unknown:
+        message = (f"Unknown search parameters {sorted(unknown)}, use any "
+                   f"of {SEARCH_PARAMETERS}")
+        raise ValueError(message)
+    names = sorted(search_space)
+    values = [value if isinstance(value, list) else [value]
+              for value in (search_space[name] for name in names)]
+    trials = [dict(zip(names, combination))
+              for combination in itertools.product(*values)]
+    if max_trials and len(trials) > max_trials:
+        trials = random.Random(seed).sample(trials, max_trials)
+    return trials
+
+
+def model_size_mb(engine):
+    """ Return the size of a compiled engine's forest arrays in MB. """
+    return sum(getattr(engine, name).nbytes
+               for name in FOREST_ARRAYS) / 1024 ** 2
+
+
+def serving_profile(pipeline, data_df, repeat=200, batch_size=1_000):
+    """ Measure what serving the pipeline with the compiled engine costs.
+
+    Returns single-transaction p50 and p99 latencies in milliseconds, the
+    latency of a ``batch_size`` batch, the forest's node count and size.
+    """
+    engine = compile_pipeline(pipeline)
+    records = data_df.head(repeat).to_dict(orient="records")
+    timings = []
+    for record in records:
+        start = time.perf_counter()
+        engine.predict_proba([record])
+        timings.append(time.perf_counter() - start)
+    timings = np.asarray(timings) * 1_000
+    batch_df = data_df.head(batch_size)
+    start = time.perf_counter()
+    engine.predict_proba(batch_df)
+    return {
+        "serving_p50_ms": float(np.percentile(timings, 50)),
+        "serving_p99_ms": float(np.percentile(timings, 99)),
+        "serving_batch_ms": (time.perf_counter() - start) * 1_000,
+        "node_count": int(len(engine.left)),
+        "model_size_mb": model_size_mb(engine),
+    }
+
+
+def select_best(results, recall_tolerance=0.0):
+    """ Return the index of the best trial result.
+
+    Trials within ``recall_tolerance`` of the best validation recall are
+    kept, and the fastest of them to serve wins, the smallest on ties.
+    """
+    best_recall = max(result["validate_recall"] for result in results)
+    candidates = [
+        idx for idx, result in enumerate(results)
+        if result["validate_recall"] >= best_recall - recall_tolerance
+    ]
+    return min(candidates, key=lambda idx: (results[idx]["serving_p50_ms"],
+                                            results[idx]["model_size_mb"]))
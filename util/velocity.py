@@ -0,0 +1,365 @@
+""" Per-card velocity features: recent spend and activity of each card.
+
+Every transaction is described by the history of its card (``User`` and
+``Card``) up to and including itself: the number of transactions and the
+amount spent in the last hour and the last 24 hours, the distinct merchants
+paid in the last 24 hours and the minutes since the card's previous
+transaction, capped at 24 hours.
+
+Serving keeps that history in a ``VelocityStore``, one pair of ring buffers
+per card holding its last hour and last 24 hours of transactions with their
+running totals, so updating and reading the features of a transaction costs
+O(1) amortized whatever the card's history. Training computes the same
+features for a whole dataset at once with ``backfill``, using sorts, prefix
+sums and binary searches instead of replaying transactions one by one.
+
+Both give identical values for the same transactions in the same order.
+Amounts are summed in integer cents so no rounding error builds up. A
+transaction older than its card's latest one counts as happening at that
+latest time, so windows only ever move forward.
+"""
+import os
+import threading
+from collections import deque
+from datetime import date
+
+import numpy as np
+
+# Window lengths in minutes, the resolution of transaction times.
+HOUR = 60
+DAY = 24 * 60
+KEY_COLUMNS = ("User", "Card")
+VELOCITY_COLUMNS = (
+    "Card Transactions 1h",
+    "Card Amount 1h",
+    "Card Transactions 24h",
+    "Card Amount 24h",
+    "Card Merchants 24h",
+    "Card Minutes Since Last",
+)
+VELOCITY_DTYPES = (np.int64, np.float64, np.int64, np.float64, np.int64,
+                   np.int64)
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def event_minute(year, month, day, hour, minute):
+    """ Return the minutes since the epoch of a transaction time. """
+    return ((date(year, month, day).toordinal() - EPOCH_ORDINAL) * DAY
+            + hour * HOUR + minute)
+
+
+def _cents(amount):
+    """ Return an amount in integer cents, missing amounts as 0. """
+    if amount is None or amount != amount:
+        return 0
+    return round(amount * 100)
+
+
+def event_minutes(data_df):
+    """ Return the minutes since the epoch of every transaction of a
+    preprocessed polars DataFrame, as ``event_minute`` does.
+    """
+    import polars as pl
+
+    return data_df.select(
+        pl.date("Year", "Month", "Day").cast(pl.Int64) * DAY
+        + pl.col("Hour").cast(pl.Int64) * HOUR
+        + pl.col("Minute").cast(pl.Int64)
+    ).to_series().to_numpy()
+
+
+def backfill(data_df, by_time=False):
+    """ Return a preprocessed polars DataFrame with its velocity features.
+
+    The transactions of each card are taken in row order, as if streamed
+    into a ``VelocityStore`` one by one. With ``by_time`` they are taken in
+    time order instead, ties in row order, which is how a history should be
+    replayed. Rows are returned in their original order either way.
+    """
+    import polars as pl
+
+    count = len(data_df)
+    minutes = event_minutes(data_df)
+    users = data_df.get_column("User").to_numpy()
+    cards = data_df.get_column("Card").to_numpy()
+    amounts = np.nan_to_num(
+        data_df.get_column("Amount").cast(pl.Float64).to_numpy())
+    cents = np.rint(amounts * 100).astype(np.int64)
+    _, merchants = np.unique(data_df.get_column("Merchant Name").to_numpy(),
+                             return_inverse=True)
+
+    # np.lexsort is stable, so each card's transactions keep their order.
+    order = np.lexsort((minutes, cards, users) if by_time else (cards, users))
+    position = np.arange(count)
+    user, card = users[order], cards[order]
+    first = np.ones(count, dtype=bool)
+    first[1:] = (user[1:] != user[:-1]) | (card[1:] != card[:-1])
+    group = np.cumsum(first) - 1
+    group_start = np.maximum.accumulate(np.where(first, position, 0))
+
+    # Times of all cards laid end to end on one timeline, each card's times
+    # made non-decreasing, so windows are found with one binary search.
+    minute = minutes[order]
+    origin = minute.min() if count else 0
+    span = (minute.max() - origin + 1) if count else 1
+    timeline = np.maximum.accumulate(group * span + minute - origin)
+    minute = timeline - group * span + origin
+
+    def window_start(width):
+        return np.maximum(
+            np.searchsorted(timeline, timeline - width, side="right"),
+            group_start)
+
+    totals = np.concatenate([[0], np.cumsum(cents[order])])
+    hour_start = window_start(HOUR)
+    day_start = window_start(DAY)
+    hour_count = position - hour_start + 1
+    day_count = position - day_start + 1
+
+    # A merchant paid again within a window is only counted once: every
+    # (previous, next) pair of payments to one merchant by one card is a
+    # repeat for the transactions from the next one on, as long as the
+    # previous one is still inside their 24 hour window.
+    merchant = merchants[order]
+    by_merchant = np.lexsort((position, merchant, group))
+    repeated = ((group[by_merchant][1:] == group[by_merchant][:-1])
+                & (merchant[by_merchant][1:] == merchant[by_merchant][:-1]))
+    previous = by_merchant[:-1][repeated]
+    following = by_merchant[1:][repeated]
+    expired = np.searchsorted(day_start, previous, side="right")
+    counted = expired > following
+    repeats = np.cumsum(
+        np.bincount(following[counted], minlength=count + 1)
+        - np.bincount(expired[counted], minlength=count + 1))[:count]
+
+    gap = np.minimum(np.diff(minute, prepend=minute[:1]), DAY)
+    gap[first] = DAY
+
+    values = (
+        hour_count,
+        (totals[position + 1] - totals[hour_start]) / 100,
+        day_count,
+        (totals[position + 1] - totals[day_start]) / 100,
+        day_count - repeats,
+        gap,
+    )
+    columns = []
+    for name, sorted_values in zip(VELOCITY_COLUMNS, values):
+        column = np.empty_like(sorted_values)
+        column[order] = sorted_values
+        columns.append(pl.Series(name, column))
+    return data_df.with_columns(columns)
+
+
+def missing_velocity_columns(model, columns):
+    """ Return the velocity features a pipeline, compiled or not, reads
+    that are not among ``columns``.
+    """
+    read = getattr(model, "feature_columns", None)
+    if read is None:
+        # The category codes step takes any columns, the next one records
+        # those the pipeline was fitted on.
+        read = next((step.feature_names_in_ for _, step in model.steps
+                     if hasattr(step, "feature_names_in_")), ())
+    read = set(read)
+    return [column for column in VELOCITY_COLUMNS
+            if column in read and column not in columns]
+
+
+def require_velocity_columns(model, columns, scorer):
+    """ Raise a ValueError when a model reads velocity features that are not
+    among ``columns``. Only the service's runner keeps the card histories
+    they are computed from online, other scorers need them in their input.
+    """
+    missing = missing_velocity_columns(model, columns)
+    if missing:
+        message = (f"{scorer} cannot compute the velocity features the "
+                   f"model reads, add {', '.join(missing)} to its input or "
+                   "score through the service's /predict endpoint")
+        raise ValueError(message)
+
+
+class _CardState:
+    """ History of one card: its transactions of the last hour and of the
+    last 24 hours with their totals, and the merchants paid in the latter.
+
+    The windows are deques used as ring buffers. Updates come one
+    transaction at a time, where deque operations on Python ints are cheaper
+    than indexing NumPy arrays, and snapshots lay them out as arrays.
+    """
+    __slots__ = ("last_minute", "hour", "hour_cents", "day", "day_cents",
+                 "merchants")
+
+    def __init__(self, last_minute):
+        self.last_minute = last_minute
+        self.hour = deque()
+        self.hour_cents = 0
+        self.day = deque()
+        self.day_cents = 0
+        self.merchants = {}
+
+    def add(self, minute, cents, merchant):
+        """ Add a transaction and evict those out of its windows. """
+        self.hour.append((minute, cents))
+        self.hour_cents += cents
+        while self.hour[0][0] <= minute - HOUR:
+            self.hour_cents -= self.hour.popleft()[1]
+        self.day.append((minute, cents, merchant))
+        self.day_cents += cents
+        self.merchants[merchant] = self.merchants.get(merchant, 0) + 1
+        while self.day[0][0] <= minute - DAY:
+            _, old_cents, old_merchant = self.day.popleft()
+            self.day_cents -= old_cents
+            if self.merchants[old_merchant] == 1:
+                del self.merchants[old_merchant]
+            else:
+                self.merchants[old_merchant] -= 1
+
+
+class VelocityStore:
+    """ Online per-card history, updated and read once per transaction. """
+
+    def __init__(self):
+        self._cards = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """ Number of cards with a history. """
+        return len(self._cards)
+
+    def update(self, user, card, minute, cents, merchant):
+        """ Add a transaction to its card's history and return its velocity
+        features, in ``VELOCITY_COLUMNS`` order.
+        """
+        state = self._cards.get((user, card))
+        if state is None:
+            state = self._cards[(user, card)] = _CardState(minute)
+            gap = DAY
+        else:
+            minute = max(minute, state.last_minute)
+            gap = min(minute - state.last_minute, DAY)
+            state.last_minute = minute
+        state.add(minute, cents, merchant)
+        return (len(state.hour), state.hour_cents / 100, len(state.day),
+                state.day_cents / 100, len(state.merchants), gap)
+
+    def features(self, data):
+        """ Add a DataFrame of preprocessed transactions to the history, in
+        row order, and return their velocity features as a dict of arrays.
+        """
+        columns = [
+            data[column].to_numpy().tolist()
+            for column in ("User", "Card", "Year", "Month", "Day", "Hour",
+                           "Minute", "Amount", "Merchant Name")
+        ]
+        with self._lock:
+            rows = [
+                self.update(user, card,
+                            event_minute(year, month, day, hour, minute),
+                            _cents(amount), merchant)
+                for user, card, year, month, day, hour, minute, amount,
+                merchant in zip(*columns)
+            ]
+        return {
+            name: np.array(values, dtype=dtype)
+            for name, values, dtype in zip(
+                VELOCITY_COLUMNS,
+                zip(*rows) if rows else [()] * len(VELOCITY_COLUMNS),
+                VELOCITY_DTYPES)
+        }
+
+    def add_features(self, data):
+        """ Return a pandas or polars DataFrame with the velocity features
+        from ``features`` added.
+        """
+        values = self.features(data)
+        if hasattr(data, "with_columns"):
+            import polars as pl
+
+            return data.with_columns([pl.Series(name, column)
+                                      for name, column in values.items()])
+        return data.assign(**values)
+
+    def snapshot(self, path):
+        """ Atomically save the history to a ``.npz`` file. Merchants must
+        be integers, as the dataset's merchant ids are.
+        """
+        with self._lock:
+            keys = list(self._cards)
+            states = [self._cards[key] for key in keys]
+            events = [event for state in states for event in state.day]
+            arrays = {
+                "users": np.array([key[0] for key in keys], dtype=np.int64),
+                "cards": np.array([key[1] for key in keys], dtype=np.int64),
+                "last_minutes": np.array(
+                    [state.last_minute for state in states], dtype=np.int64),
+                "lengths": np.array([len(state.day) for state in states],
+                                    dtype=np.int64),
+                "minutes": np.array([event[0] for event in events],
+                                    dtype=np.int64),
+                "cents": np.array([event[1] for event in events],
+                                  dtype=np.int64),
+                "merchants": np.array([event[2] for event in events],
+                                      dtype=np.int64),
+            }
+        partial_path = f"{path}.partial"
+        with open(partial_path, "wb") as snapshot_file:
+            np.savez(snapshot_file, **arrays)
+        os.replace(partial_path, path)
+
+    @classmethod
+    def restore(cls, path):
+        """ Load a history saved with ``snapshot``. """
+        store = cls()
+        with np.load(path) as arrays:
+            ends = np.cumsum(arrays["lengths"]).tolist()
+            minutes = arrays["minutes"].tolist()
+            cents = arrays["cents"].tolist()
+            merchants = arrays["merchants"].tolist()
+            start = 0
+            for user, card, last_minute, end in zip(
+                    arrays["users"].tolist(), arrays["cards"].tolist(),
+                    arrays["last_minutes"].tolist(), ends):
+                state = _CardState(last_minute)
+                for event in zip(minutes[start:end], cents[start:end],
+                                 merchants[start:end]):
+                    state.add(*event)
+                store._cards[(user, card)] = state
+                start = end
+        return store
+
+
+def main():
+    """ Replay a transactions CSV into a velocity history snapshot. """
+    import argparse
+
+    import polars as pl
+
+    from util.ingest import SOURCE_SCHEMA
+    from util.preprocessing import preprocess_dataset
+
+    parser = argparse.ArgumentParser(description="Build the per-card \
+velocity history of a transactions CSV, to warm start the service with.")
+    parser.add_argument("source", help="Transactions CSV file")
+    parser.add_argument("output", help="Snapshot .npz file")
+    args = parser.parse_args()
+
+    data_df = preprocess_dataset(
+        pl.read_csv(args.source, dtypes=SOURCE_SCHEMA))
+    minutes = event_minutes(data_df)
+    order = np.argsort(minutes, kind="stable")
+    data_df = data_df[order].with_columns(
+        pl.Series("event_minute", minutes[order]))
+    # Only the last 24 hours of each card are part of its history.
+    recent_df = data_df.filter(
+        pl.col("event_minute")
+        > pl.col("event_minute").max().over(KEY_COLUMNS) - DAY)
+    store = VelocityStore()
+    store.add_features(recent_df)
+    store.snapshot(args.output)
+    print(f"Saved the history of {len(store)} cards from "
+          f"{len(recent_df)} transactions")
+
+
+if __name__ == "__main__":
+    main()